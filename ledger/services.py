@@ -0,0 +1,59 @@
+# ledger/services.py
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models import F
+
+from .models import PointsLedger
+
+
+class InsufficientPoints(Exception):
+    """The user's balance does not cover a debit."""
+
+
+def credit_points(user, amount, *, type, note="", survey_id=None, submission_id=None, redemption_id=None):
+    """
+    Change a user's balance by `amount` (negative to debit) and record it in the
+    ledger, in one transaction.
+
+    The balance moves with a single UPDATE ... SET points = points + n, so
+    concurrent credits cannot overwrite each other and no user row lock is held
+    beyond that statement. The in-memory user instance is not refreshed.
+    """
+    User = get_user_model()
+    user_id = getattr(user, "pk", user)
+
+    with transaction.atomic():
+        User.objects.filter(pk=user_id).update(points=F("points") + amount)
+        return PointsLedger.objects.create(
+            user_id=user_id,
+            amount=amount,
+            type=type,
+            survey_id=survey_id,
+            submission_id=submission_id,
+            redemption_id=redemption_id,
+            note=note,
+        )
+
+
+def debit_points(user, amount, *, type, note="", redemption_id=None):
+    """
+    Take `amount` points from a user's balance and record the negative entry
+    in the ledger, in one transaction.
+
+    The balance check and the decrement are one conditional UPDATE, so
+    concurrent debits cannot overdraw the balance. Raises InsufficientPoints
+    (leaving everything untouched) when the balance is short.
+    """
+    User = get_user_model()
+    user_id = getattr(user, "pk", user)
+
+    with transaction.atomic():
+        if not User.objects.filter(pk=user_id, points__gte=amount).update(points=F("points") - amount):
+            raise InsufficientPoints(f"User {user_id} has fewer than {amount} points.")
+        return PointsLedger.objects.create(
+            user_id=user_id,
+            amount=-amount,
+            type=type,
+            redemption_id=redemption_id,
+            note=note,
+        )
@@ -0,0 +1,55 @@
+import logging
+
+from celery import shared_task
+from django.contrib.auth import get_user_model
+from django.db.models import F, IntegerField, OuterRef, Q, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+from .models import PointsLedger
+
+logger = logging.getLogger(__name__)
+
+
+def _ledger_total(user_ref):
+    return Coalesce(
+        Subquery(
+            PointsLedger.objects
+            .filter(user_id=user_ref)
+            .order_by()
+            .values("user_id")
+            .annotate(total=Sum("amount"))
+            .values("total"),
+            output_field=IntegerField(),
+        ),
+        0,
+    )
+
+
+@shared_task
+def reconcile_points(fix=False):
+    """
+    Compare every user's balance with the sum of their ledger entries in one
+    query. Mismatches are logged and returned; with fix=True balances are reset
+    to the ledger sum (never below zero).
+    """
+    User = get_user_model()
+
+    mismatches = list(
+        User.objects
+        .annotate(ledger_total=_ledger_total(OuterRef("pk")))
+        .filter(~Q(points=F("ledger_total")))
+        .values_list("pk", "points", "ledger_total")
+    )
+
+    for user_id, points, ledger_total in mismatches:
+        logger.warning("Points mismatch for user %s: balance=%s ledger=%s", user_id, points, ledger_total)
+
+    if fix and mismatches:
+        ids = [user_id for user_id, _, ledger_total in mismatches if ledger_total >= 0]
+        # recomputed inside the UPDATE so credits that landed since the check are included
+        User.objects.filter(pk__in=ids).update(points=_ledger_total(OuterRef("pk")))
+
+    return [
+        {"user_id": user_id, "points": points, "ledger_total": ledger_total}
+        for user_id, points, ledger_total in mismatches
+    ]
@@ -1,3 +1,75 @@
 from django.test import TestCase
 
-# Create your tests here.
+from users.models import CustomUser
+
+from .models import PointsLedger
+from .services import InsufficientPoints, credit_points, debit_points
+from .tasks import reconcile_points
+
+
+def balance(user):
+    return CustomUser.objects.get(pk=user.pk).points
+
+
+class CreditPointsTests(TestCase):
+
+    def setUp(self):
+        self.user = CustomUser.objects.create_user("member", "m@example.com", "pw")
+
+    def test_credit_moves_balance_and_records_entry(self):
+        entry = credit_points(self.user, 30, type="survey_reward", survey_id=4, note="Completed survey")
+        credit_points(self.user.pk, -10, type="admin_adjust")
+
+        self.assertEqual(balance(self.user), 20)
+        self.assertEqual((entry.amount, entry.type, entry.survey_id), (30, "survey_reward", 4))
+        self.assertEqual(sorted(PointsLedger.objects.values_list("amount", flat=True)), [-10, 30])
+
+    def test_debit_takes_points_when_the_balance_covers_them(self):
+        credit_points(self.user, 25, type="survey_reward")
+        entry = debit_points(self.user, 25, type="redeem_spend", redemption_id=7)
+
+        self.assertEqual(balance(self.user), 0)
+        self.assertEqual((entry.amount, entry.redemption_id), (-25, 7))
+
+    def test_debit_beyond_the_balance_changes_nothing(self):
+        credit_points(self.user, 5, type="survey_reward")
+        with self.assertRaises(InsufficientPoints):
+            debit_points(self.user, 6, type="redeem_spend")
+
+        self.assertEqual(balance(self.user), 5)
+        self.assertEqual(PointsLedger.objects.count(), 1)
+
+
+class ReconcilePointsTests(TestCase):
+
+    def setUp(self):
+        self.user = CustomUser.objects.create_user("member", "m@example.com", "pw")
+        self.other = CustomUser.objects.create_user("other", "o@example.com", "pw")
+        credit_points(self.user, 40, type="survey_reward")
+        credit_points(self.other, 15, type="survey_reward")
+
+    def test_balances_matching_the_ledger_are_left_alone(self):
+        self.assertEqual(reconcile_points(), [])
+
+    def test_mismatches_are_reported_and_fixed(self):
+        # a balance changed outside the ledger
+        CustomUser.objects.filter(pk=self.user.pk).update(points=100)
+
+        with self.assertLogs("ledger.tasks", "WARNING"):
+            report = reconcile_points()
+        self.assertEqual(report, [{"user_id": self.user.pk, "points": 100, "ledger_total": 40}])
+        self.assertEqual(balance(self.user), 100)
+
+        with self.assertLogs("ledger.tasks", "WARNING"):
+            reconcile_points(fix=True)
+        self.assertEqual(balance(self.user), 40)
+        self.assertEqual(balance(self.other), 15)
+        self.assertEqual(reconcile_points(), [])
+
+    def test_negative_ledger_totals_are_not_applied(self):
+        PointsLedger.objects.create(user=self.other, amount=-50, type="admin_adjust")
+
+        with self.assertLogs("ledger.tasks", "WARNING"):
+            report = reconcile_points(fix=True)
+        self.assertEqual(report, [{"user_id": self.other.pk, "points": 15, "ledger_total": -35}])
+        self.assertEqual(balance(self.other), 15)
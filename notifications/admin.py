@@ -1,10 +1,39 @@
 from django.contrib import admin
 from unfold.admin import ModelAdmin
-from .models import Notification
+from .badge import invalidate_badges
+from .models import EmailBroadcast, Notification
 
 
 @admin.register(Notification)
 class NotificationAdmin(ModelAdmin):
     list_display = ("created_at", "user", "type", "title", "is_read")
     list_filter = ("type", "is_read", "created_at")
-    search_fields = ("user__username", "user__email", "title", "message", "url")
\ No newline at end of file
+    search_fields = ("user__username", "user__email", "title", "message", "url")
+
+    # deletes bypass the post_save receiver that keeps header badges current
+    def delete_model(self, request, obj):
+        super().delete_model(request, obj)
+        invalidate_badges([obj.user_id])
+
+    def delete_queryset(self, request, queryset):
+        user_ids = list(queryset.values_list("user_id", flat=True).distinct())
+        super().delete_queryset(request, queryset)
+        invalidate_badges(user_ids)
+
+
+@admin.register(EmailBroadcast)
+class EmailBroadcastAdmin(ModelAdmin):
+    list_display = ("created_at", "kind", "subject", "status", "recipients", "sent", "failed", "progress", "finished_at")
+    list_filter = ("kind", "status", "created_at")
+    search_fields = ("subject", "survey__title")
+    readonly_fields = (
+        "kind", "survey", "subject", "body", "status", "run", "last_user_id", "recipients", "chunks",
+        "chunks_done", "sent", "failed", "retries", "created_at", "finished_at",
+    )
+
+    def progress(self, obj):
+        return f"{obj.chunks_done}/{obj.chunks} chunks"
+    progress.short_description = "Progress"
+
+    def has_add_permission(self, request):
+        return False
@@ -0,0 +1,62 @@
+import uuid
+
+from django.core.cache import cache
+from django.db import transaction
+
+from .models import Notification
+
+BADGE_CACHE_TIMEOUT = 60 * 60  # seconds; entries are dropped on every change anyway
+LATEST_COUNT = 6  # notifications in the header dropdown
+
+
+def badge_version_key(user_id) -> str:
+    return f"notifications:badge-version:{user_id}"
+
+
+def badge_cache_key(user_id, version) -> str:
+    return f"notifications:badge:{user_id}:{version}"
+
+
+def _badge_version(user_id):
+    key = badge_version_key(user_id)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, uuid.uuid4().hex, BADGE_CACHE_TIMEOUT)
+        version = cache.get(key)  # None when the cache is down
+    return version
+
+
+def get_badge(user_id):
+    """
+    (unread count, latest notifications) for a user's header badge. Cached
+    per user under a version token that changes whenever one of their
+    notifications is created or changes.
+    """
+    # read before the queries: a change committed meanwhile outdates it
+    version = _badge_version(user_id)
+    key = badge_cache_key(user_id, version)
+    badge = cache.get(key) if version else None
+    if badge is None:
+        unread_count = Notification.objects.filter(user_id=user_id, is_read=False).count()
+        latest = list(
+            Notification.objects
+            .filter(user_id=user_id)
+            .only("id", "title", "is_read", "created_at", "url")
+            .order_by("-created_at")[:LATEST_COUNT]
+        )
+        badge = (unread_count, latest)
+        if version:
+            cache.set(key, badge, BADGE_CACHE_TIMEOUT)
+    return badge
+
+
+def invalidate_badges(user_ids):
+    """
+    Retire the badge version tokens of these users once the current
+    transaction commits (right away outside one). The next render starts
+    a new token; a render that read its token and counts before the change
+    stores them under the retired token, where nothing reads them.
+    """
+    keys = [badge_version_key(user_id) for user_id in set(user_ids)]
+    if keys:
+        transaction.on_commit(lambda: cache.delete_many(keys))
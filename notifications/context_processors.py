@@ -1,23 +1,22 @@
-from .models import Notification
+from django.utils.functional import SimpleLazyObject
+
+from .badge import get_badge
 
 
 def notifications_panel(request):
     """
     Adds notification badge count + latest notifications to templates.
-    Safe to use on any page; returns empty data when not authenticated.
+    Safe to use on any page; empty data when not authenticated.
+    Both values are lazy and come from the per-user badge cache, so pages
+    that do not render the badge cost nothing.
     """
-    if not request.user.is_authenticated:
-        return {}
-
-    unread_count = Notification.objects.filter(user=request.user, is_read=False).count()
-    latest_notifications = (
-        Notification.objects
-        .filter(user=request.user)
-        .only("id", "title", "is_read", "created_at", "url")
-        .order_by("-created_at")[:6]
-    )
+    def load():
+        if not request.user.is_authenticated:
+            return (0, [])
+        return get_badge(request.user.pk)
 
+    badge = SimpleLazyObject(load)
     return {
-        "unread_count": unread_count,
-        "latest_notifications": latest_notifications,
+        "unread_count": SimpleLazyObject(lambda: badge[0]),
+        "latest_notifications": SimpleLazyObject(lambda: badge[1]),
     }
\ No newline at end of file
@@ -0,0 +1,167 @@
+from django.db import connection, transaction
+from django.db.models import BooleanField, CharField, DateTimeField, IntegerField, Max, Min, Q, TextField, Value
+from django.utils.timezone import now
+
+from surveys.models import Submission
+from users.models import CustomUser
+from .badge import invalidate_badges
+from .models import BroadcastLedger, Notification
+
+FANOUT_ID_SPAN = 20000  # user ids per INSERT ... SELECT statement
+RECIPIENT_CHUNK_SIZE = 2000  # rows per server-side cursor round trip
+
+
+def survey_audience(survey, exclude_submitted=False):
+    """
+    Users a survey is published to: members of its groups, or everyone when
+    it has none. Group membership is an IN subquery, so no DISTINCT is needed.
+    """
+    users = CustomUser.objects.all()
+    if survey.groups.exists():
+        members = CustomUser.groups.through.objects.filter(
+            group_id__in=survey.groups.values("pk")
+        ).values("customuser_id")
+        users = users.filter(pk__in=members)
+    if exclude_submitted:
+        users = users.exclude(pk__in=Submission.objects.filter(survey=survey).values("user_id"))
+    return users
+
+
+def _insert_select(model, fields, rows, suffix="", params=(), returning=None):
+    """
+    INSERT INTO model's table (fields) <the SELECT of rows><suffix>. Returns
+    the row count, or with returning (a field name) that column of the
+    inserted rows.
+    """
+    qn = connection.ops.quote_name
+    columns = ", ".join(qn(model._meta.get_field(name).column) for name in fields)
+    select_sql, select_params = rows.query.sql_with_params()
+    if returning:
+        suffix += f" RETURNING {qn(model._meta.get_field(returning).column)}"
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"INSERT INTO {qn(model._meta.db_table)} ({columns}) {select_sql}{suffix}",
+            (*select_params, *params),
+        )
+        if returning:
+            return [row[0] for row in cursor.fetchall()]
+        return cursor.rowcount
+
+
+def _id_windows(users, id_span):
+    bounds = users.aggregate(lo=Min("pk"), hi=Max("pk"))
+    if bounds["lo"] is None:
+        return []
+    return [(lo, lo + id_span) for lo in range(bounds["lo"], bounds["hi"] + 1, id_span)]
+
+
+def fan_out_notifications(users, *, type, title, message="", url="", id_span=FANOUT_ID_SPAN):
+    """
+    Create one in-app Notification per user of a queryset, in the database.
+
+    The user id range is walked in windows of id_span ids, and every window
+    is a single INSERT INTO ... SELECT over the audience query. Only the
+    RETURNING user ids reach Python, to drop those users' cached badges.
+    Each statement commits on its own. Returns the number of notifications
+    created.
+    """
+    # the SELECT yields finished rows: user id plus the shared values as parameters
+    rows = users.order_by().annotate(
+        n_type=Value(type, output_field=CharField()),
+        n_title=Value(title, output_field=CharField()),
+        n_message=Value(message, output_field=TextField()),
+        n_url=Value(url, output_field=CharField()),
+        n_is_read=Value(False, output_field=BooleanField()),
+        n_created_at=Value(now(), output_field=DateTimeField()),
+    )
+    created = 0
+    for lo, hi in _id_windows(users, id_span):
+        window = rows.filter(pk__gte=lo, pk__lt=hi).values_list(
+            "pk", "n_type", "n_title", "n_message", "n_url", "n_is_read", "n_created_at"
+        )
+        user_ids = _insert_select(
+            Notification, ("user", "type", "title", "message", "url", "is_read", "created_at"), window,
+            returning="user",
+        )
+        invalidate_badges(user_ids)
+        created += len(user_ids)
+    return created
+
+
+def fan_out_broadcast(users, survey, kind, *, run, type, title, message="", url="",
+                      resend_after=None, id_span=FANOUT_ID_SPAN):
+    """
+    fan_out_notifications for a survey broadcast, at most once per user.
+
+    Every id window first claims its users in BroadcastLedger with one
+    INSERT ... SELECT ... ON CONFLICT DO NOTHING, or with resend_after (a
+    timedelta) ON CONFLICT DO UPDATE ... WHERE sent_at is older than that,
+    so recently reached users are skipped through the unique index. The
+    window's notifications are then created for the rows that statement
+    claimed, in the same transaction. Repeating a broadcast or retrying its
+    task therefore reaches nobody twice and picks up after the last
+    committed window. run marks the claimed rows (see BroadcastLedger.run).
+    Returns the number of notifications created.
+    """
+    stamp = now()
+    qn = connection.ops.quote_name
+    ledger = BroadcastLedger._meta
+    target = ", ".join(qn(ledger.get_field(name).column) for name in ("survey", "kind", "user"))
+    if resend_after is None:
+        conflict, params = f" ON CONFLICT ({target}) DO NOTHING", ()
+    else:
+        sent_at, run_column = qn(ledger.get_field("sent_at").column), qn(ledger.get_field("run").column)
+        conflict = (
+            f" ON CONFLICT ({target}) DO UPDATE"
+            f" SET {sent_at} = EXCLUDED.{sent_at}, {run_column} = EXCLUDED.{run_column}"
+            f" WHERE {qn(ledger.db_table)}.{sent_at} < %s"
+        )
+        params = (stamp - resend_after,)
+
+    claims = users.order_by().annotate(
+        l_survey=Value(survey.pk, output_field=IntegerField()),
+        l_kind=Value(kind, output_field=CharField()),
+        l_sent_at=Value(stamp, output_field=DateTimeField()),
+        l_run=Value(run, output_field=CharField()),
+    )
+    # rows claimed by this call, inserted or re-stamped alike
+    claimed = BroadcastLedger.objects.filter(survey=survey, kind=kind, run=run, sent_at=stamp)
+    created = 0
+    for lo, hi in _id_windows(users, id_span):
+        window = claims.filter(pk__gte=lo, pk__lt=hi).values_list("pk", "l_survey", "l_kind", "l_sent_at", "l_run")
+        with transaction.atomic():
+            if not _insert_select(BroadcastLedger, ("user", "survey", "kind", "sent_at", "run"), window, conflict, params):
+                continue
+            created += fan_out_notifications(
+                CustomUser.objects.filter(pk__in=claimed.filter(user_id__gte=lo, user_id__lt=hi).values("user_id")),
+                type=type,
+                title=title,
+                message=message,
+                url=url,
+                id_span=id_span,
+            )
+    return created
+
+
+def claimed_users(run):
+    """Users whose BroadcastLedger rows were last claimed by run."""
+    return CustomUser.objects.filter(pk__in=BroadcastLedger.objects.filter(run=run).values("user_id"))
+
+
+def email_recipients(users, preference):
+    """
+    (user_id, username, email) of the users with an address who did not turn
+    off the given UserNotificationSettings flag (no settings row = allowed).
+
+    The settings are joined in the same query and rows are streamed, so
+    memory stays flat whatever the audience size.
+    """
+    allowed = Q(notification_settings__isnull=True) | Q(**{f"notification_settings__{preference}": True})
+    return (
+        users
+        .exclude(email="")
+        .filter(allowed)
+        .order_by("pk")
+        .values_list("pk", "username", "email")
+        .iterator(chunk_size=RECIPIENT_CHUNK_SIZE)
+    )
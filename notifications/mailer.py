@@ -0,0 +1,223 @@
+import logging
+import random
+import smtplib
+import time
+from itertools import islice
+
+from celery import group, shared_task
+from django.conf import settings
+from django.core.cache import cache
+from django.core.mail import EmailMessage, get_connection
+from django.db.models import F
+from django.utils.timezone import now
+
+from .fanout import email_recipients
+from .models import EmailBroadcast
+
+logger = logging.getLogger(__name__)
+
+DISPATCH_GROUP_SIZE = 50  # chunk tasks per Celery group
+RATE_WINDOW = 60  # seconds; EMAIL_DOMAIN_RATE_LIMITS are per window
+
+
+class _PooledConnection:
+    """
+    One SMTP session per worker process, kept open across chunks and
+    reopened after EMAIL_MESSAGES_PER_CONNECTION messages or when the
+    server dropped it.
+    """
+
+    def __init__(self):
+        self.backend = None
+        self.used = 0
+
+    def reset(self):
+        if self.backend is not None:
+            try:
+                self.backend.close()
+            except Exception:  # the session is being thrown away anyway
+                pass
+        self.backend = None
+        self.used = 0
+
+    def send(self, message):
+        if self.backend is not None and self.used >= settings.EMAIL_MESSAGES_PER_CONNECTION:
+            self.reset()
+        for reconnect in (False, True):
+            if self.backend is None:
+                self.backend = get_connection(fail_silently=False)
+                self.backend.open()
+            try:
+                self.backend.send_messages([message])
+                self.used += 1
+                return
+            except smtplib.SMTPServerDisconnected:
+                # idle sessions get closed server-side: one fresh attempt
+                self.reset()
+                if reconnect:
+                    raise
+
+
+_connection = _PooledConnection()
+
+
+def rate_limit_wait(domain) -> float:
+    """
+    0 when one more message to domain fits its EMAIL_DOMAIN_RATE_LIMITS
+    budget for the current window (and takes it), else the seconds until
+    the next window. Counters live in the shared cache, so the limit holds
+    across workers; without the cache nothing is limited.
+    """
+    limits = settings.EMAIL_DOMAIN_RATE_LIMITS
+    limit = limits.get(domain, limits.get('*'))
+    if not limit:
+        return 0
+    window = int(time.time() // RATE_WINDOW)
+    key = f"mail:rate:{domain}:{window}"
+    cache.add(key, 0, RATE_WINDOW * 2)
+    try:
+        count = cache.incr(key)
+    except ValueError:  # evicted between add() and incr()
+        return 0
+    if count is None or count <= limit:
+        return 0
+    return RATE_WINDOW - time.time() % RATE_WINDOW
+
+
+def _record(broadcast_id, sent=0, failed=0, retries=0, chunk_done=False):
+    EmailBroadcast.objects.filter(pk=broadcast_id).update(
+        sent=F('sent') + sent,
+        failed=F('failed') + failed,
+        retries=F('retries') + retries,
+        chunks_done=F('chunks_done') + (1 if chunk_done else 0),
+    )
+    if chunk_done:
+        _finish_if_complete(broadcast_id)
+
+
+def _finish_if_complete(broadcast_id):
+    EmailBroadcast.objects.filter(
+        pk=broadcast_id,
+        status=EmailBroadcast.STATUS_SENDING,
+        chunks_done=F('chunks'),
+    ).update(status=EmailBroadcast.STATUS_DONE, finished_at=now())
+
+
+@shared_task(bind=True, acks_late=True)
+def send_email_chunk(self, broadcast_id, recipients, attempt=1):
+    """
+    Send one chunk of a broadcast; recipients is [[username, email], ...].
+
+    Addresses the server refuses for good count as failed. After a transient
+    SMTP error, or for domains over their rate limit, the rest of the chunk
+    runs again later: with exponential backoff after errors (up to
+    EMAIL_MAX_ATTEMPTS runs), at the next rate window otherwise.
+    """
+    broadcast = EmailBroadcast.objects.filter(pk=broadcast_id).only('subject', 'body').first()
+    if broadcast is None:
+        return None
+
+    sent = failed = 0
+    pending = []
+    limited = {}  # domain -> seconds until its next window
+    error = None
+    for username, email in recipients:
+        domain = email.rpartition('@')[2].lower()
+        if error is None and domain not in limited:
+            wait = rate_limit_wait(domain)
+            if wait:
+                limited[domain] = wait
+        if error is not None or domain in limited:
+            pending.append([username, email])
+            continue
+
+        message = EmailMessage(
+            broadcast.subject,
+            broadcast.body.replace('{username}', username),
+            settings.DEFAULT_FROM_EMAIL,
+            [email],
+        )
+        try:
+            _connection.send(message)
+            sent += 1
+        except smtplib.SMTPRecipientsRefused:
+            failed += 1
+        except smtplib.SMTPResponseException as exc:
+            if exc.smtp_code >= 500:  # permanent rejection of this message
+                failed += 1
+            else:
+                error = exc
+                pending.append([username, email])
+                _connection.reset()
+        except (smtplib.SMTPException, OSError) as exc:
+            error = exc
+            pending.append([username, email])
+            _connection.reset()
+
+    if error is not None and attempt >= settings.EMAIL_MAX_ATTEMPTS:
+        logger.warning(
+            "Broadcast %s: giving up on %d recipient(s) after %d attempts: %r",
+            broadcast_id, len(pending), attempt, error,
+        )
+        failed += len(pending)
+        pending = []
+
+    _record(broadcast_id, sent=sent, failed=failed, retries=1 if pending else 0, chunk_done=not pending)
+    if pending:
+        if error is not None:
+            countdown = max(settings.EMAIL_RETRY_BACKOFF * 2 ** (attempt - 1), *limited.values(), 0)
+            attempt += 1  # rate-limit deferrals alone do not use up attempts
+        else:
+            countdown = max(limited.values())
+        countdown += random.uniform(0, countdown / 10)  # spread re-runs of many chunks
+        raise self.retry(args=[broadcast_id, pending, attempt], countdown=countdown, max_retries=None)
+    return {'sent': sent, 'failed': failed}
+
+
+def start_email_broadcast(kind, subject, body, users, preference, survey=None, run=""):
+    """
+    Queue an email to the users of a queryset who allow it (see
+    fanout.email_recipients for preference).
+
+    Recipients are streamed in user id order and cut into EMAIL_CHUNK_SIZE
+    chunks, one send_email_chunk task each, dispatched as Celery groups of
+    DISPATCH_GROUP_SIZE, so workers share the load and the dispatcher never
+    holds the whole audience. After each group the last queued user id is
+    recorded: called again with the same run, a dispatch that died halfway
+    resumes after it (at worst one group goes out twice) and a finished one
+    is returned as is. Progress is counted on the returned EmailBroadcast,
+    which turns done when its last chunk finishes.
+    """
+    broadcast = EmailBroadcast.objects.filter(run=run).first() if run else None
+    if broadcast is None:
+        broadcast = EmailBroadcast.objects.create(kind=kind, subject=subject, body=body, survey=survey, run=run)
+    elif broadcast.status != EmailBroadcast.STATUS_QUEUING:
+        return broadcast
+    if broadcast.last_user_id is not None:
+        users = users.filter(pk__gt=broadcast.last_user_id)
+
+    recipients = email_recipients(users, preference)
+    chunks, total = broadcast.chunks, broadcast.recipients
+    while True:
+        batch = []
+        last_user_id = None
+        while len(batch) < DISPATCH_GROUP_SIZE:
+            rows = list(islice(recipients, settings.EMAIL_CHUNK_SIZE))
+            if not rows:
+                break
+            batch.append([[username, email] for _user_id, username, email in rows])
+            last_user_id = rows[-1][0]
+        if not batch:
+            break
+        group(send_email_chunk.s(broadcast.pk, chunk) for chunk in batch).apply_async()
+        chunks += len(batch)
+        total += sum(len(chunk) for chunk in batch)
+        EmailBroadcast.objects.filter(pk=broadcast.pk).update(
+            chunks=chunks, recipients=total, last_user_id=last_user_id
+        )
+
+    # chunks only finish the broadcast once all of them are out
+    EmailBroadcast.objects.filter(pk=broadcast.pk).update(status=EmailBroadcast.STATUS_SENDING)
+    _finish_if_complete(broadcast.pk)
+    broadcast.refresh_from_db()
+    return broadcast
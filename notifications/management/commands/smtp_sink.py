@@ -0,0 +1,59 @@
+import time
+from collections import Counter
+
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    """
+    python manage.py smtp_sink
+    python manage.py smtp_sink --port 2525 --quiet
+    """
+    help = (
+        "Run a local SMTP server that accepts and drops every message, to exercise the "
+        "bulk email pipeline without sending real mail (needs aiosmtpd)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='localhost')
+        parser.add_argument('--port', type=int, default=1025)
+        parser.add_argument(
+            '--quiet',
+            action='store_true',
+            help='Only print totals every few seconds, not one line per message.',
+        )
+
+    def handle(self, *args, **options):
+        try:
+            from aiosmtpd.controller import Controller
+        except ImportError:
+            raise CommandError("smtp_sink needs aiosmtpd: pip install aiosmtpd")
+
+        stdout = self.stdout
+        quiet = options['quiet']
+        domains = Counter()
+
+        class Sink:
+            async def handle_DATA(self, server, session, envelope):
+                for address in envelope.rcpt_tos:
+                    domains[address.rpartition('@')[2].lower()] += 1
+                if not quiet:
+                    stdout.write(f"{envelope.mail_from} -> {', '.join(envelope.rcpt_tos)}")
+                return '250 Message accepted for delivery'
+
+        controller = Controller(Sink(), hostname=options['host'], port=options['port'])
+        controller.start()
+        self.stdout.write(f"SMTP sink on {options['host']}:{options['port']}, Ctrl+C to stop.")
+        started = time.monotonic()
+        try:
+            while True:
+                time.sleep(5)
+                total = sum(domains.values())
+                if total:
+                    rate = total / (time.monotonic() - started)
+                    top = ", ".join(f"{d}: {n}" for d, n in domains.most_common(5))
+                    self.stdout.write(f"{total} message(s), {rate:.1f}/s ({top})")
+        except KeyboardInterrupt:
+            pass
+        finally:
+            controller.stop()
@@ -9,6 +9,8 @@ class Notification(models.Model):
         ("redeem_approved", "Redemption approved"),
         ("redeem_rejected", "Redemption rejected"),
         ("redeem_fulfilled", "Redemption fulfilled"),
+        ("export_ready", "Export ready"),
+        ("export_failed", "Export failed"),
     ]
 
     user = models.ForeignKey(
@@ -32,4 +34,89 @@ class Notification(models.Model):
         ordering = ["-created_at"]
 
     def __str__(self):
-        return f"{self.user} - {self.type} - {self.title}"
\ No newline at end of file
+        return f"{self.user} - {self.type} - {self.title}"
+
+
+class BroadcastLedger(models.Model):
+    """
+    Who got a survey broadcast (announcement / reminder) and when.
+
+    Fan-out claims rows with INSERT ... ON CONFLICT before creating
+    notifications or emails (notifications.fanout), so a repeated admin
+    action or a retried task reaches nobody twice. run is the Celery task id
+    that last claimed the row, which lets a retry resume its own emails.
+    """
+    KIND_SURVEY_NEW = "survey_new"
+    KIND_SURVEY_REMINDER = "survey_reminder"
+    KIND_CHOICES = [
+        (KIND_SURVEY_NEW, "New survey"),
+        (KIND_SURVEY_REMINDER, "Survey reminder"),
+    ]
+
+    survey = models.ForeignKey(
+        "surveys.Survey",
+        on_delete=models.CASCADE,
+        related_name="broadcast_ledger",
+    )
+    kind = models.CharField(max_length=30, choices=KIND_CHOICES)
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name="broadcast_ledger",
+    )
+    sent_at = models.DateTimeField()
+    run = models.CharField(max_length=64, db_index=True)
+
+    class Meta:
+        unique_together = ("survey", "kind", "user")  # the ON CONFLICT target
+
+    def __str__(self):
+        return f"{self.survey_id} - {self.kind} - {self.user_id}"
+
+
+class EmailBroadcast(models.Model):
+    """
+    One bulk email send (notifications.mailer) and its delivery counters.
+    "{username}" in the body is replaced per recipient.
+    """
+    STATUS_QUEUING = "queuing"
+    STATUS_SENDING = "sending"
+    STATUS_DONE = "done"
+    STATUS_CHOICES = [
+        (STATUS_QUEUING, "Queuing"),
+        (STATUS_SENDING, "Sending"),
+        (STATUS_DONE, "Done"),
+    ]
+
+    kind = models.CharField(max_length=30)
+    survey = models.ForeignKey(
+        "surveys.Survey",
+        null=True,
+        blank=True,
+        on_delete=models.SET_NULL,
+        related_name="email_broadcasts",
+    )
+    subject = models.CharField(max_length=255)
+    body = models.TextField()
+    # task run that started it (BroadcastLedger.run): a retried run resumes it
+    run = models.CharField(max_length=64, blank=True, db_index=True)
+    # dispatch cursor: recipients up to this user id have been queued
+    last_user_id = models.BigIntegerField(null=True, blank=True)
+
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=STATUS_QUEUING)
+    recipients = models.PositiveIntegerField(default=0)
+    chunks = models.PositiveIntegerField(default=0)
+    chunks_done = models.PositiveIntegerField(default=0)
+    sent = models.PositiveIntegerField(default=0)
+    failed = models.PositiveIntegerField(default=0)
+    # chunk re-runs after SMTP errors or domain rate limits
+    retries = models.PositiveIntegerField(default=0)
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ["-created_at"]
+
+    def __str__(self):
+        return f"{self.kind}: {self.subject}"
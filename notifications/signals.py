@@ -0,0 +1,13 @@
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+
+from .badge import invalidate_badges
+from .models import Notification
+
+
+# Bulk paths (fan-out inserts, mark_all_read, admin deletes) call
+# invalidate_badges themselves. There is deliberately no post_delete receiver:
+# it would turn cascade deletes of users into row-by-row deletes.
+@receiver(post_save, sender=Notification)
+def notification_saved(sender, instance: Notification, **kwargs):
+    invalidate_badges([instance.user_id])
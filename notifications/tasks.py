@@ -1,141 +1,107 @@
+from datetime import timedelta
+from uuid import uuid4
+
 from celery import shared_task
-from django.core.mail import send_mass_mail, send_mail
-from django.contrib.auth.models import Group
-from users.models import CustomUser
+from django.core.mail import send_mail
 from surveys.models import Survey
 from django.conf import settings
 from django.urls import reverse
-from surveys.models import Submission
-from .models import Notification
+from .fanout import claimed_users, fan_out_broadcast, survey_audience
+from .mailer import start_email_broadcast
+from .models import BroadcastLedger
 from support.models import SupportTicket
 from rewards.models import PrizeRedemption
 
 
-@shared_task
-def send_survey_notification(survey_id):
+@shared_task(bind=True, acks_late=True)
+def send_survey_notification(self, survey_id):
+    """
+    Announce a survey to its audience, once per user: users already
+    announced to (by an earlier run or before a retry) are skipped.
+    """
     survey = Survey.objects.get(id=survey_id)
-
-    users = (
-        CustomUser.objects.filter(groups__in=survey.groups.all()).distinct()
-        if survey.groups.exists()
-        else CustomUser.objects.all()
-    )
+    users = survey_audience(survey)
+    run = self.request.id or uuid4().hex  # the same across retries of this task
 
     survey_path = reverse("surveys:survey_start", args=[survey.id])
     survey_url = settings.SITE_URL + survey_path  # for emails
 
-    # 1) In-app notifications (bulk)
-    notif_batch = []
-    notif_batch_size = 1000
-
-    # 2) Emails (mass mail)
-    messages = []
-    email_batch_size = 500
-
-    for user in users:
-        # In-app notification
-        notif_batch.append(Notification(
-            user=user,
-            type="survey_new",
-            title=f"New survey available: {survey.title}",
-            message=f"Earn {survey.points_reward} points. {survey.description}",
-            url=survey_path,
-        ))
-
-        if len(notif_batch) >= notif_batch_size:
-            Notification.objects.bulk_create(notif_batch)
-            notif_batch = []
-
-        # Email notification (optional: only if email exists, and user preferes)
-        prefs = getattr(user, "notification_settings", None)
-        email_allowed = (prefs is None) or prefs.email_new_surveys  # default True if missing
-
-        if user.email and email_allowed:
-            messages.append((
-                f"New Survey Available: {survey.title}",
-                f"Participate in our new survey: {survey.description}\n"
-                f"Earn {survey.points_reward} points!\n"
-                f"Access it here: {survey_url}",
-                settings.DEFAULT_FROM_EMAIL,
-                [user.email],
-            ))
-
-            if len(messages) >= email_batch_size:
-                send_mass_mail(messages, fail_silently=False)
-                messages = []
-
-    # Flush remaining
-    if notif_batch:
-        Notification.objects.bulk_create(notif_batch)
-
-    if messages:
-        send_mass_mail(messages, fail_silently=False)
+    # 1) In-app notifications for users claimed in the broadcast ledger
+    created = fan_out_broadcast(
+        users,
+        survey,
+        BroadcastLedger.KIND_SURVEY_NEW,
+        run=run,
+        type="survey_new",
+        title=f"New survey available: {survey.title}",
+        message=f"Earn {survey.points_reward} points. {survey.description}",
+        url=survey_path,
+    )
+
+    # 2) Emails to the users this run claimed, sent in parallel chunks
+    # (notifications.mailer); a retry resumes the run's dispatch
+    if not claimed_users(run).exists():
+        return created
+    start_email_broadcast(
+        "survey_new",
+        f"New Survey Available: {survey.title}",
+        f"Participate in our new survey: {survey.description}\n"
+        f"Earn {survey.points_reward} points!\n"
+        f"Access it here: {survey_url}",
+        claimed_users(run),
+        "email_new_surveys",
+        survey=survey,
+        run=run,
+    )
+    return created
 
 
-@shared_task
-def send_survey_reminder(survey_id):
+@shared_task(bind=True, acks_late=True)
+def send_survey_reminder(self, survey_id, interval=None):
     """
     Remind eligible users who have NOT submitted the survey yet.
     Creates in-app notifications + sends reminder emails.
+    Users reminded within the last interval seconds (default
+    SURVEY_REMINDER_INTERVAL) are skipped.
     """
     survey = Survey.objects.get(id=survey_id)
-
-    eligible_users = (
-        CustomUser.objects.filter(groups__in=survey.groups.all()).distinct()
-        if survey.groups.exists()
-        else CustomUser.objects.all()
-    )
-
-    # Exclude users who already submitted
-    completed_user_ids = Submission.objects.filter(survey=survey).values_list("user_id", flat=True)
-    users = eligible_users.exclude(id__in=completed_user_ids)
+    users = survey_audience(survey, exclude_submitted=True)
+    run = self.request.id or uuid4().hex
+    if interval is None:
+        interval = settings.SURVEY_REMINDER_INTERVAL
 
     survey_path = reverse("surveys:survey_start", args=[survey.id])
     survey_url = settings.SITE_URL + survey_path
 
     # In-app notifications
-    notif_batch = []
-    notif_batch_size = 1000
-
-    # Emails
-    messages = []
-    email_batch_size = 500
-
-    for user in users:
-        notif_batch.append(Notification(
-            user=user,
-            type="survey_new",  # or add "survey_reminder" if you want a separate type
-            title=f"Reminder: {survey.title}",
-            message=f"Don’t forget to complete this survey to earn {survey.points_reward} points.",
-            url=survey_path,
-        ))
-
-        if len(notif_batch) >= notif_batch_size:
-            Notification.objects.bulk_create(notif_batch)
-            notif_batch = []
-
-        prefs = getattr(user, "notification_settings", None)
-        email_allowed = (prefs is None) or prefs.email_survey_reminders  # default True if missing
-        if user.email and email_allowed:
-            messages.append((
-                f"Reminder: Complete {survey.title}",
-                f"Hi {user.username},\n\n"
-                f"Reminder to complete: {survey.title}\n"
-                f"Earn {survey.points_reward} points.\n\n"
-                f"Open it here: {survey_url}",
-                settings.DEFAULT_FROM_EMAIL,
-                [user.email],
-            ))
-
-            if len(messages) >= email_batch_size:
-                send_mass_mail(messages, fail_silently=False)
-                messages = []
-
-    if notif_batch:
-        Notification.objects.bulk_create(notif_batch)
-
-    if messages:
-        send_mass_mail(messages, fail_silently=False)
+    created = fan_out_broadcast(
+        users,
+        survey,
+        BroadcastLedger.KIND_SURVEY_REMINDER,
+        run=run,
+        resend_after=timedelta(seconds=interval),
+        type="survey_new",  # or add "survey_reminder" if you want a separate type
+        title=f"Reminder: {survey.title}",
+        message=f"Don’t forget to complete this survey to earn {survey.points_reward} points.",
+        url=survey_path,
+    )
+
+    # Emails ("{username}" is filled in per recipient)
+    if not claimed_users(run).exists():
+        return created
+    start_email_broadcast(
+        "survey_reminder",
+        f"Reminder: Complete {survey.title}",
+        "Hi {username},\n\n"
+        f"Reminder to complete: {survey.title}\n"
+        f"Earn {survey.points_reward} points.\n\n"
+        f"Open it here: {survey_url}",
+        claimed_users(run),
+        "email_survey_reminders",
+        survey=survey,
+        run=run,
+    )
+    return created
 
 
 @shared_task
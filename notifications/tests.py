@@ -1,3 +1,120 @@
+from datetime import timedelta
+from unittest import mock
+
+from django.core.cache import cache
 from django.test import TestCase
 
-# Create your tests here.
+from surveys.models import Survey
+from users.models import CustomUser
+
+from . import fanout
+from .badge import get_badge
+from .fanout import fan_out_broadcast
+from .models import BroadcastLedger, Notification
+
+
+class FanOutBroadcastTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.survey = Survey.objects.create(title="Survey", description="d")
+        self.users = [CustomUser.objects.create_user(f"user{i}", f"u{i}@example.com", "pw") for i in range(5)]
+
+    def broadcast(self, run, **kwargs):
+        return fan_out_broadcast(
+            CustomUser.objects.all(),
+            self.survey,
+            BroadcastLedger.KIND_SURVEY_NEW,
+            run=run,
+            type="survey_new",
+            title="New survey",
+            id_span=2,  # several windows for five users
+            **kwargs,
+        )
+
+    def notified(self):
+        return sorted(Notification.objects.values_list("user_id", flat=True))
+
+    def test_every_user_is_notified_once(self):
+        self.assertEqual(self.broadcast("run-1"), 5)
+        self.assertEqual(self.notified(), sorted(user.pk for user in self.users))
+        self.assertEqual(BroadcastLedger.objects.filter(run="run-1").count(), 5)
+
+        # the admin action clicked again, or another task for the same survey
+        self.assertEqual(self.broadcast("run-2"), 0)
+        self.assertEqual(Notification.objects.count(), 5)
+
+    def test_retry_after_a_failed_window_notifies_nobody_twice(self):
+        real = fanout.fan_out_notifications
+        calls = []
+
+        def failing_second_window(*args, **kwargs):
+            calls.append(1)
+            if len(calls) == 2:
+                raise RuntimeError("worker lost")
+            return real(*args, **kwargs)
+
+        with mock.patch.object(fanout, "fan_out_notifications", side_effect=failing_second_window):
+            with self.assertRaises(RuntimeError):
+                self.broadcast("run-1")
+        # the failed window rolled back its claims with its notifications
+        done = Notification.objects.count()
+        self.assertEqual(done, 2)
+        self.assertEqual(BroadcastLedger.objects.count(), done)
+
+        # the task retried with the same run picks up the remaining users
+        self.assertEqual(self.broadcast("run-1"), 5 - done)
+        self.assertEqual(self.notified(), sorted(user.pk for user in self.users))
+
+    def test_resend_after_only_reaches_users_notified_long_enough_ago(self):
+        self.broadcast("run-1")
+        self.assertEqual(self.broadcast("run-2", resend_after=timedelta(days=1)), 0)
+
+        BroadcastLedger.objects.filter(user__in=self.users[:2]).update(
+            sent_at=BroadcastLedger.objects.first().sent_at - timedelta(days=2)
+        )
+        self.assertEqual(self.broadcast("run-3", resend_after=timedelta(days=1)), 2)
+        self.assertEqual(Notification.objects.filter(user__in=self.users[:2]).count(), 4)
+        self.assertEqual(
+            sorted(BroadcastLedger.objects.filter(run="run-3").values_list("user_id", flat=True)),
+            sorted(user.pk for user in self.users[:2]),
+        )
+
+
+class BadgeTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = CustomUser.objects.create_user("member", "m@example.com", "pw")
+
+    def notify(self, **fields):
+        with self.captureOnCommitCallbacks(execute=True):
+            return Notification.objects.create(user=self.user, type="survey_new", title="Hello", **fields)
+
+    def test_badge_is_served_from_the_cache(self):
+        self.notify()
+        self.assertEqual(get_badge(self.user.pk)[0], 1)
+        with self.assertNumQueries(0):
+            self.assertEqual(get_badge(self.user.pk)[0], 1)
+
+    def test_new_and_read_notifications_invalidate_the_badge(self):
+        self.assertEqual(get_badge(self.user.pk), (0, []))
+
+        notification = self.notify()
+        unread, latest = get_badge(self.user.pk)
+        self.assertEqual((unread, [n.pk for n in latest]), (1, [notification.pk]))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            notification.is_read = True
+            notification.save()
+        self.assertEqual(get_badge(self.user.pk)[0], 0)
+
+    def test_fan_out_invalidates_the_recipients_badges(self):
+        self.assertEqual(get_badge(self.user.pk)[0], 0)
+        survey = Survey.objects.create(title="Survey", description="d")
+        with self.captureOnCommitCallbacks(execute=True):
+            fan_out_broadcast(
+                CustomUser.objects.all(), survey, BroadcastLedger.KIND_SURVEY_NEW,
+                run="run-1", type="survey_new", title="New survey",
+            )
+        self.assertEqual(get_badge(self.user.pk)[0], 1)
@@ -3,13 +3,14 @@ from django.shortcuts import get_object_or_404, redirect, render
 from django.views.decorators.http import require_POST
 from django.http import HttpResponseRedirect
 
+from .badge import get_badge, invalidate_badges
 from .models import Notification
 
 
 @login_required
 def notifications_list(request):
     qs = Notification.objects.filter(user=request.user).order_by("-created_at")[:200]
-    unread_count = Notification.objects.filter(user=request.user, is_read=False).count()
+    unread_count, _latest = get_badge(request.user.pk)
     return render(request, "notifications/list.html", {"notifications": qs, "unread_count": unread_count})
 
 
@@ -26,7 +27,8 @@ def mark_read(request, pk: int):
 @login_required
 @require_POST
 def mark_all_read(request):
-    Notification.objects.filter(user=request.user, is_read=False).update(is_read=True)
+    if Notification.objects.filter(user=request.user, is_read=False).update(is_read=True):
+        invalidate_badges([request.user.pk])
     return redirect("notifications:list")
 
 
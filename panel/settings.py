@@ -124,11 +124,41 @@ UNFOLD = {
                         "icon": "task_alt",
                         "link": reverse_lazy("admin:surveys_submission_changelist"),
                     },
+                    {
+                        "title": "Survey Runs",
+                        "icon": "pending_actions",
+                        "link": reverse_lazy("admin:surveys_surveyrun_changelist"),
+                    },
 {
                         "title": "AnswerFact",
                         "icon": "rate_review",
                         "link": reverse_lazy("admin:surveys_answerfact_changelist"),
                     },
+                    {
+                        "title": "Answer Aggregates",
+                        "icon": "functions",
+                        "link": reverse_lazy("admin:surveys_answeraggregate_changelist"),
+                    },
+                    {
+                        "title": "Exports",
+                        "icon": "download",
+                        "link": reverse_lazy("admin:surveys_exportjob_changelist"),
+                    },
+                    {
+                        "title": "Media Blobs",
+                        "icon": "perm_media",
+                        "link": reverse_lazy("admin:surveys_mediablob_changelist"),
+                    },
+                    {
+                        "title": "Media Derivatives",
+                        "icon": "photo_size_select_large",
+                        "link": reverse_lazy("admin:surveys_mediaderivative_changelist"),
+                    },
+                    {
+                        "title": "Crosstabs",
+                        "icon": "grid_on",
+                        "link": reverse_lazy("admin:surveys_answerfact_crosstab"),
+                    },
                 ],
             },
             {
@@ -156,6 +186,11 @@ UNFOLD = {
                         "icon": "notifications",
                         "link": reverse_lazy("admin:notifications_notification_changelist"),
                     },
+                    {
+                        "title": "Email Broadcasts",
+                        "icon": "outgoing_mail",
+                        "link": reverse_lazy("admin:notifications_emailbroadcast_changelist"),
+                    },
                     {
                         "title": "Support Tickets",
                         "icon": "support_agent",
@@ -191,12 +226,28 @@ SITE_URL = 'http://localhost:8000'  # Update to your production URL
 
 
 EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
-EMAIL_HOST = 'smtp.gmail.com'
+# EMAIL_HOST=localhost EMAIL_PORT=1025 EMAIL_USE_TLS=False points at `manage.py smtp_sink`
+EMAIL_HOST = config('EMAIL_HOST', default='smtp.gmail.com')
 EMAIL_PORT = config('EMAIL_PORT')
-EMAIL_USE_TLS = True
+EMAIL_USE_TLS = config('EMAIL_USE_TLS', default=True, cast=bool)
 EMAIL_HOST_USER = config('EMAIL_HOST_USER')
 EMAIL_HOST_PASSWORD = config('EMAIL_HOST_PASSWORD')
 DEFAULT_FROM_EMAIL = config('DEFAULT_FROM_EMAIL')
+EMAIL_TIMEOUT = 30  # seconds
+
+# Bulk email pipeline (notifications.mailer)
+EMAIL_CHUNK_SIZE = 200  # recipients per Celery subtask
+EMAIL_MESSAGES_PER_CONNECTION = 100  # SMTP servers cap messages per session
+EMAIL_MAX_ATTEMPTS = 5  # runs of a chunk before its remaining recipients count as failed
+EMAIL_RETRY_BACKOFF = 30  # seconds before a chunk's first re-run, doubled each time
+# messages per minute per recipient domain, shared by all workers; '*' = any other domain
+EMAIL_DOMAIN_RATE_LIMITS = {
+    '*': 600,
+    'gmail.com': 300,
+}
+
+# seconds; survey reminders skip users reminded more recently (notifications.BroadcastLedger)
+SURVEY_REMINDER_INTERVAL = 24 * 60 * 60
 
 
 # CORS (dev-friendly examples)
@@ -271,6 +322,44 @@ CELERY_ACCEPT_CONTENT = ['json']
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TIMEZONE = 'UTC'
+CELERY_BEAT_SCHEDULE = {
+    # pick up submission post-processing whose task message was lost
+    'sweep-submission-outbox': {
+        'task': 'surveys.tasks.sweep_outbox',
+        'schedule': 300.0,
+    },
+    # report balances that drifted from the points ledger (pass fix=True to repair)
+    'reconcile-points-ledger': {
+        'task': 'ledger.tasks.reconcile_points',
+        'schedule': 24 * 60 * 60.0,
+    },
+    # drop abandoned chunked uploads and their partial files
+    'purge-upload-sessions': {
+        'task': 'surveys.tasks.purge_upload_sessions',
+        'schedule': 60 * 60.0,
+    },
+    'collect-media-blobs': {
+        'task': 'surveys.tasks.collect_media_blobs',
+        'schedule': 6 * 60 * 60.0,
+    },
+}
+
+# Cache: set CACHE_URL (e.g. redis://localhost:6379/1) to share it between
+# web workers, so cached survey data is invalidated everywhere; without it
+# Django's default per-process memory cache is used
+CACHE_URL = config('CACHE_URL', default='')
+if CACHE_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django_redis.cache.RedisCache',
+            'LOCATION': CACHE_URL,
+            'OPTIONS': {
+                'CLIENT_CLASS': 'django_redis.client.DefaultClient',
+                # A cache outage degrades to cache misses instead of 500s
+                'IGNORE_EXCEPTIONS': True,
+            },
+        }
+    }
 
 # Password validation
 # https://docs.djangoproject.com/en/4.1/ref/settings/#auth-password-validators
@@ -312,9 +401,24 @@ STATICFILES_DIRS = [BASE_DIR / "static"]
 
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
+# admin export artifacts (respondent data): outside MEDIA_ROOT so the web
+# server never serves them; downloads go through a staff-only admin view
+EXPORT_ROOT = config('EXPORT_ROOT', default=str(BASE_DIR / 'private' / 'exports'))
 
 MAX_UPLOAD_SIZE = 25 * 1024 * 1024  # 25 MB
 
+# Chunked / resumable uploads (surveys.uploads)
+MAX_CHUNKED_UPLOAD_SIZE = 2 * 1024 * 1024 * 1024  # 2 GB per file
+UPLOAD_CHUNK_SIZE = 5 * 1024 * 1024  # size the browser sends per PUT
+UPLOAD_SESSION_TTL = 24 * 60 * 60  # seconds before unfinished sessions are purged
+MAX_OPEN_UPLOAD_SESSIONS = 10  # unfinished chunked uploads per user
+
+# Content-addressed media (surveys.storage): MEDIA_URL + 'blobs/' never changes
+# under a name, so the front server should send the same header for it
+MEDIA_BLOB_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+MEDIA_BLOB_GRACE = 24 * 60 * 60  # seconds an unreferenced blob is kept before deletion
+FFMPEG_BINARY = 'ffmpeg'  # renders video poster frames (surveys.derivatives)
+
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.1/ref/settings/#default-auto-field
@@ -15,7 +15,7 @@ Including another URLconf
 """
 
 from django.contrib import admin
-from django.urls import path, include
+from django.urls import path, include, re_path
 from . import views
 from django.conf import settings
 from django.conf.urls.static import static
@@ -35,7 +35,13 @@ urlpatterns = [
     path("support/", include("support.urls")),
     path("ledger/", include("ledger.urls")),
     path("notifications/", include("notifications.urls")),
-] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
+]
+# Development media serving; blobs go first for their immutable cache headers
+if settings.DEBUG:
+    urlpatterns.append(
+        re_path(rf"^{settings.MEDIA_URL.lstrip('/')}blobs/(?P<path>.*)$", views.media_blob)
+    )
+urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
 urlpatterns += static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)
 # Optional: only include in DEBUG mode
 if settings.DEBUG:
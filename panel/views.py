@@ -1,7 +1,20 @@
+import os
+
+from django.conf import settings
 from django.shortcuts import render, redirect
+from django.views.static import serve
+
+from surveys.storage import BLOB_DIR
 
 
 def home(request):
     if request.user.is_authenticated:
         return redirect("users:dashboard")
     return render(request, "home.html")
+
+
+def media_blob(request, path):
+    """Content-addressed media: the name changes with the bytes, so it can be cached for good."""
+    response = serve(request, path, document_root=os.path.join(settings.MEDIA_ROOT, BLOB_DIR))
+    response["Cache-Control"] = settings.MEDIA_BLOB_CACHE_CONTROL
+    return response
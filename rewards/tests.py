@@ -1,3 +1,63 @@
 from django.test import TestCase
+from django.urls import reverse
 
-# Create your tests here.
+from ledger.models import PointsLedger
+from ledger.services import credit_points
+from users.models import CustomUser
+
+from .models import Prize, PrizeRedemption
+
+
+class RedemptionTests(TestCase):
+
+    def setUp(self):
+        self.user = CustomUser.objects.create_user("member", "m@example.com", "pw")
+        credit_points(self.user, 15, type="survey_reward")
+        self.prize = Prize.objects.create(name="Mug", points_cost=10, stock=3)
+        self.client.force_login(self.user)
+
+    def redeem(self):
+        return self.client.post(reverse("rewards:redeem_prize", args=[self.prize.pk]))
+
+    def points(self):
+        return CustomUser.objects.get(pk=self.user.pk).points
+
+    def test_redeem_debits_points_and_stock(self):
+        self.assertRedirects(self.redeem(), reverse("rewards:prize_list"), fetch_redirect_response=False)
+
+        redemption = PrizeRedemption.objects.get()
+        self.assertEqual((redemption.status, redemption.points_spent), ("pending", 10))
+        self.assertEqual(self.points(), 5)
+        self.prize.refresh_from_db()
+        self.assertEqual(self.prize.stock, 2)
+        spend = PointsLedger.objects.get(type="redeem_spend")
+        self.assertEqual((spend.amount, spend.redemption_id), (-10, redemption.pk))
+
+    def test_redeem_without_enough_points_changes_nothing(self):
+        self.redeem()
+        response = self.redeem()
+
+        self.assertRedirects(response, reverse("rewards:prize_detail", args=[self.prize.pk]), fetch_redirect_response=False)
+        self.assertEqual(PrizeRedemption.objects.count(), 1)
+        self.assertEqual(self.points(), 5)
+        self.prize.refresh_from_db()
+        self.assertEqual(self.prize.stock, 2)
+
+    def test_out_of_stock_prize_is_not_redeemed(self):
+        Prize.objects.filter(pk=self.prize.pk).update(stock=0)
+        self.redeem()
+
+        self.assertFalse(PrizeRedemption.objects.exists())
+        self.assertEqual(self.points(), 15)
+
+    def test_cancel_refunds_points_and_stock(self):
+        self.redeem()
+        redemption = PrizeRedemption.objects.get()
+        self.client.post(reverse("rewards:cancel_redemption", args=[redemption.pk]))
+
+        redemption.refresh_from_db()
+        self.assertEqual(redemption.status, "cancelled")
+        self.assertEqual(self.points(), 15)
+        self.prize.refresh_from_db()
+        self.assertEqual(self.prize.stock, 3)
+        self.assertEqual(PointsLedger.objects.get(type="redeem_refund").amount, 10)
@@ -1,10 +1,9 @@
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
 from django.db import transaction
-from django.contrib.auth import get_user_model
 from django.db.models import F
 from django.shortcuts import get_object_or_404, redirect, render
-from ledger.models import PointsLedger
+from ledger.services import InsufficientPoints, credit_points, debit_points
 
 from .models import Prize, PrizeRedemption
 
@@ -50,8 +49,6 @@ def cancel_redemption(request, pk: int):
     if request.method != "POST":
         return redirect("rewards:my_redemptions")
 
-    User = get_user_model()
-
     with transaction.atomic():
         redemption = (
             PrizeRedemption.objects
@@ -64,13 +61,6 @@ def cancel_redemption(request, pk: int):
             messages.error(request, "Only pending redemptions can be cancelled.")
             return redirect("rewards:my_redemptions")
 
-        # lock user row
-        user_locked = User.objects.select_for_update().get(pk=request.user.pk)
-
-        # refund points
-        user_locked.points = F("points") + redemption.points_spent
-        user_locked.save(update_fields=["points"])
-
         # restore stock if limited
         prize = redemption.prize
         if prize.stock is not None:
@@ -80,9 +70,10 @@ def cancel_redemption(request, pk: int):
         redemption.status = "cancelled"
         redemption.save(update_fields=["status"])
 
-        PointsLedger.objects.create(
-            user=request.user,
-            amount=+redemption.points_spent,
+        # refund points (single UPDATE + ledger entry)
+        credit_points(
+            request.user,
+            +redemption.points_spent,
             type="redeem_refund",
             redemption_id=redemption.id,
             note="User cancelled redemption (refund)",
@@ -92,9 +83,6 @@ def cancel_redemption(request, pk: int):
     return redirect("rewards:my_redemptions")
 
 
-User = get_user_model()
-
-
 @login_required
 def redeem_prize(request, pk: int):
     """
@@ -118,41 +106,31 @@ def redeem_prize(request, pk: int):
             messages.error(request, "This prize is out of stock.")
             return redirect("rewards:prize_detail", pk=pk)
 
-        # Lock the real user model row (not SimpleLazyObject)
-        user_locked = User.objects.select_for_update().get(pk=user.pk)
-
-        if user_locked.points < prize.points_cost:
+        try:
+            # savepoint: a short balance rolls the redemption back with it
+            with transaction.atomic():
+                redemption = PrizeRedemption.objects.create(
+                    user_id=user.pk,
+                    prize=prize,
+                    points_spent=prize.points_cost,
+                    status="pending",
+                )
+                # balance check + deduction (single conditional UPDATE + ledger entry)
+                debit_points(
+                    user,
+                    prize.points_cost,
+                    type="redeem_spend",
+                    redemption_id=redemption.id,
+                    note=f"Redeemed prize: {prize.name}",
+                )
+        except InsufficientPoints:
             messages.error(request, "You do not have enough points to redeem this prize.")
             return redirect("rewards:prize_detail", pk=pk)
 
-        # Deduct points atomically
-        user_locked.points = F("points") - prize.points_cost
-        user_locked.save(update_fields=["points"])
-
-        # Stock handling (after locking prize)
+        # Stock handling (prize row is locked above)
         if prize.stock is not None:
-            if prize.stock <= 0:
-                messages.error(request, "This prize is out of stock.")
-                return redirect("rewards:prize_detail", pk=pk)
-
             prize.stock = F("stock") - 1
             prize.save(update_fields=["stock"])
 
-        # Create redemption record
-        redemption = PrizeRedemption.objects.create(
-            user=user_locked,
-            prize=prize,
-            points_spent=prize.points_cost,
-            status="pending",
-        )
-
-        PointsLedger.objects.create(
-            user=user_locked,
-            amount=-prize.points_cost,
-            type="redeem_spend",
-            redemption_id=redemption.id,  # see note below
-            note=f"Redeemed prize: {prize.name}",
-        )
-
     messages.success(request, "Redemption created! Status: Pending.")
     return redirect("rewards:prize_list")
\ No newline at end of file
@@ -4,23 +4,29 @@ from django.forms import BaseInlineFormSet
 from django.shortcuts import render, redirect, get_object_or_404, reverse
 import nested_admin
 import json
+import os
 from collections import defaultdict
 from django.urls import path
 from unfold.sites import UnfoldAdminSite
 from unfold.admin import ModelAdmin, StackedInline, TabularInline
 from django import forms
-from .forms import QuestionAdminForm, WizardQuestionForm, ChoiceWizardForm, MatrixColWizardForm, MatrixRowWizardForm
-from datetime import date
-import csv
+from .forms import CrosstabForm, QuestionAdminForm, WizardQuestionForm, ChoiceWizardForm, MatrixColWizardForm, MatrixRowWizardForm
 from django.utils.html import format_html
-from django.http import HttpResponse
-from .models import Survey, Question, Choice, Response, Submission, MatrixRow, MatrixColumn, SbsCellRouting, MatrixCellRouting, AnswerFact
+from django.core.exceptions import PermissionDenied
+from django.http import FileResponse, Http404, JsonResponse, StreamingHttpResponse
+from .models import Survey, Question, Choice, Response, Submission, MatrixRow, MatrixColumn, SbsCellRouting, MatrixCellRouting, AnswerFact, AnswerAggregate, SurveyRun, OutboxEvent, ExportJob, MediaBlob, MediaDerivative
 from notifications.tasks import send_survey_notification, send_survey_reminder
-import os
-import zipfile
-from django.utils.text import slugify
-from io import BytesIO, StringIO
+from .tasks import generate_media_derivatives, process_outbox_event, run_export_job
+from .exports import MediaZipStream, stream_responses_csv
+from unfold.decorators import action
+from .aggregates import recompute_answer_aggregates
+from .derivatives import with_derivatives
+from .media import recount_media_blobs
+from .storage import blob_storage
+from .crosstab import AGE_RANGES, CrosstabError, age_range_q, crosstab, crosstab_table
 from django.db.models import Max, Prefetch
+from django.db import transaction
+from functools import partial
 
 
 # Age range filter using date_of_birth
@@ -29,33 +35,34 @@ class AgeRangeFilter(admin.SimpleListFilter):
     parameter_name = 'age_range'
 
     def lookups(self, request, model_admin):
-        return [
-            ('under18', 'Under 18'),
-            ('18-30', '18 to 30'),
-            ('31-50', '31 to 50'),
-            ('51+', '51 and above'),
-        ]
+        # bands are shared with the crosstab age_range dimension
+        return [(value, label) for value, label, _min_age, _max_age in AGE_RANGES]
 
     def queryset(self, request, queryset):
-        today = date.today()
-
-        def calc_birthdate(years):
-            return date(today.year - years, today.month, today.day)
-
-        if self.value() == 'under18':
-            return queryset.filter(user__date_of_birth__gt=calc_birthdate(18))
-        elif self.value() == '18-30':
-            return queryset.filter(user__date_of_birth__lte=calc_birthdate(18),
-                                   user__date_of_birth__gt=calc_birthdate(30))
-        elif self.value() == '31-50':
-            return queryset.filter(user__date_of_birth__lte=calc_birthdate(30),
-                                   user__date_of_birth__gt=calc_birthdate(50))
-        elif self.value() == '51+':
-            return queryset.filter(user__date_of_birth__lte=calc_birthdate(50))
-
+        if self.value():
+            return queryset.filter(age_range_q(self.value()))
         return queryset
 
 
+def queue_export_job(request, kind, survey=None, responses=None, params=None):
+    """
+    Create an ExportJob for the admin user and hand it to Celery after commit.
+    The Responses to export are resolved here, in the request, and recorded
+    on the job, so the worker needs neither the admin nor the request.
+    """
+    with transaction.atomic():
+        job = ExportJob.objects.create(requested_by=request.user, kind=kind, survey=survey, params=params or {})
+        if responses is not None:
+            job.select_responses(responses)
+    transaction.on_commit(partial(run_export_job.delay, job.pk))
+    return job
+
+
+def export_job_link(job):
+    url = reverse('admin:surveys_exportjob_change', args=[job.pk])
+    return format_html('Export #{} queued - <a href="{}">follow its progress</a>.', job.pk, url)
+
+
 class MatrixColumnInlineForm(forms.ModelForm):
     class Meta:
         model = MatrixColumn
@@ -87,9 +94,16 @@ class ChoiceInline(TabularInline):
     fk_name = 'question'  # 🔧 Tells Django which FK relates to the parent
     show_change_link = True
 
+    def get_queryset(self, request):
+        return with_derivatives(super().get_queryset(request), 'image', image_thumb=MediaDerivative.KIND_THUMB)
+
     def image_preview(self, obj):
         if obj.image:
-            return format_html('<img src="{}" style="max-height: 60px;"/>', obj.image.url)
+            thumb = getattr(obj, 'image_thumb', None)
+            return format_html(
+                '<img src="{}" style="max-height: 60px;" loading="lazy"/>',
+                blob_storage.url(thumb) if thumb else obj.image.url,
+            )
         return "-"
 
     image_preview.short_description = "Preview"
@@ -125,21 +139,33 @@ class SurveyAdmin(ModelAdmin):
     list_filter = ('is_active', 'created_at', 'groups')
     search_fields = ('title', 'description')
     ordering = ('-created_at',)
-    actions = ['send_notifications', 'send_reminders']
+    actions = ['send_notifications', 'send_reminders', 'export_wide_results']
     inlines = [QuestionInline]
 
     def send_notifications(self, request, queryset):
         for survey in queryset:
             send_survey_notification.delay(survey.id)
-        self.message_user(request, f"Notifications queued for {queryset.count()} survey(s).")
+        self.message_user(
+            request,
+            f"Notifications queued for {queryset.count()} survey(s); users already notified are skipped.",
+        )
     send_notifications.short_description = "Send notifications to assigned groups"
 
     def send_reminders(self, request, queryset):
         for survey in queryset:
             send_survey_reminder.delay(survey.id)
-        self.message_user(request, f"Reminders queued for {queryset.count()} survey(s).")
+        self.message_user(
+            request,
+            f"Reminders queued for {queryset.count()} survey(s); users reminded recently are skipped.",
+        )
     send_reminders.short_description = "Send reminder to users who haven't submitted"
 
+    def export_wide_results(self, request, queryset):
+        for survey in queryset:
+            job = queue_export_job(request, ExportJob.KIND_SURVEY_WIDE, survey=survey)
+            self.message_user(request, export_job_link(job))
+    export_wide_results.short_description = "Export results (one row per submission) in the background"
+
     def get_urls(self):
         print("🔧 Custom admin URLs loaded for SurveyAdmin")
         urls = super().get_urls()
@@ -486,12 +512,25 @@ class ResponseAdmin(ModelAdmin):
     ordering = ('-submitted_at',)
     readonly_fields = ('submitted_at', 'media_preview')
 
-    actions = ['export_as_csv', 'download_media_zip']
+    actions = ['export_as_csv', 'download_media_zip', 'export_csv_in_background', 'media_zip_in_background']
+    actions_list = ['export_filtered_csv', 'export_filtered_csv_in_background']
+
+    def get_queryset(self, request):
+        # thumbnail / poster names for media_preview, in the changelist query itself
+        return with_derivatives(super().get_queryset(request), 'media_upload', media_thumb=MediaDerivative.KIND_THUMB)
 
     def media_preview(self, obj):
         if obj.media_upload:
             url = obj.media_upload.url
             name = obj.media_upload.name.lower()
+            thumb = getattr(obj, 'media_thumb', None)
+            if thumb:
+                # a few KB thumbnail (video: its poster frame) linking to the original
+                return format_html(
+                    '<a href="{}" target="_blank"><img src="{}" width="100" loading="lazy" /></a>',
+                    url,
+                    blob_storage.url(thumb),
+                )
             if name.endswith(('.jpg', '.jpeg', '.png', '.gif')):
                 return format_html(f'<img src="{url}" width="100" />')
             elif name.endswith(('.mp4', '.mov', '.webm')):
@@ -507,70 +546,58 @@ class ResponseAdmin(ModelAdmin):
 
     media_preview.short_description = "Media"
 
+    def _csv_response(self, queryset):
+        return StreamingHttpResponse(
+            stream_responses_csv(queryset),
+            content_type='text/csv',
+            headers={'Content-Disposition': 'attachment; filename="responses.csv"'},
+        )
+
     def export_as_csv(self, request, queryset):
-        meta = self.model._meta
-        field_names = ['user', 'survey', 'question', 'choice', 'text_answer', 'submitted_at']
-
-        response = HttpResponse(content_type='text/csv')
-        response['Content-Disposition'] = f'attachment; filename=responses.csv'
-        writer = csv.writer(response)
-
-        writer.writerow(field_names)
-        for obj in queryset:
-            writer.writerow([
-                obj.user.username,
-                obj.survey.title,
-                obj.question.text,
-                obj.choice.text if obj.choice else '',
-                obj.text_answer,
-                obj.submitted_at,
-            ])
-        return response
+        return self._csv_response(queryset)
 
     export_as_csv.short_description = "Export selected responses as CSV"
 
+    def export_csv_in_background(self, request, queryset):
+        job = queue_export_job(request, ExportJob.KIND_RESPONSES_CSV, responses=queryset)
+        self.message_user(request, export_job_link(job))
+
+    export_csv_in_background.short_description = "Export selected responses as CSV in the background"
+
+    def media_zip_in_background(self, request, queryset):
+        job = queue_export_job(request, ExportJob.KIND_MEDIA_ZIP, responses=queryset)
+        self.message_user(request, export_job_link(job))
+
+    media_zip_in_background.short_description = "Build media + metadata ZIP of selected responses in the background"
+
+    def changelist_view(self, request, extra_context=None):
+        response = super().changelist_view(request, extra_context)
+        # the export buttons get the changelist's querystring, so they export
+        # what it shows (filters, search, ordering)
+        context = getattr(response, 'context_data', None)
+        if context and 'cl' in context:
+            query = context['cl'].get_query_string()
+            for item in context.get('actions_list') or []:
+                if item.get('path'):
+                    item['path'] += query
+        return response
+
+    def _filtered_queryset(self, request):
+        changelist = self.get_changelist_instance(request)
+        return changelist.get_queryset(request)
+
+    @action(description="Export filtered responses as CSV", url_path="export-csv", icon="download", permissions=["view"])
+    def export_filtered_csv(self, request):
+        return self._csv_response(self._filtered_queryset(request))
+
+    @action(description="Export filtered responses in the background", url_path="export-csv-job", icon="schedule", permissions=["view"])
+    def export_filtered_csv_in_background(self, request):
+        job = queue_export_job(request, ExportJob.KIND_RESPONSES_CSV, responses=self._filtered_queryset(request))
+        return redirect('admin:surveys_exportjob_change', job.pk)
+
     def download_media_zip(self, request, queryset):
-        zip_buffer = BytesIO()
-        zip_file = zipfile.ZipFile(zip_buffer, 'w')
-
-        # Prepare CSV metadata
-        csv_text_io = StringIO()
-        csv_writer = csv.writer(csv_text_io)
-        csv_writer.writerow(['User', 'Survey', 'Question', 'Filename', 'Timestamp', 'Media URL'])
-
-        for response in queryset:
-            if response.media_upload:
-                try:
-                    path = response.media_upload.path
-                    filename = os.path.basename(path)
-                    url = response.media_upload.url
-
-                    # Clean folder name using slugified question text
-                    question_folder = slugify(response.question.text[:50])
-                    zip_path = f"{question_folder}/{response.user.username}_{slugify(filename)}"
-
-                    # Add file to ZIP under question folder
-                    zip_file.write(path, arcname=zip_path)
-
-                    # Add metadata row
-                    csv_writer.writerow([
-                        response.user.username,
-                        response.survey.title,
-                        response.question.text,
-                        filename,
-                        response.submitted_at,
-                        url
-                    ])
-                except FileNotFoundError:
-                    continue  # skip missing file
-
-        # Add metadata CSV at root of ZIP
-        zip_file.writestr("metadata.csv", csv_text_io.getvalue())
-        zip_file.close()
-        zip_buffer.seek(0)
-
-        return HttpResponse(
-            zip_buffer.getvalue(),
+        return StreamingHttpResponse(
+            MediaZipStream(queryset),
             content_type='application/zip',
             headers={'Content-Disposition': 'attachment; filename="media_responses_by_question.zip"'},
         )
@@ -585,6 +612,31 @@ class SubmissionAdmin(ModelAdmin):
     search_fields = ('user__username', 'survey__title')
 
 
+@admin.register(SurveyRun)
+class SurveyRunAdmin(ModelAdmin):
+    list_display = ('user', 'survey', 'status', 'answered_count', 'last_question', 'started_at', 'updated_at')
+    list_filter = ('status', 'survey', 'started_at')
+    search_fields = ('user__username', 'survey__title')
+    list_select_related = ('user', 'survey', 'last_question')
+    raw_id_fields = ('user', 'survey', 'last_question')
+
+
+@admin.register(OutboxEvent)
+class OutboxEventAdmin(ModelAdmin):
+    list_display = ('submission', 'kind', 'attempts', 'created_at', 'processed_at')
+    list_filter = ('kind', 'processed_at', 'created_at')
+    search_fields = ('submission__user__username', 'submission__survey__title', 'last_error')
+    raw_id_fields = ('submission',)
+    actions = ['requeue']
+
+    def requeue(self, request, queryset):
+        ids = list(queryset.filter(processed_at__isnull=True).values_list('id', flat=True))
+        for event_id in ids:
+            process_outbox_event.delay(event_id)
+        self.message_user(request, f"Requeued {len(ids)} pending event(s).")
+    requeue.short_description = "Requeue selected pending events"
+
+
 @admin.register(SbsCellRouting)
 class SbsCellRoutingAdmin(ModelAdmin):
     list_display = ('question', 'group_slug', 'row', 'col', 'next_question')
@@ -609,3 +661,189 @@ class AnswerFactAdmin(ModelAdmin):
     list_filter = ('survey', 'question_type', 'analysis_level', 'submitted_at')
     search_fields = ('analytics_key', 'analytics_label', 'question_text', 'choice_text', 'answer_text')
     ordering = ('-submitted_at',)
+
+    def get_urls(self):
+        urls = super().get_urls()
+        custom_urls = [
+            path('crosstab/', self.admin_site.admin_view(self.crosstab_view),
+                 name='surveys_answerfact_crosstab'),
+        ]
+        return custom_urls + urls
+
+    def crosstab_view(self, request):
+        form = CrosstabForm(request.GET or None)
+        table = None
+        if form.is_valid():
+            data = form.cleaned_data
+            weights = (data['weight_by'], data['weights']) if data['weight_by'] and data['weights'] else None
+            try:
+                result = crosstab(
+                    data['survey'],
+                    data['row_key'],
+                    data['columns'],
+                    filters={'gender': data['gender'], 'age_range': data['age_range']},
+                    weights=weights,
+                )
+            except CrosstabError as exc:
+                form.add_error(None, str(exc))
+            else:
+                table = crosstab_table(result, 'weighted' if weights else 'count')
+
+        return render(request, 'admin/surveys/crosstab.html', {
+            **self.admin_site.each_context(request),
+            'form': form,
+            'table': table,
+            'title': 'Crosstab',
+        })
+
+
+@admin.register(AnswerAggregate)
+class AnswerAggregateAdmin(ModelAdmin):
+    list_display = (
+        'survey',
+        'analytics_key',
+        'bucket',
+        'bucket_label',
+        'count',
+        'respondents',
+        'numeric_count',
+        'value_min',
+        'value_max',
+        'updated_at',
+    )
+    list_filter = ('survey',)
+    search_fields = ('analytics_key', 'bucket_label')
+    actions = ['recompute']
+
+    def recompute(self, request, queryset):
+        pairs = queryset.order_by().values_list('survey_id', 'analytics_key').distinct()
+        keys = {}
+        for survey_id, key in pairs:
+            keys.setdefault(survey_id, set()).add(key)
+        for survey_id, survey_keys in keys.items():
+            recompute_answer_aggregates(survey_id, survey_keys)
+        self.message_user(request, f"Recomputed aggregates for {sum(len(k) for k in keys.values())} key(s).")
+    recompute.short_description = "Recompute selected keys from answer facts"
+
+
+@admin.register(MediaDerivative)
+class MediaDerivativeAdmin(ModelAdmin):
+    list_display = ('source', 'kind', 'name', 'width', 'height', 'size', 'error', 'created_at')
+    list_filter = ('kind',)
+    search_fields = ('source', 'name')
+    readonly_fields = ('source', 'kind', 'name', 'width', 'height', 'size', 'error', 'created_at')
+    actions = ['regenerate']
+
+    def has_add_permission(self, request):
+        return False
+
+    def regenerate(self, request, queryset):
+        sources = list(queryset.order_by().values_list('source', flat=True).distinct())
+        for source in sources:
+            generate_media_derivatives.delay(source, force=True)
+        self.message_user(request, f"Queued derivatives of {len(sources)} file(s).")
+    regenerate.short_description = "Render the selected files' derivatives again"
+
+
+@admin.register(MediaBlob)
+class MediaBlobAdmin(ModelAdmin):
+    list_display = ('name', 'size', 'refcount', 'created_at', 'updated_at')
+    search_fields = ('name',)
+    readonly_fields = ('name', 'size', 'refcount', 'created_at', 'updated_at')
+    actions = ['recount']
+
+    def has_add_permission(self, request):
+        return False
+
+    def recount(self, request, queryset):
+        changed = recount_media_blobs()
+        self.message_user(request, f"Reset {len(changed)} blob refcount(s) from the stored rows.")
+    recount.short_description = "Recount references of all blobs"
+
+
+@admin.register(ExportJob)
+class ExportJobAdmin(ModelAdmin):
+    list_display = (
+        'id',
+        'kind',
+        'status',
+        'requested_by',
+        'progress_display',
+        'processed_rows',
+        'size_bytes',
+        'elapsed',
+        'created_at',
+        'download_link',
+    )
+    list_filter = ('kind', 'status', 'created_at')
+    search_fields = ('requested_by__username', 'survey__title', 'error')
+    # the file widget would link to a media URL; downloads go through download_view
+    exclude = ('file', 'responses')
+    readonly_fields = (
+        'requested_by', 'kind', 'status', 'survey', 'params', 'progress_display',
+        'total_rows', 'processed_rows', 'size_bytes', 'elapsed', 'error',
+        'created_at', 'started_at', 'finished_at', 'download_link',
+    )
+
+    def has_add_permission(self, request):
+        return False
+
+    def get_urls(self):
+        urls = super().get_urls()
+        custom_urls = [
+            path('<int:job_id>/progress/', self.admin_site.admin_view(self.progress_view),
+                 name='surveys_exportjob_progress'),
+            path('<int:job_id>/download/', self.admin_site.admin_view(self.download_view),
+                 name='surveys_exportjob_download'),
+        ]
+        return custom_urls + urls
+
+    def progress_view(self, request, job_id):
+        job = get_object_or_404(ExportJob, pk=job_id)
+        if not self.has_view_permission(request, job):
+            raise PermissionDenied
+        return JsonResponse({
+            'status': job.status,
+            'processed_rows': job.processed_rows,
+            'total_rows': job.total_rows,
+            'progress': job.progress,
+            'url': reverse('admin:surveys_exportjob_download', args=[job.pk]) if job.file else None,
+        })
+
+    def download_view(self, request, job_id):
+        """Exports hold respondent data: only staff allowed to view the job get the file."""
+        job = get_object_or_404(ExportJob, pk=job_id)
+        if not self.has_view_permission(request, job):
+            raise PermissionDenied
+        if not job.file or not job.file.storage.exists(job.file.name):
+            raise Http404("The export file is not available.")
+        ext = os.path.splitext(job.file.name)[1]
+        return FileResponse(job.file.open('rb'), as_attachment=True, filename=f"{job.kind}-{job.pk}{ext}")
+
+    def progress_display(self, obj):
+        if obj.status in (ExportJob.STATUS_DONE, ExportJob.STATUS_FAILED):
+            return obj.get_status_display()
+        url = reverse('admin:surveys_exportjob_progress', args=[obj.pk])
+        # polls the progress endpoint and reloads once the job has finished
+        return format_html(
+            '<progress id="export-{id}" max="100" value="{value}"></progress> '
+            '<span id="export-{id}-text">{text}</span>'
+            '<script>(function(){{'
+            'var timer=setInterval(function(){{fetch("{url}").then(function(r){{return r.json();}}).then(function(d){{'
+            'var bar=document.getElementById("export-{id}");'
+            'if(d.progress!==null){{bar.value=d.progress;}}'
+            'document.getElementById("export-{id}-text").textContent=d.processed_rows+" / "+(d.total_rows||"?");'
+            'if(d.status==="done"||d.status==="failed"){{clearInterval(timer);location.reload();}}'
+            '}});}},2000);}})();</script>',
+            id=obj.pk,
+            value=obj.progress or 0,
+            text=f"{obj.processed_rows} / {obj.total_rows or '?'}",
+            url=url,
+        )
+    progress_display.short_description = 'Progress'
+
+    def download_link(self, obj):
+        if not obj.file:
+            return '-'
+        return format_html('<a href="{}">Download</a>', reverse('admin:surveys_exportjob_download', args=[obj.pk]))
+    download_link.short_description = 'File'
@@ -0,0 +1,269 @@
+import math
+
+from django.db import transaction
+from django.utils import timezone
+
+from .models import AnswerAggregate, AnswerFact, Survey
+
+# bucket of the overall row of an analytics_key
+OVERALL_BUCKET = ''
+# numeric histograms keep at most this many floor(value) bins; the rest land in "other"
+HISTOGRAM_MAX_BINS = 200
+AGGREGATE_BATCH_SIZE = 500
+
+AGGREGATE_FACT_FIELDS = (
+    'submission_id',
+    'survey_id',
+    'analytics_key',
+    'choice_id',
+    'choice_text',
+    'matrix_column_id',
+    'matrix_column_label',
+    'answer_boolean',
+    'answer_number',
+)
+
+AGGREGATE_VALUE_FIELDS = [
+    'bucket_label', 'count', 'respondents', 'numeric_count', 'value_sum',
+    'value_sum_sq', 'value_min', 'value_max', 'histogram', 'updated_at',
+]
+
+
+def fact_bucket(choice_id, choice_text, column_id, column_label, boolean):
+    """(bucket, label) of the category a fact falls in, or (None, '') for none."""
+    if choice_id:
+        return f"choice:{choice_id}", choice_text
+    if column_id:
+        return f"col:{column_id}", column_label
+    if boolean is not None:
+        return ("bool:yes", "Yes") if boolean else ("bool:no", "No")
+    return None, ''
+
+
+def _bump_histogram(histogram, number, n=1):
+    key = number if number == 'other' else str(math.floor(number))
+    if key not in histogram and len(histogram) >= HISTOGRAM_MAX_BINS:
+        key = 'other'
+    histogram[key] = histogram.get(key, 0) + n
+
+
+class _Tally:
+    """Running count / moments / histogram for one (survey, key, bucket)."""
+
+    __slots__ = (
+        'label', 'count', 'respondents', 'numeric_count', 'value_sum',
+        'value_sum_sq', 'value_min', 'value_max', 'histogram', 'last_submission',
+    )
+
+    def __init__(self, label=''):
+        self.label = label
+        self.count = 0
+        self.respondents = 0
+        self.numeric_count = 0
+        self.value_sum = 0.0
+        self.value_sum_sq = 0.0
+        self.value_min = None
+        self.value_max = None
+        self.histogram = {}
+        self.last_submission = None
+
+    def add(self, submission_id, number):
+        self.count += 1
+        # facts arrive grouped by submission, so a change of id is a new respondent
+        if submission_id != self.last_submission:
+            self.respondents += 1
+            self.last_submission = submission_id
+        if number is None:
+            return
+        self.numeric_count += 1
+        self.value_sum += number
+        self.value_sum_sq += number * number
+        self.value_min = number if self.value_min is None else min(self.value_min, number)
+        self.value_max = number if self.value_max is None else max(self.value_max, number)
+        _bump_histogram(self.histogram, number)
+
+    def merge_into(self, agg):
+        agg.bucket_label = self.label or agg.bucket_label
+        agg.count += self.count
+        agg.respondents += self.respondents
+        agg.numeric_count += self.numeric_count
+        agg.value_sum += self.value_sum
+        agg.value_sum_sq += self.value_sum_sq
+        if self.value_min is not None:
+            agg.value_min = self.value_min if agg.value_min is None else min(agg.value_min, self.value_min)
+            agg.value_max = self.value_max if agg.value_max is None else max(agg.value_max, self.value_max)
+        histogram = dict(agg.histogram or {})
+        for key, n in self.histogram.items():
+            _bump_histogram(histogram, key if key == 'other' else float(key), n)
+        agg.histogram = histogram
+
+
+def tally_facts(rows):
+    """
+    Fold AGGREGATE_FACT_FIELDS tuples (ordered by submission) into
+    {(survey_id, analytics_key, bucket): _Tally}.
+    """
+    tallies = {}
+    for sub_id, survey_id, key, choice_id, choice_text, col_id, col_label, boolean, number in rows:
+        overall = tallies.get((survey_id, key, OVERALL_BUCKET))
+        if overall is None:
+            overall = tallies[(survey_id, key, OVERALL_BUCKET)] = _Tally()
+        overall.add(sub_id, number)
+
+        bucket, label = fact_bucket(choice_id, choice_text, col_id, col_label, boolean)
+        if bucket is None:
+            continue
+        tally = tallies.get((survey_id, key, bucket))
+        if tally is None:
+            tally = tallies[(survey_id, key, bucket)] = _Tally(label)
+        tally.add(sub_id, number)
+    return tallies
+
+
+def _fact_rows(facts):
+    facts = sorted(facts, key=lambda f: f.submission_id)
+    return (tuple(getattr(f, name) for name in AGGREGATE_FACT_FIELDS) for f in facts)
+
+
+def lock_surveys(survey_ids):
+    """
+    Lock the Survey rows of survey_ids (in id order) until the transaction
+    ends. Every writer of a survey's aggregates takes this lock first, so an
+    incremental update and a recompute of the same survey never interleave.
+    """
+    list(Survey.objects.select_for_update().filter(pk__in=survey_ids).order_by('pk').values_list('pk', flat=True))
+
+
+def apply_answer_facts(facts):
+    """
+    Add freshly inserted AnswerFact rows to their aggregates.
+
+    The surveys are locked first (lock_surveys), missing rows are created
+    with ignore_conflicts and every touched row is updated in one
+    bulk_update, so concurrent builders serialize per survey instead of
+    losing increments. Must only be given facts of submissions that had no
+    facts before (see build_answer_facts).
+    """
+    tallies = tally_facts(_fact_rows(facts))
+    if not tallies:
+        return
+
+    with transaction.atomic():
+        lock_surveys({survey_id for survey_id, _, _ in tallies})
+        AnswerAggregate.objects.bulk_create(
+            [
+                AnswerAggregate(survey_id=survey_id, analytics_key=key, bucket=bucket, bucket_label=t.label)
+                for (survey_id, key, bucket), t in tallies.items()
+            ],
+            batch_size=AGGREGATE_BATCH_SIZE,
+            ignore_conflicts=True,
+        )
+
+        locked = (
+            AnswerAggregate.objects
+            .select_for_update()
+            .filter(
+                survey_id__in={survey_id for survey_id, _, _ in tallies},
+                analytics_key__in={key for _, key, _ in tallies},
+            )
+            .order_by('id')
+        )
+        now = timezone.now()
+        changed = []
+        for agg in locked:
+            tally = tallies.get((agg.survey_id, agg.analytics_key, agg.bucket))
+            if tally is None:
+                continue
+            tally.merge_into(agg)
+            agg.updated_at = now
+            changed.append(agg)
+
+        AnswerAggregate.objects.bulk_update(changed, AGGREGATE_VALUE_FIELDS, batch_size=AGGREGATE_BATCH_SIZE)
+
+
+def recompute_answer_aggregates(survey_id, analytics_keys=None):
+    """
+    Rebuild the aggregates of one survey (optionally only some keys) from its
+    AnswerFact rows. Used after facts were replaced, where increments cannot
+    be undone (min / max / respondents).
+    """
+    facts = AnswerFact.objects.filter(survey_id=survey_id)
+    stale = AnswerAggregate.objects.filter(survey_id=survey_id)
+    if analytics_keys is not None:
+        analytics_keys = list(analytics_keys)
+        if not analytics_keys:
+            return 0
+        facts = facts.filter(analytics_key__in=analytics_keys)
+        stale = stale.filter(analytics_key__in=analytics_keys)
+
+    with transaction.atomic():
+        # taken before reading the facts: a builder that commits facts of
+        # this survey first is counted here, one that commits after us
+        # waits and applies its facts on top of the rebuilt rows
+        lock_surveys([survey_id])
+
+        rows = facts.order_by('submission_id').values_list(*AGGREGATE_FACT_FIELDS).iterator(chunk_size=5000)
+        tallies = tally_facts(rows)
+
+        stale.delete()
+        aggregates = []
+        for (sid, key, bucket), tally in tallies.items():
+            agg = AnswerAggregate(survey_id=sid, analytics_key=key, bucket=bucket)
+            tally.merge_into(agg)
+            aggregates.append(agg)
+        AnswerAggregate.objects.bulk_create(aggregates, batch_size=AGGREGATE_BATCH_SIZE)
+
+    return len(aggregates)
+
+
+def answer_summary(survey, analytics_key=None):
+    """
+    Frequencies, mean, standard deviation, min, max and histogram per
+    analytics_key, read from AnswerAggregate in one indexed query:
+
+        {key: {"count", "respondents", "mean", "std", "min", "max",
+               "histogram", "frequencies": [{"bucket", "label", "count", "share"}]}}
+
+    "share" is the fraction of the key's respondents in that bucket.
+    """
+    qs = AnswerAggregate.objects.filter(survey=survey)
+    if analytics_key is not None:
+        qs = qs.filter(analytics_key=analytics_key)
+
+    summary = {}
+    for agg in qs.order_by('analytics_key', 'bucket'):
+        entry = summary.setdefault(agg.analytics_key, {
+            'count': 0,
+            'respondents': 0,
+            'mean': None,
+            'std': None,
+            'min': None,
+            'max': None,
+            'histogram': {},
+            'frequencies': [],
+        })
+        if agg.bucket != OVERALL_BUCKET:
+            entry['frequencies'].append({'bucket': agg.bucket, 'label': agg.bucket_label, 'count': agg.count})
+            continue
+
+        entry.update(
+            count=agg.count,
+            respondents=agg.respondents,
+            min=agg.value_min,
+            max=agg.value_max,
+            histogram=agg.histogram,
+        )
+        n = agg.numeric_count
+        if n:
+            entry['mean'] = agg.value_sum / n
+        if n > 1:
+            # sample standard deviation
+            variance = (agg.value_sum_sq - agg.value_sum * agg.value_sum / n) / (n - 1)
+            entry['std'] = math.sqrt(max(variance, 0.0))
+
+    for entry in summary.values():
+        base = entry['respondents']
+        for freq in entry['frequencies']:
+            freq['share'] = freq['count'] / base if base else None
+
+    return summary
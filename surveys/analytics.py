@@ -1,66 +1,152 @@
-from .models import AnswerFact, Response
+import mimetypes
+import os
+from collections import namedtuple
+from functools import partial
+
+from django.db import transaction
+from django.utils.dateparse import parse_date
+from .models import AnswerFact, Response, Question, Choice, MatrixRow, MatrixColumn
+from .aggregates import apply_answer_facts, recompute_answer_aggregates
+from .crosstab import bump_facts_version
 from django.utils.text import slugify
 
 
-SIMPLE_CHOICE_TYPES = {'SINGLE_CHOICE', 'MULTI_CHOICE', 'DROPDOWN', 'RATING'}
-
-
-def _base_fact_kwargs(response):
-    question = response.question
+SIMPLE_CHOICE_TYPES = {'SINGLE_CHOICE', 'MULTI_CHOICE', 'DROPDOWN', 'RATING', 'IMAGE_CHOICE'}
+MEDIA_TYPES = {'PHOTO_UPLOAD', 'PHOTO_MULTI_UPLOAD', 'VIDEO_UPLOAD', 'AUDIO_UPLOAD'}
+FACT_BATCH_SIZE = 500
+
+# Only the Response columns the fact builders read; rows stream as named tuples
+RESPONSE_FIELDS = (
+    'id',
+    'submission_id',
+    'user_id',
+    'survey_id',
+    'question_id',
+    'choice_id',
+    'matrix_row_id',
+    'matrix_column_id',
+    'text_answer',
+    'value',
+    'group_label',
+    'media_upload',
+    'latitude',
+    'longitude',
+    'submitted_at',
+)
+
+QuestionSnapshot = namedtuple('QuestionSnapshot', 'id code text question_type matrix_mode base')
+
+
+class FactSnapshot:
+    """
+    Reporting labels (question code/text/type, choice texts, matrix row and
+    column labels) for every survey a build touches, loaded once per survey
+    with a handful of values_list() queries.
+    """
 
+    def __init__(self):
+        self.questions = {}
+        self.choices = {}
+        self.rows = {}
+        self.columns = {}
+        self._surveys = set()
+
+    def load_survey(self, survey_id):
+        if survey_id in self._surveys:
+            return
+        self._surveys.add(survey_id)
+
+        for qid, code, text, qtype, mode in (
+            Question.objects
+            .filter(survey_id=survey_id)
+            .values_list('id', 'code', 'text', 'question_type', 'matrix_mode')
+        ):
+            self.questions[qid] = QuestionSnapshot(qid, code or '', text, qtype, mode, _question_base(qid, code, text, qtype))
+
+        self.choices.update(Choice.objects.filter(question__survey_id=survey_id).values_list('id', 'text'))
+        self.rows.update(MatrixRow.objects.filter(question__survey_id=survey_id).values_list('id', 'text'))
+        self.columns.update(MatrixColumn.objects.filter(question__survey_id=survey_id).values_list('id', 'label'))
+
+    def question(self, question_id, survey_id):
+        q = self.questions.get(question_id)
+        if q is None:
+            self.load_survey(survey_id)
+            q = self.questions.get(question_id)
+        if q is None:
+            # answer to a question routed in from another survey
+            other = Question.objects.filter(pk=question_id).values_list('survey_id', flat=True).first()
+            if other is not None:
+                self.load_survey(other)
+                q = self.questions.get(question_id)
+        return q
+
+
+def _question_base(question_id, code, text, question_type):
+    """Fact fields that are the same for every answer to one question."""
     return {
-        'submission': response.submission,
-        'response': response,
-        'user': response.user,
-        'survey': response.survey,
-        'question': question,
-        'question_code': question.code or '',
-        'question_text': question.text,
-        'question_type': question.question_type,
-        'analytics_key': f'Q{question.id}',
-        'analytics_label': question.text,
+        'question_id': question_id,
+        'question_code': code or '',
+        'question_text': text,
+        'question_type': question_type,
+        'analytics_key': f'Q{question_id}',
+        'analytics_label': text,
         'parent_analytics_key': '',
         'analysis_level': 'question',
-        'matrix_row': None,
+        'matrix_row_id': None,
         'matrix_row_text': '',
-        'matrix_column': None,
+        'matrix_column_id': None,
         'matrix_column_label': '',
         'group_label': None,
-        'choice': None,
+        'choice_id': None,
         'choice_text': '',
         'answer_text': '',
         'answer_number': None,
         'answer_boolean': None,
-        'submitted_at': response.submitted_at,
+        'answer_date': None,
+        'latitude': None,
+        'longitude': None,
+        'media_path': '',
+        'media_content_type': '',
+        'media_size': None,
     }
 
 
-def _fact_for_choice_response(response):
-    data = _base_fact_kwargs(response)
+def _base_fact_kwargs(r, q):
+    data = dict(q.base)
+    data['submission_id'] = r.submission_id
+    data['response_id'] = r.id
+    data['user_id'] = r.user_id
+    data['survey_id'] = r.survey_id
+    data['submitted_at'] = r.submitted_at
+    return data
+
+
+def _fact_for_choice_response(r, q, snap):
+    data = _base_fact_kwargs(r, q)
 
-    if response.choice_id:
-        data['choice'] = response.choice
-        data['choice_text'] = response.choice.text
+    if r.choice_id:
+        data['choice_id'] = r.choice_id
+        data['choice_text'] = snap.choices.get(r.choice_id, '')
 
-    if response.text_answer:
-        data['answer_text'] = response.text_answer
-    elif response.choice_id:
-        data['answer_text'] = response.choice.text
+    if r.text_answer:
+        data['answer_text'] = r.text_answer
+    elif r.choice_id:
+        data['answer_text'] = data['choice_text']
 
-    if response.value is not None:
-        data['answer_number'] = response.value
+    if r.value is not None:
+        data['answer_number'] = r.value
 
     return AnswerFact(**data)
 
 
-def _fact_for_yesno_response(response):
-    data = _base_fact_kwargs(response)
+def _fact_for_yesno_response(r, q, snap):
+    data = _base_fact_kwargs(r, q)
 
-    raw = (response.text_answer or '').strip().lower()
+    raw = (r.text_answer or '').strip().lower()
     data['answer_text'] = raw
 
-    if response.value is not None:
-        data['answer_number'] = response.value
+    if r.value is not None:
+        data['answer_number'] = r.value
 
     if raw == 'yes':
         data['answer_boolean'] = True
@@ -70,93 +156,66 @@ def _fact_for_yesno_response(response):
     return AnswerFact(**data)
 
 
-def _fact_for_numeric_response(response):
-    data = _base_fact_kwargs(response)
+def _fact_for_numeric_response(r, q, snap):
+    data = _base_fact_kwargs(r, q)
 
-    if response.text_answer:
-        data['answer_text'] = response.text_answer
+    if r.text_answer:
+        data['answer_text'] = r.text_answer
 
-    if response.value is not None:
-        data['answer_number'] = response.value
+    if r.value is not None:
+        data['answer_number'] = r.value
 
     return AnswerFact(**data)
 
 
-def _fact_for_text_response(response):
-    data = _base_fact_kwargs(response)
-    data['answer_text'] = response.text_answer or ''
+def _fact_for_text_response(r, q, snap):
+    data = _base_fact_kwargs(r, q)
+    data['answer_text'] = r.text_answer or ''
     return AnswerFact(**data)
 
 
-def build_submission_answer_facts(submission):
-    """
-    Build normalized analytics rows for a completed submission.
-
-    Step 4 scope:
-    - SINGLE_CHOICE
-    - MULTI_CHOICE
-    - DROPDOWN
-    - RATING
-    - YESNO
-    - NUMBER
-    - SLIDER
-    - TEXT
-
-    Matrix / SBS / image rating / media / geo come later.
-    """
-    responses = (
-        Response.objects
-        .filter(submission=submission)
-        .select_related('survey', 'question', 'choice', 'user', 'submission')
-        .order_by('id')
-    )
-
-    # rebuild safely for this submission
-    AnswerFact.objects.filter(submission=submission).delete()
-
-    facts = []
-
-    for response in responses:
-        qtype = response.question.question_type
-
-        if qtype in SIMPLE_CHOICE_TYPES:
-            facts.append(_fact_for_choice_response(response))
-
-        elif qtype == 'YESNO':
-            facts.append(_fact_for_yesno_response(response))
-
-        elif qtype in {'NUMBER', 'SLIDER'}:
-            facts.append(_fact_for_numeric_response(response))
+def _fact_for_date_response(r, q, snap):
+    data = _base_fact_kwargs(r, q)
+    raw = (r.text_answer or '').strip()
+    data['answer_text'] = raw
+    try:
+        data['answer_date'] = parse_date(raw) if raw else None
+    except ValueError:
+        data['answer_date'] = None  # well-formed but impossible date
+    return AnswerFact(**data)
 
-        elif qtype == 'TEXT':
-            facts.append(_fact_for_text_response(response))
 
-        elif qtype == 'MATRIX':
-            if response.question.matrix_mode == 'side_by_side':
-                fact = _fact_for_sbs_response(response)
-                if fact:
-                    facts.append(fact)
-            else:
-                fact = _fact_for_matrix_row_response(response)
-                if fact:
-                    facts.append(fact)
+def _fact_for_geo_response(r, q, snap):
+    if r.latitude is None or r.longitude is None:
+        return None
+    data = _base_fact_kwargs(r, q)
+    data['latitude'] = r.latitude
+    data['longitude'] = r.longitude
+    data['answer_text'] = f'{r.latitude},{r.longitude}'
+    return AnswerFact(**data)
 
-        elif qtype == 'IMAGE_RATING':
-            fact = _fact_for_image_rating_response(response)
-            if fact:
-                facts.append(fact)
 
-        else:
-            # not handled yet
-            continue
+def _media_size(name):
+    try:
+        # the field's own storage (blob_storage), wherever that points
+        return Response._meta.get_field('media_upload').storage.size(name)
+    except (OSError, NotImplementedError):
+        return None  # file gone or backend cannot tell
 
-    if facts:
-        AnswerFact.objects.bulk_create(facts, batch_size=500)
 
-    return len(facts)
+def _fact_for_media_response(r, q, snap):
+    """One fact per uploaded file: storage path, guessed content type and size."""
+    if not r.media_upload:
+        return None
+    data = _base_fact_kwargs(r, q)
+    data['answer_text'] = os.path.basename(r.media_upload)
+    data['media_path'] = r.media_upload
+    data['media_content_type'] = mimetypes.guess_type(r.media_upload)[0] or ''
+    data['media_size'] = _media_size(r.media_upload)
+    return AnswerFact(**data)
 
 
-def _fact_for_matrix_row_response(response):
+def _fact_for_matrix_row_response(r, q, snap):
     """
     For MATRIX single/multi (non-SBS), each row is treated as a separate
     analytics question.
@@ -165,48 +224,32 @@ def _fact_for_matrix_row_response(response):
       analytics_key   = Q12__ROW_5
       analytics_label = Customer service — Staff friendliness
     """
-    question = response.question
-    row = response.matrix_row
-    col = response.matrix_column
-
-    if not row:
+    if not r.matrix_row_id:
         return None
 
-    data = {
-        'submission': response.submission,
-        'response': response,
-        'user': response.user,
-        'survey': response.survey,
-        'question': question,
-        'question_code': question.code or '',
-        'question_text': question.text,
-        'question_type': question.question_type,
-
-        'analytics_key': f'Q{question.id}__ROW_{row.id}',
-        'analytics_label': f'{question.text} — {row.text}',
-        'parent_analytics_key': f'Q{question.id}',
-        'analysis_level': 'matrix_row',
-
-        'matrix_row': row,
-        'matrix_row_text': row.text,
-        'matrix_column': col,
-        'matrix_column_label': col.label if col else '',
-        'group_label': None,
+    row_text = snap.rows.get(r.matrix_row_id, '')
+    col_label = snap.columns.get(r.matrix_column_id, '') if r.matrix_column_id else ''
 
-        'choice': None,
-        'choice_text': '',
+    data = _base_fact_kwargs(r, q)
+    data.update({
+        'analytics_key': f'Q{q.id}__ROW_{r.matrix_row_id}',
+        'analytics_label': f'{q.text} — {row_text}',
+        'parent_analytics_key': f'Q{q.id}',
+        'analysis_level': 'matrix_row',
 
-        'answer_text': response.text_answer or (col.label if col else ''),
-        'answer_number': response.value if response.value is not None else None,
-        'answer_boolean': None,
+        'matrix_row_id': r.matrix_row_id,
+        'matrix_row_text': row_text,
+        'matrix_column_id': r.matrix_column_id,
+        'matrix_column_label': col_label,
 
-        'submitted_at': response.submitted_at,
-    }
+        'answer_text': r.text_answer or col_label,
+        'answer_number': r.value,
+    })
 
     return AnswerFact(**data)
 
 
-def _fact_for_sbs_response(response):
+def _fact_for_sbs_response(r, q, snap):
     """
     For MATRIX side_by_side, each row+group is treated as a separate
     analytics question.
@@ -215,52 +258,37 @@ def _fact_for_sbs_response(response):
       analytics_key   = Q12__ROW_5__GROUP_importance
       analytics_label = Product feedback — Battery life — Importance
     """
-    question = response.question
-    row = response.matrix_row
-    col = response.matrix_column
-    raw_group = (response.group_label or '').strip()
-
-    if not row:
+    if not r.matrix_row_id:
         return None
 
+    raw_group = (r.group_label or '').strip()
     group_slug = slugify(raw_group or 'ungrouped')
     display_group = raw_group or 'Ungrouped'
 
-    data = {
-        'submission': response.submission,
-        'response': response,
-        'user': response.user,
-        'survey': response.survey,
-        'question': question,
-        'question_code': question.code or '',
-        'question_text': question.text,
-        'question_type': question.question_type,
-
-        'analytics_key': f'Q{question.id}__ROW_{row.id}__GROUP_{group_slug}',
-        'analytics_label': f'{question.text} — {row.text} — {display_group}',
-        'parent_analytics_key': f'Q{question.id}__ROW_{row.id}',
+    row_text = snap.rows.get(r.matrix_row_id, '')
+    col_label = snap.columns.get(r.matrix_column_id, '') if r.matrix_column_id else ''
+
+    data = _base_fact_kwargs(r, q)
+    data.update({
+        'analytics_key': f'Q{q.id}__ROW_{r.matrix_row_id}__GROUP_{group_slug}',
+        'analytics_label': f'{q.text} — {row_text} — {display_group}',
+        'parent_analytics_key': f'Q{q.id}__ROW_{r.matrix_row_id}',
         'analysis_level': 'sbs_row_group',
 
-        'matrix_row': row,
-        'matrix_row_text': row.text,
-        'matrix_column': col,
-        'matrix_column_label': col.label if col else '',
+        'matrix_row_id': r.matrix_row_id,
+        'matrix_row_text': row_text,
+        'matrix_column_id': r.matrix_column_id,
+        'matrix_column_label': col_label,
         'group_label': display_group,
 
-        'choice': None,
-        'choice_text': '',
-
-        'answer_text': response.text_answer or (col.label if col else ''),
-        'answer_number': response.value if response.value is not None else None,
-        'answer_boolean': None,
-
-        'submitted_at': response.submitted_at,
-    }
+        'answer_text': r.text_answer or col_label,
+        'answer_number': r.value,
+    })
 
     return AnswerFact(**data)
 
 
-def _fact_for_image_rating_response(response):
+def _fact_for_image_rating_response(r, q, snap):
     """
     For IMAGE_RATING, each image(choice) is treated as a separate
     analytics question.
@@ -269,50 +297,171 @@ def _fact_for_image_rating_response(response):
       analytics_key   = Q12__CHOICE_7
       analytics_label = Package design rating — Front label
     """
-    question = response.question
-    choice = response.choice
-
-    if not choice:
+    if not r.choice_id:
         return None
 
     rating_number = None
-    if response.value is not None:
-        rating_number = response.value
-    elif response.text_answer:
+    if r.value is not None:
+        rating_number = r.value
+    elif r.text_answer:
         try:
-            rating_number = float(response.text_answer)
+            rating_number = float(r.text_answer)
         except (TypeError, ValueError):
             rating_number = None
 
-    data = {
-        'submission': response.submission,
-        'response': response,
-        'user': response.user,
-        'survey': response.survey,
-        'question': question,
-        'question_code': question.code or '',
-        'question_text': question.text,
-        'question_type': question.question_type,
-
-        'analytics_key': f'Q{question.id}__CHOICE_{choice.id}',
-        'analytics_label': f'{question.text} — {choice.text}',
-        'parent_analytics_key': f'Q{question.id}',
-        'analysis_level': 'image_choice_rating',
+    choice_text = snap.choices.get(r.choice_id, '')
 
-        'matrix_row': None,
-        'matrix_row_text': '',
-        'matrix_column': None,
-        'matrix_column_label': '',
-        'group_label': None,
+    data = _base_fact_kwargs(r, q)
+    data.update({
+        'analytics_key': f'Q{q.id}__CHOICE_{r.choice_id}',
+        'analytics_label': f'{q.text} — {choice_text}',
+        'parent_analytics_key': f'Q{q.id}',
+        'analysis_level': 'image_choice_rating',
 
-        'choice': choice,
-        'choice_text': choice.text,
+        'choice_id': r.choice_id,
+        'choice_text': choice_text,
 
-        'answer_text': response.text_answer or '',
+        'answer_text': r.text_answer or '',
         'answer_number': rating_number,
-        'answer_boolean': None,
-
-        'submitted_at': response.submitted_at,
-    }
+    })
 
     return AnswerFact(**data)
+
+
+def _fact_for_response(r, q, snap):
+    """Dispatch one response row to its fact builder; None when the type has no facts yet."""
+    qtype = q.question_type
+
+    if qtype in SIMPLE_CHOICE_TYPES:
+        return _fact_for_choice_response(r, q, snap)
+
+    elif qtype == 'YESNO':
+        return _fact_for_yesno_response(r, q, snap)
+
+    elif qtype in {'NUMBER', 'SLIDER'}:
+        return _fact_for_numeric_response(r, q, snap)
+
+    elif qtype == 'TEXT':
+        return _fact_for_text_response(r, q, snap)
+
+    elif qtype == 'MATRIX':
+        if q.matrix_mode == 'side_by_side':
+            return _fact_for_sbs_response(r, q, snap)
+        return _fact_for_matrix_row_response(r, q, snap)
+
+    elif qtype == 'IMAGE_RATING':
+        return _fact_for_image_rating_response(r, q, snap)
+
+    elif qtype == 'DATE':
+        return _fact_for_date_response(r, q, snap)
+
+    elif qtype == 'GEOLOCATION':
+        return _fact_for_geo_response(r, q, snap)
+
+    elif qtype in MEDIA_TYPES:
+        return _fact_for_media_response(r, q, snap)
+
+    # unknown type
+    return None
+
+
+def iter_answer_facts(submission_ids, snapshot=None, chunk_size=FACT_BATCH_SIZE):
+    """
+    Stream unsaved AnswerFact instances for the given submissions.
+
+    Responses are read as plain value tuples through a server-side iterator and
+    labels come from the per-survey snapshot, so no Response/Question/Choice/
+    User/Submission model instances are built.
+    """
+    snap = snapshot or FactSnapshot()
+    rows = (
+        Response.objects
+        .filter(submission_id__in=submission_ids)
+        .order_by('submission_id', 'id')
+        .values_list(*RESPONSE_FIELDS, named=True)
+    )
+    for r in rows.iterator(chunk_size=chunk_size):
+        q = snap.question(r.question_id, r.survey_id)
+        if q is None:
+            continue
+        fact = _fact_for_response(r, q, snap)
+        if fact:
+            yield fact
+
+
+def build_answer_facts(submission_ids, batch_size=FACT_BATCH_SIZE, snapshot=None, aggregate=True):
+    """
+    Rebuild AnswerFact rows for a batch of submissions.
+
+    One DELETE for the whole batch, one streamed Response query and batched
+    INSERTs, all in a single transaction so readers never see a half-built
+    batch. Pass a FactSnapshot to reuse labels across batches. Returns the
+    number of facts written.
+
+    With aggregate=True, AnswerAggregate follows along: first-time facts are
+    added incrementally, replaced facts trigger a recompute of the keys they
+    touched. Bulk rebuilds pass aggregate=False and recompute once at the end.
+    Cached crosstabs of every touched survey are invalidated on commit.
+    """
+    submission_ids = list(submission_ids)
+    if not submission_ids:
+        return 0
+
+    written = 0
+    with transaction.atomic():
+        existing = AnswerFact.objects.filter(submission_id__in=submission_ids)
+        replaced = {}
+        if aggregate:
+            for survey_id, key in existing.order_by().values_list('survey_id', 'analytics_key').distinct():
+                replaced.setdefault(survey_id, set()).add(key)
+        existing.delete()
+
+        touched = set(replaced)
+        facts = []
+        created = []
+        for fact in iter_answer_facts(submission_ids, snapshot, batch_size):
+            touched.add(fact.survey_id)
+            facts.append(fact)
+            if len(facts) >= batch_size:
+                AnswerFact.objects.bulk_create(facts, batch_size=batch_size)
+                written += len(facts)
+                if aggregate:
+                    created.extend(facts)
+                facts = []
+        if facts:
+            AnswerFact.objects.bulk_create(facts, batch_size=batch_size)
+            written += len(facts)
+            if aggregate:
+                created.extend(facts)
+
+        if replaced:
+            for fact in created:
+                replaced.setdefault(fact.survey_id, set()).add(fact.analytics_key)
+            for survey_id, keys in replaced.items():
+                recompute_answer_aggregates(survey_id, keys)
+        elif created:
+            apply_answer_facts(created)
+
+        for survey_id in touched:
+            transaction.on_commit(partial(bump_facts_version, survey_id))
+
+    return written
+
+
+def build_submission_answer_facts(submission):
+    """
+    Build normalized analytics rows for a completed submission.
+
+    Covers every question type:
+    - SINGLE_CHOICE / MULTI_CHOICE / DROPDOWN / RATING / IMAGE_CHOICE
+    - YESNO
+    - NUMBER / SLIDER
+    - TEXT
+    - DATE (answer_date)
+    - GEOLOCATION (latitude / longitude)
+    - PHOTO / VIDEO / AUDIO uploads (media_path / media_content_type / media_size)
+    - MATRIX (single / multi / side-by-side)
+    - IMAGE_RATING
+    """
+    # rebuild safely for this submission
+    return build_answer_facts([submission.pk])
@@ -0,0 +1,285 @@
+import hashlib
+import json
+import time
+from datetime import date
+
+from django.core.cache import cache
+from django.db.models import Case, Count, F, FilteredRelation, FloatField, Q, Sum, Value, When
+
+from .aggregates import fact_bucket
+from .models import AnswerFact
+
+CROSSTAB_CACHE_TIMEOUT = 60 * 60  # seconds
+MAX_COLUMN_DIMENSIONS = 3
+
+# (value, label, min age, max age) - shared with the admin AgeRangeFilter
+AGE_RANGES = [
+    ('under18', 'Under 18', None, 18),
+    ('18-30', '18 to 30', 18, 30),
+    ('31-50', '31 to 50', 30, 50),
+    ('51+', '51 and above', 50, None),
+]
+
+GENDERS = [('M', 'Male'), ('F', 'Female'), ('O', 'Other')]
+
+DEMOGRAPHIC_DIMENSIONS = {
+    'gender': 'Gender',
+    'age_range': 'Age range',
+}
+
+# fact columns that identify an answer category (see aggregates.fact_bucket)
+CATEGORY_FIELDS = (
+    'choice_id',
+    'choice_text',
+    'matrix_column_id',
+    'matrix_column_label',
+    'answer_boolean',
+    'answer_number',
+)
+
+
+class CrosstabError(ValueError):
+    pass
+
+
+def _years_ago(today, years):
+    try:
+        return today.replace(year=today.year - years)
+    except ValueError:  # 29 February
+        return today.replace(year=today.year - years, day=28)
+
+
+def age_range_q(value, prefix='user__', today=None):
+    """Q matching users whose date_of_birth falls in one AGE_RANGES band."""
+    today = today or date.today()
+    for band, _label, min_age, max_age in AGE_RANGES:
+        if band != value:
+            continue
+        q = Q()
+        if min_age is not None:
+            q &= Q(**{f'{prefix}date_of_birth__lte': _years_ago(today, min_age)})
+        if max_age is not None:
+            q &= Q(**{f'{prefix}date_of_birth__gt': _years_ago(today, max_age)})
+        return q
+    raise CrosstabError(f"Unknown age range: {value!r}")
+
+
+def _dimension_q(dimension, value):
+    if dimension == 'gender':
+        return Q(user__gender=value)
+    if dimension == 'age_range':
+        return age_range_q(value)
+    raise CrosstabError(f"Unknown demographic dimension: {dimension!r}")
+
+
+def _demographic_expression(dimension):
+    if dimension == 'gender':
+        return F('user__gender')
+    return Case(
+        *[When(age_range_q(band), then=Value(band)) for band, _label, _lo, _hi in AGE_RANGES],
+        default=Value(''),
+    )
+
+
+def _weight_expression(weights):
+    """Sum() argument for (dimension, {value: weight}); unlisted groups weigh 1."""
+    dimension, table = weights
+    return Case(
+        *[When(_dimension_q(dimension, value), then=Value(float(w))) for value, w in table.items()],
+        default=Value(1.0),
+        output_field=FloatField(),
+    )
+
+
+# --- cache versioning ------------------------------------------------------
+
+def facts_version_key(survey_id) -> str:
+    return f"surveys:facts_version:{survey_id}"
+
+
+def facts_version(survey_id):
+    key = facts_version_key(survey_id)
+    version = cache.get(key)
+    if version is None:
+        # seeded from the clock so an evicted counter never reuses an old version
+        cache.add(key, int(time.time()), None)
+        version = cache.get(key)
+    return version
+
+
+def bump_facts_version(survey_id) -> None:
+    """Invalidate every cached crosstab of a survey; called when facts change."""
+    key = facts_version_key(survey_id)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, int(time.time()), None)
+
+
+def crosstab_cache_key(survey_id, spec) -> str:
+    digest = hashlib.sha1(json.dumps(spec, sort_keys=True, default=str).encode()).hexdigest()
+    return f"surveys:crosstab:{survey_id}:v{facts_version(survey_id)}:{digest}"
+
+
+# --- categories ------------------------------------------------------------
+
+def _category(values):
+    """(bucket, label) for one grouped CATEGORY_FIELDS tuple."""
+    choice_id, choice_text, col_id, col_label, boolean, number = values
+    bucket, label = fact_bucket(choice_id, choice_text, col_id, col_label, boolean)
+    if bucket is not None:
+        return bucket, label
+    if number is not None:
+        return f"num:{number:g}", f"{number:g}"
+    return '', '(other)'
+
+
+def _demographic_category(dimension, value):
+    labels = dict(GENDERS) if dimension == 'gender' else {b: l for b, l, _lo, _hi in AGE_RANGES}
+    return value or '', labels.get(value, '(unknown)')
+
+
+def _sort_key(dimension, bucket):
+    if dimension == 'gender':
+        order = [g for g, _label in GENDERS]
+    elif dimension == 'age_range':
+        order = [b for b, _label, _lo, _hi in AGE_RANGES]
+    else:
+        _, _, tail = bucket.partition(':')
+        try:
+            return (0, float(tail), bucket)
+        except ValueError:
+            return (1, 0, bucket)
+    return (0, order.index(bucket), bucket) if bucket in order else (1, 0, bucket)
+
+
+# --- query -----------------------------------------------------------------
+
+def crosstab(survey, row_key, columns=(), *, filters=None, weights=None, use_cache=True):
+    """
+    Cross-tabulate one analytics_key against up to MAX_COLUMN_DIMENSIONS
+    column dimensions with a single grouped query.
+
+    columns: analytics_keys (self-joined through the submission) and/or
+        DEMOGRAPHIC_DIMENSIONS names, e.g. ['gender', 'age_range'].
+    filters: {'gender': 'F', 'age_range': '18-30', 'since': date, 'until': date}
+    weights: ('gender', {'M': 1.2, 'F': 0.8}) - per-group respondent weights.
+
+    Returns a dict with 'rows' / 'columns' header lists of (bucket, label),
+    'cells' {(row_bucket, col_buckets): {'count', 'weighted'}}, row/column
+    totals and the grand total. Results are cached until facts of the survey
+    are rebuilt.
+    """
+    survey_id = getattr(survey, 'pk', survey)
+    columns = list(columns)
+    filters = {k: v for k, v in (filters or {}).items() if v not in (None, '')}
+    if len(columns) > MAX_COLUMN_DIMENSIONS:
+        raise CrosstabError(f"At most {MAX_COLUMN_DIMENSIONS} column dimensions are supported.")
+    if weights:
+        weights = (weights[0], {str(k): float(v) for k, v in weights[1].items()})
+
+    spec = {'row': row_key, 'columns': columns, 'filters': filters, 'weights': weights}
+    if use_cache:
+        key = crosstab_cache_key(survey_id, spec)
+        result = cache.get(key)
+        if result is not None:
+            return result
+
+    result = _compute_crosstab(survey_id, row_key, columns, filters, weights)
+
+    if use_cache:
+        cache.set(key, result, CROSSTAB_CACHE_TIMEOUT)
+    return result
+
+
+def _compute_crosstab(survey_id, row_key, columns, filters, weights):
+    qs = AnswerFact.objects.filter(survey_id=survey_id, analytics_key=row_key)
+
+    for name in ('gender', 'age_range'):
+        if name in filters:
+            qs = qs.filter(_dimension_q(name, filters[name]))
+    if 'since' in filters:
+        qs = qs.filter(submitted_at__gte=filters['since'])
+    if 'until' in filters:
+        qs = qs.filter(submitted_at__lt=filters['until'])
+
+    group_by = {f'r_{field}': F(field) for field in CATEGORY_FIELDS}
+    for i, dimension in enumerate(columns):
+        if dimension in DEMOGRAPHIC_DIMENSIONS:
+            group_by[f'c{i}'] = _demographic_expression(dimension)
+            continue
+        # self-join: the same submission's facts for the column key
+        alias = f'col{i}'
+        qs = qs.annotate(**{alias: FilteredRelation(
+            'submission__answer_facts',
+            condition=Q(submission__answer_facts__analytics_key=dimension),
+        )}).filter(**{f'{alias}__isnull': False})
+        for field in CATEGORY_FIELDS:
+            group_by[f'c{i}_{field}'] = F(f'{alias}__{field}')
+
+    aggregates = {'n': Count('id')}
+    if weights:
+        aggregates['weighted'] = Sum(_weight_expression(weights))
+
+    rows = qs.values(**group_by).annotate(**aggregates).order_by()
+
+    cells = {}
+    row_labels = {}
+    col_labels = {}
+    for row in rows:
+        r_bucket, r_label = _category([row[f'r_{field}'] for field in CATEGORY_FIELDS])
+        c_buckets, c_names = [], []
+        for i, dimension in enumerate(columns):
+            if dimension in DEMOGRAPHIC_DIMENSIONS:
+                bucket, label = _demographic_category(dimension, row[f'c{i}'])
+            else:
+                bucket, label = _category([row[f'c{i}_{field}'] for field in CATEGORY_FIELDS])
+            c_buckets.append(bucket)
+            c_names.append(label)
+        c_buckets = tuple(c_buckets)
+
+        row_labels[r_bucket] = r_label
+        col_labels[c_buckets] = tuple(c_names)
+        cell = cells.setdefault((r_bucket, c_buckets), {'count': 0, 'weighted': 0.0})
+        cell['count'] += row['n']
+        cell['weighted'] += row['weighted'] if weights else row['n']
+
+    row_order = sorted(row_labels, key=lambda b: _sort_key(row_key, b))
+    col_order = sorted(
+        col_labels,
+        key=lambda bs: tuple(_sort_key(dim, b) for dim, b in zip(columns, bs)),
+    )
+
+    row_totals = {b: {'count': 0, 'weighted': 0.0} for b in row_order}
+    col_totals = {b: {'count': 0, 'weighted': 0.0} for b in col_order}
+    total = {'count': 0, 'weighted': 0.0}
+    for (r_bucket, c_buckets), cell in cells.items():
+        for bucket_total in (row_totals[r_bucket], col_totals[c_buckets], total):
+            bucket_total['count'] += cell['count']
+            bucket_total['weighted'] += cell['weighted']
+
+    return {
+        'row_key': row_key,
+        'dimensions': columns,
+        'weighted': bool(weights),
+        'rows': [(b, row_labels[b]) for b in row_order],
+        'columns': [(b, col_labels[b]) for b in col_order],
+        'cells': cells,
+        'row_totals': row_totals,
+        'column_totals': col_totals,
+        'total': total,
+    }
+
+
+def crosstab_table(result, value='count'):
+    """Flatten a crosstab() result into header + body rows for templates."""
+    header = [' / '.join(labels) or 'Total' for _buckets, labels in result['columns']]
+    body = []
+    for r_bucket, r_label in result['rows']:
+        cells = [
+            result['cells'].get((r_bucket, c_buckets), {}).get(value, 0)
+            for c_buckets, _labels in result['columns']
+        ]
+        body.append({'label': r_label, 'cells': cells, 'total': result['row_totals'][r_bucket][value]})
+    footer = [result['column_totals'][c][value] for c, _labels in result['columns']]
+    return {'header': header, 'body': body, 'footer': footer, 'total': result['total'][value]}
@@ -0,0 +1,155 @@
+import os
+import shutil
+import subprocess
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import transaction
+from django.db.models import OuterRef, Subquery
+from PIL import Image, ImageOps
+
+from .media import acquire_media, release_media
+from .models import MediaDerivative
+from .storage import blob_storage, media_type
+
+# kind: (longest side in px, Pillow format, extension)
+IMAGE_DERIVATIVES = {
+    MediaDerivative.KIND_THUMB: (320, 'JPEG', '.jpg'),
+    MediaDerivative.KIND_WEB: (1280, 'JPEG', '.jpg'),
+    MediaDerivative.KIND_WEB_WEBP: (1280, 'WEBP', '.webp'),
+}
+SAVE_OPTIONS = {
+    'JPEG': {'quality': 82, 'optimize': True, 'progressive': True},
+    'WEBP': {'quality': 80, 'method': 4},
+}
+POSTER_SEEK = '1'  # seconds into the video; short clips fall back to the first frame
+FFMPEG_TIMEOUT = 120  # seconds
+
+
+class DerivativeError(Exception):
+    pass
+
+
+def derivative_kinds(source):
+    """Derivative kinds a stored file gets, by its media type."""
+    kind = media_type(source)
+    if kind == 'image':
+        return list(IMAGE_DERIVATIVES)
+    if kind == 'video':
+        return [MediaDerivative.KIND_POSTER] + list(IMAGE_DERIVATIVES)
+    return []
+
+
+def _poster_frame(source) -> bytes:
+    """One JPEG frame of a video through ffmpeg."""
+    binary = shutil.which(settings.FFMPEG_BINARY)
+    if binary is None:
+        raise DerivativeError(f"{settings.FFMPEG_BINARY} is not installed.")
+    for seek in (POSTER_SEEK, '0'):
+        try:
+            result = subprocess.run(
+                [
+                    binary, '-v', 'error', '-ss', seek, '-i', blob_storage.path(source),
+                    '-frames:v', '1', '-f', 'image2', '-c:v', 'mjpeg', 'pipe:1',
+                ],
+                capture_output=True,
+                timeout=FFMPEG_TIMEOUT,
+            )
+        except subprocess.TimeoutExpired:
+            raise DerivativeError("ffmpeg timed out.")
+        if result.returncode == 0 and result.stdout:
+            return result.stdout
+    raise DerivativeError(result.stderr.decode(errors='replace')[:500] or "No video frame found.")
+
+
+def _render(image, max_side, fmt):
+    """Scaled-down copy of image encoded as fmt: (bytes, width, height)."""
+    image = image.copy()
+    image.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)  # never upscales
+    if fmt == 'JPEG' and image.mode != 'RGB':
+        if image.mode in ('RGBA', 'LA', 'P'):
+            # flatten transparency onto white instead of black
+            image = image.convert('RGBA')
+            background = Image.new('RGB', image.size, (255, 255, 255))
+            background.paste(image, mask=image.getchannel('A'))
+            image = background
+        else:
+            image = image.convert('RGB')
+    buffer = BytesIO()
+    image.save(buffer, fmt, **SAVE_OPTIONS[fmt])
+    return buffer.getvalue(), image.width, image.height
+
+
+def _save(source, kind, data, ext, width, height):
+    stem = os.path.splitext(os.path.basename(source))[0]
+    name = blob_storage.save(f"{stem}_{kind}{ext}", ContentFile(data))
+    return MediaDerivative(source=source, kind=kind, name=name, width=width, height=height, size=len(data))
+
+
+def _load(fh):
+    image = Image.open(fh)
+    # let the JPEG decoder scale down while reading: big photos decode much faster
+    largest = max(side for side, _fmt, _ext in IMAGE_DERIVATIVES.values())
+    image.draft('RGB', (largest, largest))
+    return ImageOps.exif_transpose(image)  # a loaded copy: fh may be closed after
+
+
+def _render_all(source):
+    rows = []
+    if media_type(source) == 'video':
+        poster = _poster_frame(source)
+        image = _load(BytesIO(poster))
+        rows.append(_save(source, MediaDerivative.KIND_POSTER, poster, '.jpg', image.width, image.height))
+    else:
+        with blob_storage.open(source, 'rb') as fh:
+            image = _load(fh)
+    for kind, (max_side, fmt, ext) in IMAGE_DERIVATIVES.items():
+        data, width, height = _render(image, max_side, fmt)
+        rows.append(_save(source, kind, data, ext, width, height))
+    return rows
+
+
+def build_derivatives(source, force=False):
+    """
+    Render the derivatives of one stored file and record them.
+
+    Existing ones are kept unless force. The rendered files are blobs
+    themselves and hold a reference each, so they are collected together
+    with their source. Unreadable files get rows with the error instead.
+    """
+    kinds = derivative_kinds(source)
+    if not kinds:
+        return []
+    existing = list(MediaDerivative.objects.filter(source=source))
+    if not force and {d.kind for d in existing} >= set(kinds):
+        return existing
+
+    try:
+        rows = _render_all(source)
+    except (OSError, Image.DecompressionBombError, DerivativeError) as exc:
+        rows = [MediaDerivative(source=source, kind=kind, error=str(exc)[:2000]) for kind in kinds]
+
+    with transaction.atomic():
+        MediaDerivative.objects.filter(source=source).delete()
+        MediaDerivative.objects.bulk_create(rows)
+        acquire_media([d.name for d in rows], derive=False)
+        release_media([d.name for d in existing])
+    return rows
+
+
+def with_derivatives(queryset, field, **aliases):
+    """
+    Annotate derivative blob names onto a queryset, one subquery per alias:
+    with_derivatives(choices, 'image', image_web='web') sets choice.image_web
+    (None until the derivative exists).
+    """
+    return queryset.annotate(**{
+        alias: Subquery(
+            MediaDerivative.objects
+            .filter(source=OuterRef(field), kind=kind)
+            .exclude(name='')
+            .values('name')[:1]
+        )
+        for alias, kind in aliases.items()
+    })
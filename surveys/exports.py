@@ -0,0 +1,387 @@
+import csv
+import os
+import zipfile
+from functools import partial
+
+from django.db.models import Max, Min
+from django.utils.text import slugify
+
+from .models import AnswerFact, Submission
+
+try:
+    import pyarrow as pa
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:  # optional: exports fall back to CSV
+    pa = None
+
+EXPORT_CHUNK_SIZE = 2000  # submissions per chunk / written row group
+STREAM_CHUNK_SIZE = 2000  # rows fetched per server-side cursor round trip
+ZIP_READ_CHUNK = 1024 * 1024  # bytes
+# already-compressed media is STORED in ZIPs; deflating it again only costs CPU
+STORED_EXTENSIONS = {
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic', '.heif',
+    '.mp4', '.m4v', '.mov', '.webm', '.mkv', '.avi', '.3gp',
+    '.mp3', '.m4a', '.aac', '.ogg', '.oga', '.opus', '.flac',
+    '.zip', '.gz', '.7z', '.rar',
+}
+EXPORT_FORMATS = ('parquet', 'feather', 'csv')
+# keys of these question types export as float columns, everything else as text
+NUMERIC_EXPORT_TYPES = {'NUMBER', 'SLIDER', 'IMAGE_RATING'}
+MULTI_VALUE_SEPARATOR = '; '
+
+BASE_COLUMNS = ('submission_id', 'user_id', 'username', 'submitted_at')
+
+WIDE_FACT_FIELDS = (
+    'submission_id',
+    'analytics_key',
+    'question_type',
+    'choice_text',
+    'matrix_column_label',
+    'answer_text',
+    'answer_number',
+    'answer_boolean',
+    'answer_date',
+    'latitude',
+    'longitude',
+    'media_path',
+)
+
+
+RESPONSE_CSV_HEADER = ('user', 'survey', 'question', 'choice', 'text_answer', 'submitted_at')
+RESPONSE_CSV_FIELDS = (
+    'user__username',
+    'survey__title',
+    'question__text',
+    'choice__text',
+    'text_answer',
+    'submitted_at',
+)
+
+
+class _Echo:
+    """File-like object whose write() hands the line back to the caller."""
+
+    def write(self, value):
+        return value
+
+
+def stream_responses_csv(queryset, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Yield a Response queryset as CSV lines for a StreamingHttpResponse.
+
+    One joined values_list() projection read through iterator() (a
+    server-side cursor on PostgreSQL), so neither the rows nor the CSV are
+    ever held in memory and related objects are never loaded one by one.
+    """
+    writer = csv.writer(_Echo())
+    yield writer.writerow(RESPONSE_CSV_HEADER)
+    rows = queryset.values_list(*RESPONSE_CSV_FIELDS).iterator(chunk_size=chunk_size)
+    for username, title, question, choice, text_answer, submitted_at in rows:
+        yield writer.writerow([username, title, question, choice or '', text_answer, submitted_at])
+
+
+def write_responses_csv(queryset, path, progress=None):
+    """Write stream_responses_csv() to path; returns the number of data rows."""
+    rows = -1  # header line
+    with open(path, 'w', newline='', encoding='utf-8') as fh:
+        for line in stream_responses_csv(queryset):
+            fh.write(line)
+            rows += 1
+            if progress and rows and rows % STREAM_CHUNK_SIZE == 0:
+                progress(rows)
+    return rows
+
+
+def media_responses(queryset):
+    """Responses with an uploaded file, with the related rows the archive names need."""
+    return (
+        queryset
+        .exclude(media_upload='')
+        .exclude(media_upload__isnull=True)
+        .select_related('user', 'survey', 'question')
+        .only('media_upload', 'media_filename', 'submitted_at', 'user__username', 'survey__title', 'question__text')
+    )
+
+
+class MediaZipStream:
+    """
+    Iterable of ZIP bytes holding the uploaded files of a Response queryset,
+    one folder per question, plus metadata.csv. Missing files are skipped.
+
+    The archive is generated as it is consumed: files are read in
+    ZIP_READ_CHUNK pieces and zipfile writes into a non-seekable sink
+    (sizes go into data descriptors), so memory stays flat however big the
+    uploads are. Already-compressed media is STORED, everything else
+    DEFLATED. `added` holds the number of files written so far.
+    """
+
+    def __init__(self, queryset, progress=None):
+        self.queryset = queryset
+        self.progress = progress
+        self.added = 0
+
+    def __iter__(self):
+        sink = _ZipSink()
+        metadata = [['Response ID', 'User', 'Survey', 'Question', 'Filename', 'Timestamp', 'Media URL']]
+        with zipfile.ZipFile(sink, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+            for response in media_responses(self.queryset).iterator(chunk_size=STREAM_CHUNK_SIZE):
+                upload = response.media_upload
+                try:
+                    src = upload.storage.open(upload.name, 'rb')
+                except FileNotFoundError:
+                    continue  # skip missing file
+                filename = response.media_filename or os.path.basename(upload.name)
+                stem, ext = os.path.splitext(filename)
+                ext = f".{slugify(ext)}" if slugify(ext) else ''
+
+                # Clean folder name using slugified question text; the response
+                # id keeps entries unique when a user uploaded several files
+                question_folder = slugify(response.question.text[:50])
+                zinfo = zipfile.ZipInfo(
+                    f"{question_folder}/{response.pk}_{response.user.username}_{slugify(stem)}{ext}",
+                    date_time=response.submitted_at.timetuple()[:6],
+                )
+                zinfo.compress_type = zipfile.ZIP_STORED if ext in STORED_EXTENSIONS else zipfile.ZIP_DEFLATED
+
+                with src, zip_file.open(zinfo, 'w', force_zip64=True) as dest:
+                    for chunk in iter(partial(src.read, ZIP_READ_CHUNK), b''):
+                        dest.write(chunk)
+                        if sink.pending:
+                            yield sink.drain()
+                yield sink.drain()
+
+                metadata.append([
+                    response.pk,
+                    response.user.username,
+                    response.survey.title,
+                    response.question.text,
+                    filename,
+                    response.submitted_at,
+                    upload.url,
+                ])
+                self.added += 1
+                if self.progress and self.added % 100 == 0:
+                    self.progress(self.added)
+
+            writer = csv.writer(_Echo())
+            zip_file.writestr("metadata.csv", ''.join(writer.writerow(row) for row in metadata))
+        # closing the archive wrote the central directory
+        yield sink.drain()
+
+
+class _ZipSink:
+    """Write-only, non-seekable target for zipfile; MediaZipStream drains it."""
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    @property
+    def pending(self):
+        return len(self.buffer) >= ZIP_READ_CHUNK
+
+    def write(self, data):
+        self.buffer += data
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        return data
+
+
+def write_media_zip(queryset, fileobj, progress=None):
+    """Write MediaZipStream(queryset) to fileobj; returns the number of files added."""
+    stream = MediaZipStream(queryset, progress)
+    for chunk in stream:
+        fileobj.write(chunk)
+    return stream.added
+
+
+def wide_columns(survey):
+    """
+    [(analytics_key, label, numeric)] for a survey in question order, from
+    one grouped query over its facts.
+    """
+    keys = (
+        AnswerFact.objects
+        .filter(survey=survey)
+        .values('analytics_key')
+        .annotate(
+            label=Max('analytics_label'),
+            question_type=Max('question_type'),
+            sort_index=Min('question__sort_index'),
+            first_id=Min('id'),
+        )
+        .order_by('sort_index', 'first_id')
+    )
+    return [
+        (row['analytics_key'], row['label'], row['question_type'] in NUMERIC_EXPORT_TYPES)
+        for row in keys
+    ]
+
+
+def _fact_value(row):
+    """Export value of one WIDE_FACT_FIELDS row."""
+    (_sub, _key, question_type, choice_text, column_label, text, number,
+     boolean, day, latitude, longitude, media_path) = row
+    if question_type in NUMERIC_EXPORT_TYPES:
+        return number
+    if choice_text or column_label:
+        return choice_text or column_label
+    if boolean is not None:
+        return 'Yes' if boolean else 'No'
+    if day is not None:
+        return day.isoformat()
+    if latitude is not None and longitude is not None:
+        return f"{latitude},{longitude}"
+    if media_path:
+        return media_path
+    if text:
+        return text
+    if number is not None:
+        return f"{number:g}"
+    return None
+
+
+def iter_wide_chunks(survey, columns, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Yield lists of wide rows (dicts keyed by BASE_COLUMNS + analytics_key),
+    one list per chunk of submissions.
+
+    Each chunk is two queries - the submissions and their facts by
+    submission_id - so memory stays bounded by chunk_size whatever the
+    survey size.
+    """
+    numeric = {key for key, _label, is_numeric in columns if is_numeric}
+    submissions = (
+        Submission.objects
+        .filter(survey=survey)
+        .order_by('id')
+        .values_list('id', 'user_id', 'user__username', 'submitted_at')
+    )
+
+    last_id = 0
+    while True:
+        subs = list(submissions.filter(id__gt=last_id)[:chunk_size])
+        if not subs:
+            return
+        last_id = subs[-1][0]
+
+        rows = {
+            sub_id: {
+                'submission_id': sub_id,
+                'user_id': user_id,
+                'username': username,
+                'submitted_at': submitted_at,
+            }
+            for sub_id, user_id, username, submitted_at in subs
+        }
+        facts = (
+            AnswerFact.objects
+            .filter(submission_id__in=list(rows))
+            .order_by('submission_id', 'id')
+            .values_list(*WIDE_FACT_FIELDS)
+        )
+        for fact in facts.iterator(chunk_size=chunk_size * 10):
+            value = _fact_value(fact)
+            if value is None:
+                continue
+            row = rows[fact[0]]
+            key = fact[1]
+            if key not in row or key in numeric:
+                row[key] = value
+            else:
+                # several facts under one key (multi choice): one joined cell
+                row[key] = f"{row[key]}{MULTI_VALUE_SEPARATOR}{value}"
+
+        yield list(rows.values())
+
+
+class _CsvWriter:
+    def __init__(self, path, columns):
+        self.fh = open(path, 'w', newline='', encoding='utf-8')
+        self.names = list(BASE_COLUMNS) + [key for key, _label, _numeric in columns]
+        self.writer = csv.DictWriter(self.fh, fieldnames=self.names, extrasaction='ignore')
+        self.writer.writeheader()
+
+    def write(self, rows):
+        self.writer.writerows(rows)
+
+    def close(self):
+        self.fh.close()
+
+
+class _ArrowWriter:
+    """Parquet (one row group per chunk) or Feather v2 (one record batch per chunk)."""
+
+    def __init__(self, path, columns, fmt):
+        fields = [
+            pa.field('submission_id', pa.int64()),
+            pa.field('user_id', pa.int64()),
+            pa.field('username', pa.string()),
+            pa.field('submitted_at', pa.timestamp('us', tz='UTC')),
+        ]
+        for key, label, is_numeric in columns:
+            fields.append(pa.field(
+                key,
+                pa.float64() if is_numeric else pa.string(),
+                metadata={'label': label or ''},
+            ))
+        self.schema = pa.schema(fields)
+        if fmt == 'parquet':
+            self.writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+        else:
+            self.writer = pyarrow.ipc.new_file(path, self.schema)
+
+    def write(self, rows):
+        table = pa.Table.from_pylist(rows, schema=self.schema)
+        self.writer.write_table(table)
+
+    def close(self):
+        self.writer.close()
+
+
+def resolve_export_format(fmt='auto'):
+    """'auto' picks Parquet when pyarrow is installed, CSV otherwise."""
+    if fmt == 'auto':
+        return 'parquet' if pa is not None else 'csv'
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format: {fmt!r}")
+    if fmt != 'csv' and pa is None:
+        raise ValueError(f"{fmt} export requires pyarrow.")
+    return fmt
+
+
+def export_survey_wide(survey, path, fmt='auto', chunk_size=EXPORT_CHUNK_SIZE, progress=None):
+    """
+    Write one row per submission and one column per analytics_key to path.
+
+    The file extension is set from the resolved format. Written to a
+    temporary name and renamed at the end, so readers never see a partial
+    file. progress(rows_written) is called after every chunk. Returns
+    (path, row_count).
+    """
+    fmt = resolve_export_format(fmt)
+    path = f"{os.path.splitext(path)[0]}.{fmt}"
+    tmp_path = f"{path}.part"
+
+    columns = wide_columns(survey)
+    writer = _CsvWriter(tmp_path, columns) if fmt == 'csv' else _ArrowWriter(tmp_path, columns, fmt)
+    written = 0
+    try:
+        for rows in iter_wide_chunks(survey, columns, chunk_size):
+            writer.write(rows)
+            written += len(rows)
+            if progress:
+                progress(written)
+    except BaseException:
+        writer.close()
+        os.remove(tmp_path)
+        raise
+    writer.close()
+    os.replace(tmp_path, path)
+    return path, written
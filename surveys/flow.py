@@ -0,0 +1,179 @@
+# surveys/flow.py
+from collections import defaultdict
+
+from django.core.cache import cache
+
+from .logic import compiled_rules_for, rule_hash, rule_keys
+from .models import Question, Choice, MatrixColumn, MatrixCellRouting, SbsCellRouting
+
+FLOW_CACHE_TIMEOUT = 60 * 60  # seconds
+FLOW_PLAN_FORMAT = 3  # bump when the cached flow_routes structure changes
+
+
+def flow_cache_key(survey_id) -> str:
+    return f"surveys:flow:v{FLOW_PLAN_FORMAT}:{survey_id}"
+
+
+def flow_routes(survey_id) -> dict:
+    """
+    The routing tables of a survey as plain id structures; this, not the
+    Question rows, is what get_flow_plan caches.
+    """
+    choice_routes = dict(
+        Choice.objects
+        .filter(question__survey_id=survey_id, next_question__isnull=False)
+        .values_list("id", "next_question_id")
+    )
+    column_routes = dict(
+        MatrixColumn.objects
+        .filter(question__survey_id=survey_id, next_question__isnull=False)
+        .values_list("id", "next_question_id")
+    )
+    matrix_cell_routes = {
+        (row_id, col_id): target_id
+        for row_id, col_id, target_id in (
+            MatrixCellRouting.objects
+            .filter(question__survey_id=survey_id, next_question__isnull=False)
+            .values_list("row_id", "col_id", "next_question_id")
+        )
+    }
+    sbs_cell_routes = {
+        (group_slug, row_id, col_id): target_id
+        for group_slug, row_id, col_id, target_id in (
+            SbsCellRouting.objects
+            .filter(question__survey_id=survey_id, next_question__isnull=False)
+            .values_list("group_slug", "row_id", "col_id", "next_question_id")
+        )
+    }
+    return {
+        "choice_routes": choice_routes,
+        "column_routes": column_routes,
+        "matrix_cell_routes": matrix_cell_routes,
+        "sbs_cell_routes": sbs_cell_routes,
+    }
+
+
+def flow_questions(survey_id):
+    return Question.objects.filter(survey_id=survey_id).order_by("sort_index", "id")
+
+
+class SurveyFlowPlan:
+    """
+    Compiled routing graph for one survey.
+
+    Holds everything the runner needs to pick the next question without
+    touching the database:
+      - questions in (sort_index, id) order
+      - next_question chains
+      - Choice / MatrixColumn routing targets
+      - MatrixCellRouting (row, col) and SbsCellRouting (group_slug, row, col) overrides
+      - visibility rules per question, with a reverse index of which
+        questions depend on which answers-map keys
+    """
+
+    def __init__(self, survey_id, questions, choice_routes, column_routes, matrix_cell_routes, sbs_cell_routes):
+        self.survey_id = survey_id
+        self.questions = list(questions)
+        self.by_id = {q.id: q for q in self.questions}
+        self.positions = {q.id: idx for idx, q in enumerate(self.questions)}
+        self.rules = {q.id: q.visibility_rules for q in self.questions if q.visibility_rules}
+        self.rule_hashes = {qid: rule_hash(rules) for qid, rules in self.rules.items()}
+
+        # answers-map key -> ids of questions whose rules read it
+        self.dependents = defaultdict(set)
+        for qid, rules in self.rules.items():
+            for key in rule_keys(rules):
+                self.dependents[key].add(qid)
+        self.dependents = dict(self.dependents)
+
+        # source id -> target question id
+        self.choice_routes = choice_routes
+        self.column_routes = column_routes
+        # (row_id, col_id) -> target question id
+        self.matrix_cell_routes = matrix_cell_routes
+        # (group_slug, row_id, col_id) -> target question id
+        self.sbs_cell_routes = sbs_cell_routes
+
+    @classmethod
+    def build(cls, survey_id) -> "SurveyFlowPlan":
+        return cls(survey_id, flow_questions(survey_id), **flow_routes(survey_id))
+
+    # --- rules -----------------------------------------------------------
+
+    def rule_for(self, question):
+        """Compiled visibility rule for a question, or None when it is always shown."""
+        rules = self.rules.get(question.id)
+        if rules is None:
+            if question.id in self.by_id or not question.visibility_rules:
+                return None
+            # question from outside this plan
+            return compiled_rules_for(question.id, question.visibility_rules)
+        return compiled_rules_for(question.id, rules, self.rule_hashes[question.id])
+
+    def dependents_of(self, keys) -> set:
+        affected = set()
+        for key in keys:
+            affected |= self.dependents.get(key, set())
+        return affected
+
+    # --- lookups ---------------------------------------------------------
+
+    def get(self, question_id) -> "Question|None":
+        return self.by_id.get(question_id)
+
+    def _resolve(self, question_id) -> "Question|None":
+        if not question_id:
+            return None
+        q = self.by_id.get(question_id)
+        if q is None:
+            # Target lives outside this survey; keep the legacy behaviour of following it.
+            q = Question.objects.filter(pk=question_id).first()
+        return q
+
+    def chain_next(self, question) -> "Question|None":
+        """Explicit Question.next_question target."""
+        return self._resolve(question.next_question_id)
+
+    def next_in_order(self, question) -> "Question|None":
+        idx = self.positions.get(question.id)
+        if idx is None or idx + 1 >= len(self.questions):
+            return None
+        return self.questions[idx + 1]
+
+    def choice_target(self, choice_id) -> "Question|None":
+        return self._resolve(self.choice_routes.get(choice_id))
+
+    def column_target(self, col_id) -> "Question|None":
+        return self._resolve(self.column_routes.get(col_id))
+
+    def matrix_cell_target(self, row_id, col_id) -> "Question|None":
+        """Cell override first, then the column's own routing."""
+        target_id = self.matrix_cell_routes.get((row_id, col_id))
+        if target_id:
+            return self._resolve(target_id)
+        return self.column_target(col_id)
+
+    def sbs_cell_target(self, group_slug, row_id, col_id) -> "Question|None":
+        target_id = self.sbs_cell_routes.get((group_slug, row_id, col_id))
+        if target_id:
+            return self._resolve(target_id)
+        return self.column_target(col_id)
+
+
+def get_flow_plan(survey) -> SurveyFlowPlan:
+    """
+    The flow plan of a survey: its questions in one query plus the routing
+    tables from the cache, loaded on a miss.
+    """
+    survey_id = getattr(survey, "pk", survey)
+    key = flow_cache_key(survey_id)
+    routes = cache.get(key)
+    if routes is None:
+        routes = flow_routes(survey_id)
+        cache.set(key, routes, FLOW_CACHE_TIMEOUT)
+    return SurveyFlowPlan(survey_id, flow_questions(survey_id), **routes)
+
+
+def invalidate_flow_plan(survey_id) -> None:
+    if survey_id:
+        cache.delete(flow_cache_key(survey_id))
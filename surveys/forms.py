@@ -1,6 +1,7 @@
 from django import forms
 import json
-from .models import Survey, Question, MatrixColumn, MatrixRow, Choice
+from .models import Survey, Question, MatrixColumn, MatrixRow, Choice, AnswerFact
+from .crosstab import AGE_RANGES, DEMOGRAPHIC_DIMENSIONS, GENDERS, MAX_COLUMN_DIMENSIONS
 import ast
 from django.core.exceptions import ValidationError
 
@@ -233,3 +234,66 @@ class SurveyResponseForm(forms.Form):
                 # Add textarea field for text questions
                 self.fields[f'question_{question.id}'] = forms.CharField(widget=forms.Textarea, required=True)
 
+
+
+# Admin crosstab picker; analytics_key choices follow the selected survey
+class CrosstabForm(forms.Form):
+    survey = forms.ModelChoiceField(queryset=Survey.objects.all())
+    row_key = forms.ChoiceField(label="Rows", choices=[])
+    columns = forms.MultipleChoiceField(
+        label="Columns",
+        choices=[],
+        required=False,
+        help_text=f"Up to {MAX_COLUMN_DIMENSIONS} analytics keys and/or demographics.",
+    )
+    gender = forms.ChoiceField(choices=[('', 'Any gender')] + GENDERS, required=False)
+    age_range = forms.ChoiceField(
+        choices=[('', 'Any age')] + [(value, label) for value, label, _lo, _hi in AGE_RANGES],
+        required=False,
+    )
+    weight_by = forms.ChoiceField(
+        choices=[('', 'No weighting')] + list(DEMOGRAPHIC_DIMENSIONS.items()),
+        required=False,
+    )
+    weights = forms.CharField(required=False, help_text="e.g. M=1.2, F=0.8")
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        survey_id = self.data.get('survey') if self.is_bound else None
+        keys = []
+        if survey_id and str(survey_id).isdigit():
+            keys = list(
+                AnswerFact.objects
+                .filter(survey_id=survey_id)
+                .values_list('analytics_key', 'analytics_label')
+                .order_by('analytics_key')
+                .distinct()
+            )
+        key_choices = [(key, f"{key} - {label}") for key, label in keys]
+        self.fields['row_key'].choices = key_choices
+        self.fields['columns'].choices = list(DEMOGRAPHIC_DIMENSIONS.items()) + key_choices
+
+    def clean_columns(self):
+        columns = self.cleaned_data['columns']
+        if len(columns) > MAX_COLUMN_DIMENSIONS:
+            raise ValidationError(f"Pick at most {MAX_COLUMN_DIMENSIONS} column dimensions.")
+        return columns
+
+    def clean_weights(self):
+        raw = self.cleaned_data['weights'].strip()
+        weights = {}
+        for part in filter(None, (p.strip() for p in raw.split(','))):
+            value, sep, weight = part.partition('=')
+            try:
+                weights[value.strip()] = float(weight)
+            except ValueError:
+                raise ValidationError(f"Invalid weight {part!r}; use value=number.")
+            if not sep:
+                raise ValidationError(f"Invalid weight {part!r}; use value=number.")
+        return weights
+
+    def clean(self):
+        cleaned = super().clean()
+        if cleaned.get('weights') and not cleaned.get('weight_by'):
+            self.add_error('weight_by', "Choose the dimension the weights apply to.")
+        return cleaned
@@ -1,7 +1,14 @@
 # surveys/logic.py
-from typing import Any, Dict, Union, Iterable
-from .models import Response, Question
+from typing import Any, Callable, Dict, Union, Iterable
 from collections import defaultdict
+from collections.abc import Mapping
+import hashlib
+import json
+import operator
+import uuid
+from django.core.cache import cache
+from django.db import transaction
+from .models import Response, Question
 
 Number = Union[int, float]
 
@@ -73,87 +80,220 @@ def eval_rules(rules: Dict[str, Any], answers: Dict[Any, Any]) -> bool:
     return eval_condition(rules, answers)
 
 
-def answers_for_user_survey(user, survey) -> Dict[Any, Any]:
-    """
-    Build an answers map from in-progress responses (submission is NULL).
+# --- Rule compiler -------------------------------------------------------
+#
+# Same semantics as eval_rules()/eval_condition(), but literals are coerced and
+# membership sets frozen once, and the qref lookup keys are resolved up front.
 
-    Base keys:
-      - question.code if present, else question.id
+_NUMERIC_OPS = {"gt": operator.gt, "gte": operator.ge, "lt": operator.lt, "lte": operator.le}
 
-    Extra keys for MATRIX (non-SBS):
-      - "<QREF>::col::<colKey>" = rowKey OR [rowKey1, rowKey2, ...]
-        where rowKey is row.value or "id:<row_pk>"
+_COMPILED_RULES: Dict[tuple, "CompiledRule"] = {}
+_COMPILED_RULES_MAX = 4096
 
-    Extra keys for MATRIX (SBS):
-      - "<QREF>::sbs::group::<group_slug>::row::<rowKey>" = value
-        where value is numeric/text of that row+group cell; may be a list
-        if multiple values exist (e.g. checkbox).
+
+def _always(answers) -> bool:
+    return True
+
+
+def _never(answers) -> bool:
+    return False
+
+
+class CompiledRule:
+    """A visibility rule tree turned into a predicate over an answers map."""
+
+    __slots__ = ("predicate", "keys")
+
+    def __init__(self, predicate: Callable[[Any], bool], keys: frozenset):
+        self.predicate = predicate
+        self.keys = keys  # answers-map keys the rule reads
+
+    def __call__(self, answers) -> bool:
+        return self.predicate(answers)
+
+
+def _condition_keys(qref) -> tuple:
+    # "123" may also be stored under the numeric question id
+    if isinstance(qref, str) and qref.isdigit():
+        return (qref, int(qref))
+    return (qref,)
+
+
+def _compile_condition(cond: Dict[str, Any]) -> Callable[[Any], bool]:
+    keys = _condition_keys(cond.get("q"))
+    op = cond.get("op", "eq")
+    v = _coerce(cond.get("val"))
+    v_set = frozenset(_coerce(x) for x in v) if isinstance(v, (list, tuple, set)) else None
+
+    if op == "eq":
+        on_list = lambda a: any(y == v for y in a)
+        on_scalar = lambda a: a == v
+    elif op == "ne":
+        on_list = lambda a: not any(y == v for y in a)
+        on_scalar = lambda a: a != v
+    elif op == "in":
+        if v_set is None:
+            return _never
+        on_list = lambda a: any(y in v_set for y in a)
+        on_scalar = lambda a: a in v_set
+    elif op == "not_in":
+        if v_set is None:
+            return _always
+        on_list = lambda a: all(y not in v_set for y in a)
+        on_scalar = lambda a: a not in v_set
+    elif op in _NUMERIC_OPS:
+        if not isinstance(v, (int, float)):
+            return _never
+        cmp = _NUMERIC_OPS[op]
+        # Numeric ops don’t make much sense on lists; default False
+        on_list = lambda a: False
+        on_scalar = lambda a: isinstance(a, (int, float)) and cmp(a, v)
+    else:
+        return _never
+
+    primary = keys[0]
+    fallback = keys[1] if len(keys) > 1 else None
+
+    def predicate(answers) -> bool:
+        actual = answers.get(primary)
+        if actual is None and fallback is not None:
+            actual = answers.get(fallback)
+        a = _coerce(actual)
+        if isinstance(a, (list, tuple, set)):
+            return on_list(a)
+        return on_scalar(a)
+
+    return predicate
+
+
+def _compile_node(rules: Dict[str, Any]) -> Callable[[Any], bool]:
+    if not rules:
+        return _always
+    if "all" in rules:
+        children = [_compile_node(r) for r in rules["all"]]
+        return lambda answers: all(c(answers) for c in children)
+    if "any" in rules:
+        children = [_compile_node(r) for r in rules["any"]]
+        return lambda answers: any(c(answers) for c in children)
+    return _compile_condition(rules)
+
+
+def rule_keys(rules: Dict[str, Any]) -> frozenset:
+    """Every answers-map key (qref, ::col::, ::sbs::group:: keys) a rule tree reads."""
+    keys = set()
+    stack = [rules]
+    while stack:
+        node = stack.pop()
+        if not node:
+            continue
+        if "all" in node:
+            stack.extend(node["all"])
+        elif "any" in node:
+            stack.extend(node["any"])
+        else:
+            keys.update(_condition_keys(node.get("q")))
+    return frozenset(keys)
+
+
+def rule_hash(rules: Dict[str, Any]) -> str:
+    payload = json.dumps(rules or {}, sort_keys=True, default=str)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+
+def compile_rules(rules: Dict[str, Any]) -> CompiledRule:
+    return CompiledRule(_compile_node(rules or {}), rule_keys(rules or {}))
+
+
+def compiled_rules_for(question_id, rules: Dict[str, Any], digest: str = None) -> CompiledRule:
+    """Compile a question's visibility_rules, cached per process by question id + rule hash."""
+    key = (question_id, digest or rule_hash(rules))
+    compiled = _COMPILED_RULES.get(key)
+    if compiled is None:
+        if len(_COMPILED_RULES) >= _COMPILED_RULES_MAX:
+            _COMPILED_RULES.clear()
+        compiled = _COMPILED_RULES[key] = compile_rules(rules)
+    return compiled
+
+
+ANSWERS_CACHE_TIMEOUT = 60 * 60  # seconds
+
+
+def answers_version_key(user_id, survey_id) -> str:
+    return f"surveys:answers-version:{user_id}:{survey_id}"
+
+
+def answers_cache_key(user_id, survey_id, version) -> str:
+    return f"surveys:answers:{user_id}:{survey_id}:{version}"
+
+
+def _cell_value(r) -> Any:
+    if r.choice_id:
+        return r.value if r.value is not None else r.choice_id
+    if r.value is not None:
+        return r.value
+    if r.text_answer not in (None, ""):
+        try:
+            return float(r.text_answer) if "." in r.text_answer else int(r.text_answer)
+        except Exception:
+            return r.text_answer
+    return None
+
+
+def _merge_value(existing: Any, new: Any) -> Any:
+    # Same key answered more than once -> flatten into a list
+    old_vals = existing if isinstance(existing, list) else [existing]
+    new_vals = new if isinstance(new, list) else [new]
+    return old_vals + new_vals
+
+
+def _answers_for_question(question, responses) -> Dict[Any, Any]:
+    """
+    Answers-map entries contributed by one question's in-progress responses.
+    See answers_for_user_survey() for the key layout.
     """
-    amap: Dict[Any, Any] = {}
+    part: Dict[Any, Any] = {}
+    qref = question.code or question.id
 
-    # (qref, colKey) -> list[rowKey] (we'll de-dupe)
-    matrix_col_rows: Dict[tuple, list] = defaultdict(list)
+    # colKey -> list[rowKey] (we'll de-dupe)
+    matrix_col_rows: Dict[str, list] = defaultdict(list)
 
-    # (qref, group_slug, rowKey) -> val or [vals]
+    # (group_slug, rowKey) -> val or [vals]
     sbs_cells: Dict[tuple, Any] = {}
 
-    qs = (
-        Response.objects
-        .filter(user=user, survey=survey, submission__isnull=True)
-        .select_related("question", "choice", "matrix_row", "matrix_column")
-    )
-
-    for r in qs:
-        q = r.question
-        qref = q.code or q.id
-
-        # --- compute cell value (unchanged) ------------------------------
-        cell_val = None
-        if r.choice_id:
-            cell_val = r.value if r.value is not None else r.choice_id
-        elif r.value is not None:
-            cell_val = r.value
-        elif r.text_answer not in (None, ""):
-            try:
-                cell_val = float(r.text_answer) if "." in r.text_answer else int(r.text_answer)
-            except Exception:
-                cell_val = r.text_answer
-
-        # --- base per-question key (unchanged) ---------------------------
-        key = qref
-        if key in amap:
-            existing = amap[key]
-            if isinstance(existing, list):
-                amap[key] = existing + [cell_val]
-            else:
-                amap[key] = [existing, cell_val]
+    for r in responses:
+        cell_val = _cell_value(r)
+
+        # --- base per-question key ---------------------------------------
+        if qref in part:
+            part[qref] = _merge_value(part[qref], cell_val)
         else:
-            amap[key] = cell_val if cell_val is not None else None
+            part[qref] = cell_val
 
         # --- MATRIX extras -----------------------------------------------
-        if q.question_type == "MATRIX":
-            mode = getattr(q, "matrix_mode", None) or "single"
+        if question.question_type == "MATRIX":
+            mode = getattr(question, "matrix_mode", None) or "single"
             col  = getattr(r, "matrix_column", None)
             row  = getattr(r, "matrix_row", None)
+            if col is None or row is None:
+                continue
+
+            row_key = str(row.value) if getattr(row, "value", None) not in (None, "") else f"id:{row.id}"
 
             # Non-SBS: record selected row for that column
-            if mode != "side_by_side" and col is not None and row is not None:
+            if mode != "side_by_side":
                 col_key = str(col.value) if col.value not in (None, "") else f"id:{col.id}"
-                row_key = str(row.value) if getattr(row, "value", None) not in (None, "") else f"id:{row.id}"
 
                 # only record when we actually have an answer
                 if cell_val is not None:
-                    matrix_col_rows[(qref, col_key)].append(row_key)
+                    matrix_col_rows[col_key].append(row_key)
 
             # SBS: record the value of (group,row)
-            elif mode == "side_by_side" and col is not None and row is not None:
+            else:
                 group_slug = (col.group or "").strip()
                 if not group_slug:
                     continue
 
-                row_key = str(row.value) if getattr(row, "value", None) not in (None, "") else f"id:{row.id}"
-                t = (qref, group_slug, row_key)
-
+                t = (group_slug, row_key)
                 if t in sbs_cells:
                     existing = sbs_cells[t]
                     if isinstance(existing, list):
@@ -163,56 +303,232 @@ def answers_for_user_survey(user, survey) -> Dict[Any, Any]:
                 else:
                     sbs_cells[t] = cell_val
 
-    # --- Fold MATRIX non-SBS column selections into amap -----------------
-    # De-dupe and collapse single vs list.
-    for (qref, col_key), rows in matrix_col_rows.items():
-        if not rows:
-            continue
+    # --- Fold MATRIX non-SBS column selections ----------------------------
+    # De-dupe (stable order) and collapse single vs list.
+    for col_key, rows in matrix_col_rows.items():
+        uniq = list(dict.fromkeys(rows))
+        if uniq:
+            part[f"{qref}::col::{col_key}"] = uniq[0] if len(uniq) == 1 else uniq
 
-        # De-dupe but keep stable order
-        seen = set()
-        uniq = []
-        for rk in rows:
-            if rk in seen:
-                continue
-            seen.add(rk)
-            uniq.append(rk)
+    # --- Fold MATRIX SBS cells --------------------------------------------
+    for (group_slug, row_key), val in sbs_cells.items():
+        part[f"{qref}::sbs::group::{group_slug}::row::{row_key}"] = val
 
-        amap[f"{qref}::col::{col_key}"] = uniq[0] if len(uniq) == 1 else uniq
+    return part
 
-    # --- Fold MATRIX SBS cells into amap ---------------------------------
-    for (qref, group_slug, row_key), val in sbs_cells.items():
-        amap[f"{qref}::sbs::group::{group_slug}::row::{row_key}"] = val
 
-    return amap
+class AnswersMap(Mapping):
+    """
+    Answers map for one user's in-progress run of a survey.
+
+    Loaded lazily (from the cache, else with a single Response query) and
+    shared by every visibility check in a request. Entries are kept per
+    question so a save replaces one question in place for the rest of the
+    request.
 
+    Cached snapshots are keyed by a version token that every save replaces
+    (after commit), so they are never written back: a snapshot built from
+    rows read before a concurrent save (another tab, a double submit) lands
+    under the old token and is never read.
+
+    Visibility results are memoised per question; when a question's answers
+    change, only the questions whose rules read one of the changed keys (per
+    the flow plan's reverse index) are re-evaluated.
+    """
+
+    def __init__(self, user, survey, plan=None):
+        self.user_id = user.pk
+        self.survey_id = survey.pk
+        self.plan = plan
+        self._by_question: "Dict[int, Dict[Any, Any]] | None" = None
+        self._merged: "Dict[Any, Any] | None" = None
+        self._visible: Dict[int, bool] = {}
+
+    # --- loading ---------------------------------------------------------
+
+    def _in_progress(self):
+        return (
+            Response.objects
+            .filter(user_id=self.user_id, survey_id=self.survey_id, submission__isnull=True)
+            .select_related("question", "choice", "matrix_row", "matrix_column")
+            .order_by("id")
+        )
+
+    def _version(self):
+        key = answers_version_key(self.user_id, self.survey_id)
+        version = cache.get(key)
+        if version is None:
+            cache.add(key, uuid.uuid4().hex, ANSWERS_CACHE_TIMEOUT)
+            version = cache.get(key)  # None when the cache is down
+        return version
+
+    def _load_cached(self) -> bool:
+        version = self._version()
+        cached = cache.get(answers_cache_key(self.user_id, self.survey_id, version)) if version else None
+        if cached is None:
+            return False
+        self._by_question = cached
+        self._merged = None
+        self._visible.clear()
+        return True
+
+    def _load_db(self) -> None:
+        version = self._version()  # taken before reading, so a later save outdates it
+        grouped: Dict[int, list] = defaultdict(list)
+        questions: Dict[int, Any] = {}
+        for r in self._in_progress():
+            grouped[r.question_id].append(r)
+            questions[r.question_id] = r.question
+
+        self._by_question = {
+            qid: _answers_for_question(questions[qid], rows)
+            for qid, rows in grouped.items()
+        }
+        self._merged = None
+        self._visible.clear()
+        if version:
+            cache.set(answers_cache_key(self.user_id, self.survey_id, version), self._by_question, ANSWERS_CACHE_TIMEOUT)
+
+    def _invalidate(self) -> None:
+        # a new token once the saved rows are visible to other requests
+        key = answers_version_key(self.user_id, self.survey_id)
+        transaction.on_commit(lambda: cache.set(key, uuid.uuid4().hex, ANSWERS_CACHE_TIMEOUT))
+
+    def _ensure(self) -> Dict[Any, Any]:
+        if self._by_question is None and not self._load_cached():
+            self._load_db()
+        if self._merged is None:
+            merged: Dict[Any, Any] = {}
+            for part in self._by_question.values():
+                for key, val in part.items():
+                    merged[key] = _merge_value(merged[key], val) if key in merged else val
+            self._merged = merged
+        return self._merged
+
+    # --- updates ---------------------------------------------------------
+
+    def set_question(self, question, responses) -> None:
+        """Replace one question's entries with the given (already saved) responses."""
+        self._invalidate()
+        if self._by_question is None and not self._load_cached():
+            # Nothing loaded yet: the next lazy load reads the fresh rows from the DB.
+            return
+        responses = list(responses)
+        old = self._by_question.get(question.id, {})
+        new = _answers_for_question(question, responses) if responses else {}
+        if responses:
+            self._by_question[question.id] = new
+        else:
+            self._by_question.pop(question.id, None)
+        self._merged = None
+
+        changed = {k for k in old.keys() | new.keys() if old.get(k) != new.get(k)}
+        if self.plan is None:
+            self._visible.clear()
+        else:
+            for qid in self.plan.dependents_of(changed):
+                self._visible.pop(qid, None)
+
+    def refresh_question(self, question) -> None:
+        """Re-read one question's in-progress responses after they were saved."""
+        if self._by_question is None and not self._load_cached():
+            return
+        self.set_question(question, self._in_progress().filter(question=question))
+
+    def discard(self) -> None:
+        cache.delete(answers_version_key(self.user_id, self.survey_id))
+        self._by_question = None
+        self._merged = None
+        self._visible.clear()
+
+    # --- read API --------------------------------------------------------
+
+    def visible(self, question_id, rule: CompiledRule) -> bool:
+        """Evaluate (or reuse) a compiled visibility rule against this map."""
+        if question_id not in self._visible:
+            self._visible[question_id] = rule(self)
+        return self._visible[question_id]
+
+    @property
+    def answered_question_ids(self) -> set:
+        self._ensure()
+        return set(self._by_question)
+
+    def __getitem__(self, key):
+        return self._ensure()[key]
+
+    def __iter__(self):
+        return iter(self._ensure())
+
+    def __len__(self):
+        return len(self._ensure())
+
+
+def answers_for_user_survey(user, survey) -> Dict[Any, Any]:
+    """
+    Build an answers map from in-progress responses (submission is NULL).
+
+    Base keys:
+      - question.code if present, else question.id
+
+    Extra keys for MATRIX (non-SBS):
+      - "<QREF>::col::<colKey>" = rowKey OR [rowKey1, rowKey2, ...]
+        where rowKey is row.value or "id:<row_pk>"
+
+    Extra keys for MATRIX (SBS):
+      - "<QREF>::sbs::group::<group_slug>::row::<rowKey>" = value
+        where value is numeric/text of that row+group cell; may be a list
+        if multiple values exist (e.g. checkbox).
+    """
+    amap = AnswersMap(user, survey)
+    amap._load_db()
+    return dict(amap)
+
+
+def is_visible(question, user, survey, answers=None, plan=None) -> bool:
+    if plan is not None:
+        rule = plan.rule_for(question)
+        if rule is None:
+            return True
+        amap = answers if answers is not None else AnswersMap(user, survey, plan)
+        if isinstance(amap, AnswersMap):
+            return amap.visible(question.id, rule)
+        return rule(amap)
 
-def is_visible(question, user, survey) -> bool:
-    from .models import Question
     rules = question.visibility_rules or {}
-    amap = answers_for_user_survey(user, survey)
+    if not rules:
+        return True
+    amap = answers if answers is not None else AnswersMap(user, survey)
     return eval_rules(rules, amap)
 
 
-def next_displayable(start_q, user, survey) -> "Question|None":
+def next_displayable(start_q, user, survey, answers=None, plan=None) -> "Question|None":
+    """
+    Follow start_q's next_question chain until a visible question is found.
+    Pass a prebuilt ``answers`` map and the survey's flow ``plan`` to resolve
+    the chain in memory.
+    """
     q = start_q
     visited = set()
     while q:
         if q.pk in visited:
             break
         visited.add(q.pk)
-        if is_visible(q, user, survey):
+        if is_visible(q, user, survey, answers, plan):
             return q
-        q = q.next_question
+        q = plan.chain_next(q) if plan else q.next_question
     return None
 
 
-def find_next_visible_after(current_question, all_questions, user, survey):
+def find_next_visible_after(current_question, all_questions, user, survey, answers=None, plan=None):
     """
     Walk forward in the survey’s linear order starting right AFTER current_question.
     For each candidate, apply next_displayable() to honor per-question routing chains
     and visibility rules. Returns a visible question or None.
     """
+    if answers is None:
+        answers = AnswersMap(user, survey, plan)
+
     try:
         start_idx = all_questions.index(current_question)
     except ValueError:
@@ -220,25 +536,30 @@ def find_next_visible_after(current_question, all_questions, user, survey):
 
     for cand in all_questions[start_idx + 1:]:
         # this lets the candidate chase its own next_question chain while skipping hidden
-        nxt = next_displayable(cand, user, survey)
+        nxt = next_displayable(cand, user, survey, answers, plan)
         if nxt:
             return nxt
     return None
 
 
-def safe_next_question(preferred_next, current_question, all_questions, user, survey):
+def safe_next_question(preferred_next, current_question, all_questions, user, survey, answers=None, plan=None):
     """
     Preferred path:
       1) Try the explicit routing target (and its chain) respecting visibility
       2) If that yields None, try the next visible question in linear order
       3) If none, return None (caller should finalize)
+
+    Pass the request's AnswersMap so it is loaded once and shared by every
+    visibility check.
     """
+    if answers is None:
+        answers = AnswersMap(user, survey, plan)
+
     # 1) try the explicit target (which may itself skip forward via next_question chain)
     if preferred_next:
-        cand = next_displayable(preferred_next, user, survey)
+        cand = next_displayable(preferred_next, user, survey, answers, plan)
         if cand:
             return cand
 
     # 2) try the linear sequence after the current question
-    return find_next_visible_after(current_question, all_questions, user, survey)
-
+    return find_next_visible_after(current_question, all_questions, user, survey, answers, plan)
@@ -0,0 +1,70 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count, Exists, Min, OuterRef
+
+from surveys.models import Response, Submission, SurveyRun
+from surveys.services import ANSWERED_RESPONSE_Q
+
+
+class Command(BaseCommand):
+    """
+    python manage.py backfill_survey_runs
+    python manage.py backfill_survey_runs --survey-id 5
+    """
+    help = "Create SurveyRun rows for runs that were started before SurveyRun existed."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--survey-id',
+            type=int,
+            dest='survey_id',
+            help='Only backfill runs for one survey id.',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            dest='batch_size',
+            default=1000,
+            help='Rows per INSERT.',
+        )
+
+    def handle(self, *args, **options):
+        survey_id = options.get('survey_id')
+        batch_size = options['batch_size']
+
+        # (user, survey) pairs with in-progress answers, no submission and no run yet
+        qs = (
+            Response.objects
+            .filter(submission__isnull=True)
+            .filter(~Exists(Submission.objects.filter(user=OuterRef('user'), survey=OuterRef('survey'))))
+            .filter(~Exists(SurveyRun.objects.filter(user=OuterRef('user'), survey=OuterRef('survey'))))
+        )
+        if survey_id:
+            qs = qs.filter(survey_id=survey_id)
+
+        pairs = (
+            qs.values('user_id', 'survey_id')
+            .annotate(
+                started_at=Min('submitted_at'),
+                answered=Count('question_id', filter=ANSWERED_RESPONSE_Q, distinct=True),
+            )
+            .order_by()
+        )
+
+        created = 0
+        batch = []
+        for row in pairs.iterator():
+            batch.append(SurveyRun(
+                user_id=row['user_id'],
+                survey_id=row['survey_id'],
+                started_at=row['started_at'],
+                answered_count=row['answered'],
+            ))
+            if len(batch) >= batch_size:
+                SurveyRun.objects.bulk_create(batch, ignore_conflicts=True)
+                created += len(batch)
+                batch = []
+        if batch:
+            SurveyRun.objects.bulk_create(batch, ignore_conflicts=True)
+            created += len(batch)
+
+        self.stdout.write(self.style.SUCCESS(f"Backfilled {created} survey run(s)."))
@@ -0,0 +1,55 @@
+from django.core.management.base import BaseCommand
+
+from surveys.derivatives import build_derivatives, derivative_kinds
+from surveys.models import MediaBlob, MediaDerivative
+from surveys.tasks import generate_media_derivatives
+
+
+class Command(BaseCommand):
+    """
+    python manage.py build_media_derivatives
+    python manage.py build_media_derivatives --queue
+    python manage.py build_media_derivatives --force
+    """
+    help = "Render thumbnails, web sizes and video posters for stored media that lacks them."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--force',
+            action='store_true',
+            help='Render again even where derivatives exist (e.g. after changing the sizes).',
+        )
+        parser.add_argument(
+            '--queue',
+            action='store_true',
+            help='Queue one Celery task per file instead of rendering here.',
+        )
+
+    def handle(self, *args, **options):
+        force = options['force']
+        done = set()
+        if not force:
+            done = set(MediaDerivative.objects.values_list('source', flat=True).distinct())
+
+        # derivatives are blobs too, but never sources
+        derived = set(MediaDerivative.objects.exclude(name='').values_list('name', flat=True))
+        names = MediaBlob.objects.filter(refcount__gt=0).values_list('name', flat=True)
+        sources = [
+            name for name in names.iterator()
+            if name not in done and name not in derived and derivative_kinds(name)
+        ]
+
+        failed = 0
+        for i, source in enumerate(sources, 1):
+            if options['queue']:
+                generate_media_derivatives.delay(source, force=force)
+                continue
+            rows = build_derivatives(source, force=force)
+            failed += any(row.error for row in rows)
+            if i % 100 == 0:
+                self.stdout.write(f"{i}/{len(sources)} file(s)...")
+
+        verb = "Queued" if options['queue'] else "Rendered"
+        self.stdout.write(self.style.SUCCESS(
+            f"{verb} derivatives for {len(sources)} file(s); {failed} failed."
+        ))
@@ -0,0 +1,81 @@
+from django.core.management.base import BaseCommand
+
+from surveys.media import MEDIA_FIELDS, recount_media_blobs
+from surveys.storage import BLOB_DIR, blob_storage
+
+
+class Command(BaseCommand):
+    """
+    python manage.py dedupe_media
+    python manage.py dedupe_media --dry-run
+    python manage.py dedupe_media --keep-legacy
+    """
+    help = (
+        "Move files saved before content-addressed storage into MEDIA_ROOT/blobs/ "
+        "(one copy per distinct file), repoint the rows and reset blob refcounts."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Only report how many legacy files would be moved.',
+        )
+        parser.add_argument(
+            '--keep-legacy',
+            action='store_true',
+            help='Leave the old files in place after the rows are repointed.',
+        )
+
+    def handle(self, *args, **options):
+        dry_run = options['dry_run']
+        moved = {}  # legacy name -> blob name, so shared files are hashed once
+        missing = set()
+        legacy_bytes = 0
+        rows = 0
+
+        for model, field in MEDIA_FIELDS:
+            legacy = (
+                model.objects
+                .exclude(**{f'{field}__startswith': f'{BLOB_DIR}/'})
+                .exclude(**{field: ''})
+                .exclude(**{f'{field}__isnull': True})
+                .values_list('pk', field)
+            )
+            for pk, name in legacy.iterator():
+                if name in missing:
+                    continue
+                if name not in moved:
+                    try:
+                        legacy_bytes += blob_storage.size(name)
+                        if dry_run:
+                            moved[name] = None
+                        else:
+                            with blob_storage.open(name, 'rb') as fh:
+                                moved[name] = blob_storage.save(name, fh)
+                    except FileNotFoundError:
+                        missing.add(name)
+                        continue
+                rows += 1
+                if not dry_run:
+                    model.objects.filter(pk=pk).update(**{field: moved[name]})
+
+        if dry_run:
+            self.stdout.write(
+                f"{len(moved)} legacy file(s) ({legacy_bytes} bytes) referenced by {rows} row(s) "
+                f"would be moved; {len(missing)} missing."
+            )
+            return
+
+        changed = recount_media_blobs()
+        if not options['keep_legacy']:
+            for name in moved:
+                blob_storage.delete(name)
+
+        blobs = set(moved.values())
+        blob_bytes = sum(blob_storage.size(name) for name in blobs)
+        self.stdout.write(self.style.SUCCESS(
+            f"Moved {len(moved)} legacy file(s) referenced by {rows} row(s) into {len(blobs)} blob(s) "
+            f"({legacy_bytes} -> {blob_bytes} bytes); {len(changed)} refcount(s) reset, "
+            f"{len(missing)} missing file(s) skipped."
+        ))
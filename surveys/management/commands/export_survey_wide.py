@@ -0,0 +1,56 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from surveys.exports import EXPORT_CHUNK_SIZE, EXPORT_FORMATS, export_survey_wide
+from surveys.models import Survey
+
+
+class Command(BaseCommand):
+    """
+    python manage.py export_survey_wide --survey-id 5 --output /tmp/survey5
+    python manage.py export_survey_wide --survey-id 5 --output /tmp/survey5 --format csv
+    """
+    help = "Export a survey's answer facts as one row per submission (Parquet / Feather / CSV)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--survey-id', type=int, dest='survey_id', required=True)
+        parser.add_argument(
+            '--output',
+            required=True,
+            help='Output path; the extension is set from the format.',
+        )
+        parser.add_argument(
+            '--format',
+            choices=('auto',) + EXPORT_FORMATS,
+            default='auto',
+            help='auto = parquet when pyarrow is installed, csv otherwise.',
+        )
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            dest='chunk_size',
+            default=EXPORT_CHUNK_SIZE,
+            help='Submissions per chunk / row group.',
+        )
+
+    def handle(self, *args, **options):
+        survey = Survey.objects.filter(pk=options['survey_id']).first()
+        if survey is None:
+            raise CommandError(f"Survey #{options['survey_id']} not found.")
+
+        started = time.monotonic()
+        try:
+            path, rows = export_survey_wide(
+                survey,
+                options['output'],
+                fmt=options['format'],
+                chunk_size=max(1, options['chunk_size']),
+            )
+        except ValueError as exc:
+            raise CommandError(str(exc))
+
+        elapsed = max(time.monotonic() - started, 1e-6)
+        self.stdout.write(self.style.SUCCESS(
+            f"Exported {rows} submission(s) to {path} in {elapsed:.1f}s."
+        ))
@@ -1,7 +1,43 @@
+import datetime
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import django
+from django.apps import apps
 from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.db.models import Max, Min
+from django.utils.dateparse import parse_date, parse_datetime
+from django.utils.timezone import is_naive, make_aware
 
 from surveys.models import Submission
-from surveys.analytics import build_submission_answer_facts
+from surveys.analytics import FactSnapshot, build_answer_facts
+from surveys.aggregates import recompute_answer_aggregates
+
+# question/option labels, loaded once per survey per process for the whole run
+_snapshot = None
+
+
+def _init_worker():
+    # spawn-based platforms start a fresh interpreter without Django configured
+    if not apps.ready:
+        django.setup()
+
+
+def _rebuild_range(lo, hi, filters):
+    """Rebuild one submission id range; runs in the worker process."""
+    global _snapshot
+    if _snapshot is None:
+        _snapshot = FactSnapshot()
+    ids = list(
+        Submission.objects
+        .filter(id__gte=lo, id__lte=hi, **filters)
+        .values_list('id', flat=True)
+    )
+    # aggregates are recomputed once per survey after all chunks are in
+    return lo, hi, len(ids), build_answer_facts(ids, snapshot=_snapshot, aggregate=False)
 
 
 class Command(BaseCommand):
@@ -10,6 +46,8 @@ class Command(BaseCommand):
     python manage.py rebuild_answer_facts --survey-id 5
     python manage.py rebuild_answer_facts --submission-id 42
     python manage.py rebuild_answer_facts --user-id 7
+    python manage.py rebuild_answer_facts --workers 8 --chunk-size 1000
+    python manage.py rebuild_answer_facts --since 2025-01-01 --checkpoint /tmp/facts.json
     """
     help = "Rebuild AnswerFact rows from existing submissions."
 
@@ -32,41 +70,174 @@ class Command(BaseCommand):
             dest='user_id',
             help='Only rebuild submissions for one user id.',
         )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=1,
+            help='Number of worker processes (default 1 = in-process).',
+        )
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            dest='chunk_size',
+            default=500,
+            help='Submissions per chunk; each chunk is one delete + insert transaction.',
+        )
+        parser.add_argument(
+            '--since',
+            help='Only rebuild submissions submitted at/after this date or datetime (ISO format).',
+        )
+        parser.add_argument(
+            '--checkpoint',
+            help=(
+                'JSON file recording the last fully rebuilt submission id; reruns with the same '
+                'filters and chunk size resume after it.'
+            ),
+        )
 
     def handle(self, *args, **options):
         survey_id = options.get('survey_id')
         submission_id = options.get('submission_id')
         user_id = options.get('user_id')
+        workers = max(1, options['workers'])
+        chunk_size = max(1, options['chunk_size'])
+        checkpoint = options.get('checkpoint')
 
-        qs = Submission.objects.all().order_by('id')
+        filters = {}
 
         if submission_id:
-            qs = qs.filter(id=submission_id)
+            filters['id'] = submission_id
 
         if survey_id:
-            qs = qs.filter(survey_id=survey_id)
+            filters['survey_id'] = survey_id
 
         if user_id:
-            qs = qs.filter(user_id=user_id)
+            filters['user_id'] = user_id
+
+        if options.get('since'):
+            filters['submitted_at__gte'] = self._parse_since(options['since'])
+
+        qs = Submission.objects.filter(**filters)
+
+        # what the checkpoint was written for: resuming with other options
+        # would skip submissions this run never rebuilt
+        run = {
+            'survey_id': survey_id,
+            'submission_id': submission_id,
+            'user_id': user_id,
+            'since': filters['submitted_at__gte'].isoformat() if 'submitted_at__gte' in filters else None,
+            'chunk_size': chunk_size,
+        }
+        resume_after = self._read_checkpoint(checkpoint, run)
+        if resume_after:
+            qs = qs.filter(id__gt=resume_after)
+            self.stdout.write(f"Resuming after submission #{resume_after}.")
 
-        total = qs.count()
+        bounds = qs.aggregate(lo=Min('id'), hi=Max('id'))
+        total = qs.count() if bounds['lo'] is not None else 0
         if total == 0:
+            if resume_after:
+                # an interrupted run may have stopped before its aggregates step
+                self._recompute_aggregates(filters)
+                self.stdout.write(self.style.SUCCESS("Nothing left to rebuild past the checkpoint."))
+                return
             raise CommandError("No matching submissions found.")
 
-        self.stdout.write(self.style.WARNING(f"Rebuilding AnswerFact rows for {total} submission(s)..."))
+        # windows of chunk_size consecutive ids, so none holds more than
+        # chunk_size matching submissions (sparse filters leave some empty)
+        ranges = [
+            (lo, min(lo + chunk_size - 1, bounds['hi']))
+            for lo in range(bounds['lo'], bounds['hi'] + 1, chunk_size)
+        ]
 
-        built_total = 0
-        for idx, submission in enumerate(qs.iterator(), start=1):
-            count = build_submission_answer_facts(submission)
-            built_total += count
+        self.stdout.write(self.style.WARNING(
+            f"Rebuilding AnswerFact rows for {total} submission(s) "
+            f"in {len(ranges)} chunk(s) with {workers} worker(s)..."
+        ))
 
+        started = time.monotonic()
+        done_subs = 0
+        done_facts = 0
+        finished = set()
+        next_idx = 0  # first range not yet known to be finished
+
+        for lo, hi, sub_count, fact_count in self._run(ranges, filters, workers):
+            done_subs += sub_count
+            done_facts += fact_count
+            finished.add(lo)
+
+            # the checkpoint only moves past ranges whose predecessors are all done
+            while next_idx < len(ranges) and ranges[next_idx][0] in finished:
+                next_idx += 1
+            if checkpoint and next_idx:
+                self._write_checkpoint(checkpoint, ranges[next_idx - 1][1], run)
+
+            elapsed = max(time.monotonic() - started, 1e-6)
             self.stdout.write(
-                f"[{idx}/{total}] submission #{submission.id} -> {count} fact row(s)"
+                f"[{done_subs}/{total}] #{lo}-#{hi}: {fact_count} fact row(s) | "
+                f"{done_subs / elapsed:.1f} submissions/s, {done_facts / elapsed:.1f} facts/s"
             )
 
+        self._recompute_aggregates(filters)
+
+        elapsed = max(time.monotonic() - started, 1e-6)
         self.stdout.write(
             self.style.SUCCESS(
-                f"Done. Rebuilt {built_total} AnswerFact row(s) across {total} submission(s)."
+                f"Done. Rebuilt {done_facts} AnswerFact row(s) across {done_subs} submission(s) "
+                f"in {elapsed:.1f}s ({done_subs / elapsed:.1f} submissions/s, {done_facts / elapsed:.1f} facts/s)."
             )
         )
 
+    def _run(self, ranges, filters, workers):
+        if workers == 1:
+            for lo, hi in ranges:
+                yield _rebuild_range(lo, hi, filters)
+            return
+
+        # children must not share the parent's database sockets
+        connections.close_all()
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as pool:
+            futures = [pool.submit(_rebuild_range, lo, hi, filters) for lo, hi in ranges]
+            for future in as_completed(futures):
+                yield future.result()
+
+    def _recompute_aggregates(self, filters):
+        survey_ids = (
+            Submission.objects.filter(**filters)
+            .order_by()
+            .values_list('survey_id', flat=True)
+            .distinct()
+        )
+        for sid in list(survey_ids):
+            rows = recompute_answer_aggregates(sid)
+            self.stdout.write(f"Survey #{sid}: recomputed {rows} AnswerAggregate row(s).")
+
+    def _parse_since(self, raw):
+        value = parse_datetime(raw)
+        if value is None:
+            day = parse_date(raw)
+            if day is None:
+                raise CommandError(f"Invalid --since value: {raw!r}")
+            value = datetime.datetime.combine(day, datetime.time.min)
+        return make_aware(value) if is_naive(value) else value
+
+    def _read_checkpoint(self, path, run):
+        if not path or not os.path.exists(path):
+            return None
+        try:
+            with open(path) as fh:
+                data = json.load(fh)
+        except (OSError, ValueError) as exc:
+            raise CommandError(f"Unreadable checkpoint {path}: {exc}")
+        if data.get('run') != run:
+            raise CommandError(
+                f"Checkpoint {path} was written by a run with other options ({data.get('run')}); "
+                f"rerun with those or delete the checkpoint."
+            )
+        return data.get('last_id')
+
+    def _write_checkpoint(self, path, last_id, run):
+        tmp = f"{path}.tmp"
+        with open(tmp, 'w') as fh:
+            json.dump({'last_id': last_id, 'run': run}, fh)
+        os.replace(tmp, path)
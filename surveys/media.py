@@ -0,0 +1,190 @@
+from collections import Counter, defaultdict
+from datetime import timedelta
+from functools import partial
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.db.models.functions import Greatest
+from django.db.models.signals import post_delete, post_init, post_save
+from django.utils.timezone import now
+
+from users.models import CustomUser
+from .models import Choice, MediaBlob, MediaDerivative, Question, Response
+from .storage import BLOB_DIR, blob_storage, is_blob_name, media_type
+
+# (model, file field) pairs stored in blob_storage
+MEDIA_FIELDS = [
+    (Choice, 'image'),
+    (Question, 'helper_media'),
+    (Response, 'media_upload'),
+    (CustomUser, 'avatar'),
+]
+
+# file names as loaded from the database, to tell what a save replaced
+SNAPSHOT_ATTR = '_media_names'
+
+
+def _name(value):
+    return getattr(value, 'name', value) or None
+
+
+def _blob_counts(values) -> Counter:
+    """References per blob name among FieldFiles / names; legacy names are not counted."""
+    return Counter(name for name in map(_name, values) if is_blob_name(name))
+
+
+def _by_count(counts):
+    grouped = defaultdict(list)
+    for name, count in counts.items():
+        grouped[count].append(name)
+    return grouped.items()
+
+
+def _blob_size(name):
+    try:
+        return blob_storage.size(name)
+    except OSError:
+        return 0
+
+
+def acquire_media(values, derive=True) -> None:
+    """
+    Add one reference per value (FieldFile or name) to its blob. Images and
+    videos stored for the first time get their derivatives rendered in the
+    background unless derive is False.
+    """
+    counts = _blob_counts(values)
+    if not counts:
+        return
+    existing = set(MediaBlob.objects.filter(name__in=list(counts)).values_list('name', flat=True))
+    new = [name for name in counts if name not in existing]
+    MediaBlob.objects.bulk_create(
+        [MediaBlob(name=name, size=_blob_size(name)) for name in new],
+        ignore_conflicts=True,
+    )
+    for count, names in _by_count(counts):
+        MediaBlob.objects.filter(name__in=names).update(
+            refcount=F('refcount') + count, updated_at=now()
+        )
+    if derive:
+        new = [name for name in new if media_type(name)]
+        if new:
+            transaction.on_commit(partial(queue_derivatives, new))
+
+
+def queue_derivatives(names) -> None:
+    from .tasks import generate_media_derivatives  # tasks imports this module
+
+    for name in names:
+        generate_media_derivatives.delay(name)
+
+
+def release_media(values) -> None:
+    """Drop one reference per value; unreferenced blobs are collected later."""
+    counts = _blob_counts(values)
+    for count, names in _by_count(counts):
+        MediaBlob.objects.filter(name__in=names).update(
+            refcount=Greatest(F('refcount') - count, 0), updated_at=now()
+        )
+
+
+def forget_media(name) -> None:
+    """
+    Hand a blob nothing has claimed (e.g. an abandoned upload) to the
+    collector. A blob that is referenced keeps its count.
+    """
+    if is_blob_name(name):
+        MediaBlob.objects.bulk_create([MediaBlob(name=name, size=_blob_size(name))], ignore_conflicts=True)
+
+
+def collect_media_blobs(grace=None) -> list:
+    """
+    Delete blobs (rows and files) that have had no references for longer
+    than MEDIA_BLOB_GRACE seconds. The grace period covers the moment
+    between a save finding the file already stored and its row taking the
+    reference.
+    """
+    grace = settings.MEDIA_BLOB_GRACE if grace is None else grace
+    with transaction.atomic():
+        dead = list(
+            MediaBlob.objects
+            .select_for_update(skip_locked=True)
+            .filter(refcount=0, updated_at__lt=now() - timedelta(seconds=grace))
+            .values_list('name', flat=True)
+        )
+        MediaBlob.objects.filter(name__in=dead).delete()
+        # derivatives go with their source (their own blobs on a later pass)
+        derivatives = MediaDerivative.objects.filter(source__in=dead)
+        release_media(derivatives.values_list('name', flat=True))
+        derivatives.delete()
+    for name in dead:
+        blob_storage.delete(name)
+    return dead
+
+
+def recount_media_blobs() -> dict:
+    """
+    Reset every MediaBlob refcount from the rows that hold the file.
+
+    Saves and deletes of the tracked models keep the counts, and so does
+    AnswerWriter for answers; answers removed any other way (the admin, a
+    deleted survey) or queryset.update() calls leave them off until this runs.
+    """
+    counts = Counter()
+    for model, field in MEDIA_FIELDS:
+        names = model.objects.filter(**{f'{field}__startswith': f'{BLOB_DIR}/'}).values_list(field, flat=True)
+        counts.update(_blob_counts(names.iterator()))
+
+    with transaction.atomic():
+        stored = dict(MediaBlob.objects.select_for_update().values_list('name', 'refcount'))
+        MediaBlob.objects.bulk_create(
+            [MediaBlob(name=name, size=_blob_size(name)) for name in counts if name not in stored],
+            ignore_conflicts=True,
+        )
+        changed = {
+            name: counts.get(name, 0)
+            for name in set(stored) | set(counts)
+            if stored.get(name) != counts.get(name, 0)
+        }
+        for count, names in _by_count(changed):
+            MediaBlob.objects.filter(name__in=names).update(refcount=count, updated_at=now())
+    return changed
+
+
+# --- model tracking --------------------------------------------------------
+
+def track_media_fields(model, *fields) -> None:
+    """Keep blob refcounts of a model's file fields in step with its saves and deletes."""
+
+    def snapshot(sender, instance, **kwargs):
+        # deferred fields are left out: their stored value is unknown
+        instance.__dict__[SNAPSHOT_ATTR] = {
+            field: _name(instance.__dict__[field]) for field in fields if field in instance.__dict__
+        }
+
+    def saved(sender, instance, created, raw=False, update_fields=None, **kwargs):
+        if raw:
+            return
+        before = {} if created else instance.__dict__.get(SNAPSHOT_ATTR, {})
+        acquired, released = [], []
+        for field in fields:
+            if field not in instance.__dict__ or (update_fields is not None and field not in update_fields):
+                continue
+            if not created and field not in before:
+                continue
+            name = _name(instance.__dict__[field])
+            if name != before.get(field):
+                acquired.append(name)
+                released.append(before.get(field))
+        acquire_media(acquired)
+        release_media(released)
+        snapshot(sender, instance)
+
+    def deleted(sender, instance, **kwargs):
+        release_media(instance.__dict__.get(SNAPSHOT_ATTR, {}).values())
+
+    uid = f"media:{model._meta.label}"
+    post_init.connect(snapshot, sender=model, weak=False, dispatch_uid=uid)
+    post_save.connect(saved, sender=model, weak=False, dispatch_uid=uid)
+    post_delete.connect(deleted, sender=model, weak=False, dispatch_uid=uid)
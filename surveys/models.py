@@ -1,9 +1,14 @@
 
-from django.db import models
+import uuid
+
+from django.utils import timezone
+from django.db import connection, models
 from users.models import CustomUser
 from django.contrib.auth.models import Group
 from django.core.exceptions import ValidationError
-from django.db.models import Q
+from django.db.models import Q, Value
+
+from .storage import blob_storage, export_storage
 
 
 # Model for surveys, storing title, description, and status
@@ -74,7 +79,7 @@ class Question(models.Model):
         blank=True,
         null=True,
         help_text="Only for MATRIX type")
-    helper_media = models.FileField(upload_to='question_helpers/', blank=True, null=True)
+    helper_media = models.FileField(upload_to='question_helpers/', storage=blob_storage, blank=True, null=True)
     helper_media_type = models.CharField(
         max_length=10,
         choices=HELPER_MEDIA_TYPES,
@@ -205,7 +210,7 @@ class MatrixColumn(models.Model):
 class Choice(models.Model):
     question = models.ForeignKey(Question, related_name='choices', on_delete=models.CASCADE)  # Link to parent question
     text = models.CharField(max_length=200)  # Choice text
-    image = models.ImageField(upload_to='choice_images/', null=True, blank=True)
+    image = models.ImageField(upload_to='choice_images/', storage=blob_storage, null=True, blank=True)
     value = models.IntegerField()  # Represents 1–5 etc.
     # Add this to your Choice model
     next_question = models.ForeignKey(
@@ -236,6 +241,150 @@ class Submission(models.Model):
         return f"{self.user} submitted {self.survey}"
 
 
+class OutboxEvent(models.Model):
+    """
+    Post-processing owed to a submission (transactional outbox). Written in the
+    same transaction as the Submission and handled by surveys.tasks, so the work
+    survives a lost task message and can be retried.
+    """
+    KIND_ANSWER_FACTS = 'answer_facts'
+    KIND_CHOICES = [
+        (KIND_ANSWER_FACTS, 'Build answer facts'),
+    ]
+
+    submission = models.ForeignKey(Submission, on_delete=models.CASCADE, related_name='outbox_events')
+    kind = models.CharField(max_length=30, choices=KIND_CHOICES)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        unique_together = ('submission', 'kind')
+        indexes = [
+            models.Index(fields=['processed_at', 'created_at']),
+        ]
+
+    def __str__(self):
+        return f"{self.kind} for submission #{self.submission_id}"
+
+
+class ExportJob(models.Model):
+    """
+    An admin export generated in the background by surveys.tasks.run_export_job.
+    The artifact is written under EXPORT_ROOT (not publicly served) and the
+    requesting user is notified when it is ready.
+    """
+    KIND_RESPONSES_CSV = 'responses_csv'
+    KIND_MEDIA_ZIP = 'media_zip'
+    KIND_SURVEY_WIDE = 'survey_wide'
+    KIND_CHOICES = [
+        (KIND_RESPONSES_CSV, 'Responses CSV'),
+        (KIND_MEDIA_ZIP, 'Media ZIP'),
+        (KIND_SURVEY_WIDE, 'Survey results (wide)'),
+    ]
+
+    STATUS_PENDING = 'pending'
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'Pending'),
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_DONE, 'Done'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+
+    requested_by = models.ForeignKey(
+        CustomUser, null=True, blank=True, on_delete=models.SET_NULL, related_name='export_jobs'
+    )
+    kind = models.CharField(max_length=30, choices=KIND_CHOICES)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=STATUS_PENDING)
+
+    # what to export: a survey (wide export) or the Responses recorded by
+    # select_responses when the job was queued; params holds their ordering
+    # and per-kind options
+    survey = models.ForeignKey(Survey, null=True, blank=True, on_delete=models.SET_NULL)
+    responses = models.ManyToManyField('Response', blank=True, related_name='+')
+    params = models.JSONField(default=dict, blank=True)
+
+    file = models.FileField(storage=export_storage, blank=True)
+    total_rows = models.PositiveIntegerField(default=0)
+    processed_rows = models.PositiveIntegerField(default=0)
+    size_bytes = models.BigIntegerField(null=True, blank=True)
+    elapsed = models.FloatField(null=True, blank=True)  # seconds
+    error = models.TextField(blank=True)
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['-created_at']
+
+    def __str__(self):
+        return f"{self.get_kind_display()} #{self.pk} ({self.status})"
+
+    @property
+    def progress(self):
+        """Percent done, or None while the total is unknown."""
+        if self.status == self.STATUS_DONE:
+            return 100
+        if not self.total_rows:
+            return None
+        return min(100, int(self.processed_rows * 100 / self.total_rows))
+
+    def select_responses(self, queryset):
+        """
+        Record the Responses of queryset as what this job exports, in one
+        INSERT ... SELECT, and keep the queryset's ordering for the export.
+        """
+        through = self.responses.through
+        rows = queryset.order_by().distinct().values_list('pk', Value(self.pk))
+        select_sql, select_params = rows.query.sql_with_params()
+        qn = connection.ops.quote_name
+        columns = ", ".join(qn(through._meta.get_field(name).column) for name in ('response', 'exportjob'))
+        with connection.cursor() as cursor:
+            cursor.execute(f"INSERT INTO {qn(through._meta.db_table)} ({columns}) {select_sql}", select_params)
+        ordering = [field for field in queryset.query.order_by if isinstance(field, str)]
+        if ordering:
+            self.params = {**self.params, 'ordering': ordering}
+            self.save(update_fields=['params'])
+
+
+class SurveyRun(models.Model):
+    """
+    One row per (user, survey) describing the in-progress run: where the
+    respondent is, how far they got and when they started. Maintained by the
+    runner and finalize_submission().
+    """
+    STATUS_IN_PROGRESS = 'in_progress'
+    STATUS_SUBMITTED = 'submitted'
+    STATUS_CHOICES = [
+        (STATUS_IN_PROGRESS, 'In progress'),
+        (STATUS_SUBMITTED, 'Submitted'),
+    ]
+
+    user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='survey_runs')
+    survey = models.ForeignKey('Survey', on_delete=models.CASCADE, related_name='runs')
+    started_at = models.DateTimeField(default=timezone.now)
+    last_question = models.ForeignKey('Question', null=True, blank=True, on_delete=models.SET_NULL, related_name='+')
+    answered_count = models.PositiveIntegerField(default=0)
+    path = models.JSONField(default=list, blank=True)  # visited question ids, for "Back"
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=STATUS_IN_PROGRESS)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('user', 'survey')
+        indexes = [
+            models.Index(fields=['user', 'status']),
+            models.Index(fields=['survey', 'status']),
+        ]
+
+    def __str__(self):
+        return f"{self.user} - {self.survey} ({self.status})"
+
+
 # Model for user responses, linking users, surveys, questions, and answers
 class Response(models.Model):
     submission = models.ForeignKey(Submission, on_delete=models.CASCADE, related_name='responses', null=True, blank=True)
@@ -248,7 +397,8 @@ class Response(models.Model):
     group_label = models.CharField(max_length=100, blank=True, null=True)
     matrix_row = models.ForeignKey(MatrixRow, null=True, blank=True, on_delete=models.CASCADE)
     matrix_column = models.ForeignKey(MatrixColumn, null=True, blank=True, on_delete=models.CASCADE)
-    media_upload = models.FileField(upload_to='uploads/', null=True, blank=True)
+    media_upload = models.FileField(upload_to='uploads/', storage=blob_storage, null=True, blank=True)
+    media_filename = models.CharField(max_length=255, blank=True)  # name of the uploaded file; media_upload is content-addressed
     value = models.FloatField(null=True, blank=True, help_text="Scoring or weighted value of the answer")
     latitude = models.FloatField(null=True, blank=True)
     longitude = models.FloatField(null=True, blank=True)
@@ -257,6 +407,104 @@ class Response(models.Model):
     #     unique_together = ('user', 'survey', 'question', 'matrix_row', 'matrix_column')  # Ensure one response per user per question per survey
 
 
+class MediaBlob(models.Model):
+    """
+    Reference count of one content-addressed file (surveys.storage).
+
+    The tracked file fields add and drop references as rows are saved and
+    deleted; blobs left without references are removed after a grace period
+    by surveys.tasks.collect_media_blobs.
+    """
+    name = models.CharField(max_length=255, unique=True)
+    size = models.BigIntegerField(default=0)
+    refcount = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['refcount', 'updated_at']),
+        ]
+
+    def __str__(self):
+        return f"{self.name} ({self.refcount} refs)"
+
+
+class MediaDerivative(models.Model):
+    """
+    A rendition of a stored media file (surveys.derivatives): thumbnails and
+    web-sized JPEG / WebP images, and the poster frame of a video. Keyed by
+    the source blob name, so identical uploads share one set. A failed
+    rendition keeps an empty name and the error.
+    """
+    KIND_THUMB = 'thumb'
+    KIND_WEB = 'web'
+    KIND_WEB_WEBP = 'web_webp'
+    KIND_POSTER = 'poster'
+    KIND_CHOICES = [
+        (KIND_THUMB, 'Thumbnail'),
+        (KIND_WEB, 'Web JPEG'),
+        (KIND_WEB_WEBP, 'Web WebP'),
+        (KIND_POSTER, 'Video poster'),
+    ]
+
+    source = models.CharField(max_length=255)
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    name = models.CharField(max_length=255, blank=True)
+    width = models.PositiveIntegerField(null=True, blank=True)
+    height = models.PositiveIntegerField(null=True, blank=True)
+    size = models.BigIntegerField(default=0)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ('source', 'kind')
+
+    def __str__(self):
+        return f"{self.source} [{self.kind}]"
+
+
+class UploadSession(models.Model):
+    """
+    A chunked, resumable upload for an upload question (see surveys.uploads).
+    Chunks are appended to a part file under MEDIA_ROOT/uploads/partial/; once
+    complete and checksummed the file moves into Response.media_upload's
+    blob storage and the runner attaches it to the answer.
+    """
+    STATUS_OPEN = 'open'
+    STATUS_COMPLETE = 'complete'
+    STATUS_CHOICES = [
+        (STATUS_OPEN, 'Open'),
+        (STATUS_COMPLETE, 'Complete'),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='upload_sessions')
+    survey = models.ForeignKey(Survey, on_delete=models.CASCADE)
+    question = models.ForeignKey(Question, on_delete=models.CASCADE, related_name='upload_sessions')
+
+    filename = models.CharField(max_length=255)
+    content_type = models.CharField(max_length=100)
+    total_size = models.BigIntegerField()
+    received = models.BigIntegerField(default=0)
+    # expected digest from the client (optional) until complete, then the verified one
+    sha256 = models.CharField(max_length=64, blank=True)
+    stored_name = models.CharField(max_length=255, blank=True)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=STATUS_OPEN)
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'question', 'status']),
+            models.Index(fields=['status', 'updated_at']),
+        ]
+
+    def __str__(self):
+        return f"{self.filename} ({self.received}/{self.total_size})"
+
+
 class AnswerFact(models.Model):
     ANALYSIS_LEVELS = [
         ('question', 'Question'),
@@ -314,6 +562,16 @@ class AnswerFact(models.Model):
     answer_text = models.TextField(blank=True)
     answer_number = models.FloatField(null=True, blank=True)
     answer_boolean = models.BooleanField(null=True, blank=True)
+    answer_date = models.DateField(null=True, blank=True)
+
+    # geolocation answers
+    latitude = models.FloatField(null=True, blank=True)
+    longitude = models.FloatField(null=True, blank=True)
+
+    # upload answers (file metadata only)
+    media_path = models.CharField(max_length=255, blank=True)
+    media_content_type = models.CharField(max_length=100, blank=True)
+    media_size = models.BigIntegerField(null=True, blank=True)
 
     submitted_at = models.DateTimeField()
 
@@ -332,6 +590,39 @@ class AnswerFact(models.Model):
         return f"{self.analytics_label} ({self.user})"
 
 
+class AnswerAggregate(models.Model):
+    """
+    Pre-aggregated AnswerFact statistics, maintained by surveys.aggregates as
+    facts are built.
+
+    bucket '' is the overall row of an analytics_key (answer count, numeric
+    moments, histogram); other buckets ("choice:7", "col:12", "bool:yes") hold
+    category frequencies.
+    """
+    survey = models.ForeignKey(Survey, on_delete=models.CASCADE, related_name='answer_aggregates')
+    analytics_key = models.CharField(max_length=255)
+    bucket = models.CharField(max_length=100, blank=True, default='')
+    bucket_label = models.CharField(max_length=255, blank=True)
+
+    count = models.PositiveIntegerField(default=0)
+    respondents = models.PositiveIntegerField(default=0)
+    numeric_count = models.PositiveIntegerField(default=0)
+    value_sum = models.FloatField(default=0)
+    value_sum_sq = models.FloatField(default=0)
+    value_min = models.FloatField(null=True, blank=True)
+    value_max = models.FloatField(null=True, blank=True)
+    histogram = models.JSONField(default=dict, blank=True)  # {"<floor(value)>": count}
+
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('survey', 'analytics_key', 'bucket')
+        ordering = ['survey', 'analytics_key', 'bucket']
+
+    def __str__(self):
+        return f"{self.analytics_key} [{self.bucket or 'all'}] n={self.count}"
+
+
 class MatrixCellRouting(models.Model):
     """
     Non-SBS MATRIX routing override:
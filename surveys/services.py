@@ -1,35 +1,187 @@
 # surveys/services.py
 from collections import defaultdict
+from django.db import IntegrityError, transaction
+from django.db.models import Prefetch, prefetch_related_objects
+from django.utils.functional import cached_property
 from django.utils.html import escape
 from django.utils.text import slugify
-from surveys.models import SbsCellRouting
-from .analytics import build_submission_answer_facts
-from django.utils.timezone import now
+from .logic import AnswersMap
+from django.utils.timezone import now, is_naive, make_aware
 from django.utils.dateparse import parse_datetime
+from django.db.models import Count, Q
 
-from .models import Submission, Response
-from ledger.models import  PointsLedger # adjust import if your app path differs
+from .derivatives import with_derivatives
+from .media import acquire_media, release_media
+from .models import Choice, MediaDerivative, Submission, Response, SurveyRun, OutboxEvent
+from .tasks import process_outbox_event
+from ledger.services import credit_points
 
 
-def validate_and_collect_matrix_responses(request, survey, question):
-    """Validate all required side-by-side matrix inputs before saving."""
-    grouped_matrix_columns = defaultdict(list)
-    columns = question.matrix_columns.all().order_by('group', 'value')
-    for col in columns:
-        key = col.group or "Ungrouped"
-        grouped_matrix_columns[key].append(col)
-    grouped_matrix_columns = dict(grouped_matrix_columns)
+# question types whose options live in Choice rows
+CHOICE_QUESTION_TYPES = {'SINGLE_CHOICE', 'MULTI_CHOICE', 'RATING', 'DROPDOWN', 'IMAGE_CHOICE', 'IMAGE_RATING'}
+# choice question types whose options are shown as images
+IMAGE_CHOICE_QUESTION_TYPES = {'IMAGE_CHOICE', 'IMAGE_RATING'}
+# question types whose answers are files in Response.media_upload
+UPLOAD_QUESTION_TYPES = {'PHOTO_UPLOAD', 'PHOTO_MULTI_UPLOAD', 'VIDEO_UPLOAD', 'AUDIO_UPLOAD'}
+
+
+def group_matrix_columns(columns) -> dict:
+    """Side-by-side column groups: {group label: [columns ordered by value]}."""
+    grouped = defaultdict(list)
+    for col in sorted(columns, key=lambda c: (c.group is None, c.group or '', c.value)):
+        grouped[col.group or "Ungrouped"].append(col)
+    return dict(grouped)
+
+
+def _to_pk(raw):
+    try:
+        return int(raw)
+    except (TypeError, ValueError):
+        return None
+
+
+class AnswerWriter:
+    """
+    Persists one question's answers for the survey runner.
+
+    Choices, matrix rows and matrix columns are fetched once per question (and
+    prefetched onto the question, so the template reuses them) and posted ids
+    are validated against those sets, so no branch looks anything up per
+    selected id. The replacement set is written with a single delete +
+    bulk_create inside one transaction.
+    """
+
+    def __init__(self, user, survey, question, plan):
+        self.user = user
+        self.survey = survey
+        self.question = question
+        self.plan = plan
+        # rows now stored for the question (None until a full replace happened)
+        self.saved = None
+
+    # --- prefetched option sets ------------------------------------------
+
+    def prefetch(self) -> None:
+        """Load the option sets this question type uses onto the question in one pass."""
+        if self.question.question_type == 'MATRIX':
+            prefetch_related_objects([self.question], 'matrix_rows', 'matrix_columns')
+        elif self.question.question_type in IMAGE_CHOICE_QUESTION_TYPES:
+            # web-sized renditions instead of the original uploads
+            choices = with_derivatives(
+                Choice.objects.all(),
+                'image',
+                image_web=MediaDerivative.KIND_WEB,
+                image_webp=MediaDerivative.KIND_WEB_WEBP,
+            )
+            prefetch_related_objects([self.question], Prefetch('choices', queryset=choices))
+        elif self.question.question_type in CHOICE_QUESTION_TYPES:
+            prefetch_related_objects([self.question], 'choices')
+
+    @cached_property
+    def choices(self) -> dict:
+        return {c.id: c for c in self.question.choices.all()}
+
+    @cached_property
+    def rows(self) -> list:
+        return list(self.question.matrix_rows.all())
+
+    @cached_property
+    def columns(self) -> list:
+        return list(self.question.matrix_columns.all())
+
+    @cached_property
+    def column_groups(self) -> dict:
+        return group_matrix_columns(self.columns)
+
+    def choice(self, raw_id):
+        """The posted choice if it belongs to this question, else None."""
+        return self.choices.get(_to_pk(raw_id))
+
+    def selected_choices(self, raw_ids) -> list:
+        """Valid, de-duplicated choices for a list of posted ids (posted order kept)."""
+        selected = []
+        for raw_id in raw_ids:
+            choice = self.choice(raw_id)
+            if choice is not None and choice not in selected:
+                selected.append(choice)
+        return selected
+
+    # --- routing ---------------------------------------------------------
+
+    def choice_route(self, choices):
+        """Routing target of the first choice that has one."""
+        for choice in choices:
+            target = self.plan.choice_target(choice.id)
+            if target:
+                return target
+        return None
+
+    def cell_route(self, cells):
+        """Routing target of the first (row, col) cell that has one."""
+        for row, col in cells:
+            target = self.plan.matrix_cell_target(row.id, col.id)
+            if target:
+                return target
+        return None
+
+    # --- writes ----------------------------------------------------------
+
+    def build(self, **fields) -> Response:
+        return Response(user=self.user, survey=self.survey, question=self.question, **fields)
+
+    @property
+    def stores_media(self) -> bool:
+        return self.question.question_type in UPLOAD_QUESTION_TYPES
+
+    def replace(self, responses=()) -> list:
+        """Swap the in-progress answer rows for this question in one transaction."""
+        responses = list(responses)
+        with transaction.atomic():
+            current = Response.objects.filter(
+                user=self.user, survey=self.survey, question=self.question, submission__isnull=True
+            )
+            replaced = list(current.values_list('media_upload', flat=True)) if self.stores_media else []
+            current.delete()
+            if responses:
+                Response.objects.bulk_create(responses)
+            if self.stores_media:
+                # blob refcounts; bulk_create and fast deletes send no signals
+                acquire_media(r.media_upload for r in responses)
+                release_media(replaced)
+        self.saved = responses
+        return responses
+
+    def append(self, responses) -> list:
+        """Add rows next to the existing ones (multi-file uploads)."""
+        responses = list(responses)
+        if responses:
+            with transaction.atomic():
+                Response.objects.bulk_create(responses)
+                acquire_media(r.media_upload for r in responses)
+        return responses
+
+
+def validate_and_collect_matrix_responses(request, survey, question, writer):
+    """
+    Validate all required side-by-side matrix inputs before saving.
+
+    Rows and columns come from the writer's prefetched sets and cell routes from
+    the flow plan's (group_slug, row, col) index, so the grid size does not
+    change the number of queries.
+    """
+    grouped_matrix_columns = writer.column_groups
+    plan = writer.plan
 
     collected_responses = []
     next_q = None
 
-    for row in question.matrix_rows.all():
+    for row in writer.rows:
         for group_label, cols in grouped_matrix_columns.items():
             input_type = cols[0].input_type  # all columns in a group share the same type
+            group_slug = slugify(group_label)
 
             # --- SELECT (one field per group) ---
             if input_type == 'select':
-                group_slug = slugify(group_label)
                 field_name = f"matrix_{row.id}_{group_slug}"
                 val = (request.POST.get(field_name, '') or '').strip()
 
@@ -51,22 +203,12 @@ def validate_and_collect_matrix_responses(request, survey, question):
                         'value': val,
                         'group_label': group_label,
                     })
-                    if not next_q:
-                        route = SbsCellRouting.objects.filter(
-                            question=question,
-                            group_slug=group_slug,
-                            row=row,
-                            col=matching_col,  # or matching_col / anchor_col in that branch
-                        ).select_related('next_question').first()
-
-                        if route and route.next_question:
-                            next_q = route.next_question
-                        elif matching_col.next_question:
-                            next_q = matching_col.next_question
+                    # only a real column can carry routing
+                    if not next_q and matching_col:
+                        next_q = plan.sbs_cell_target(group_slug, row.id, matching_col.id)
 
             # --- RADIO (one field per group) ---
             elif input_type == 'radio':
-                group_slug = slugify(group_label)
                 field_name = f"matrix_{row.id}_{group_slug}"
                 selected_val = (request.POST.get(field_name, '') or '').strip()
 
@@ -91,21 +233,10 @@ def validate_and_collect_matrix_responses(request, survey, question):
                         'group_label': group_label,
                     })
                     if not next_q:
-                        route = SbsCellRouting.objects.filter(
-                            question=question,
-                            group_slug=group_slug,
-                            row=row,
-                            col=selected_col,  # or matching_col / anchor_col in that branch
-                        ).select_related('next_question').first()
-
-                        if route and route.next_question:
-                            next_q = route.next_question
-                        elif selected_col.next_question:
-                            next_q = selected_col.next_question
+                        next_q = plan.sbs_cell_target(group_slug, row.id, selected_col.id)
 
             # --- CHECKBOX (one field per group; multiple values) ---
             elif input_type == 'checkbox':
-                group_slug = slugify(group_label)
                 field_name = f"matrix_{row.id}_{group_slug}"
                 selected_values = request.POST.getlist(field_name)
 
@@ -126,24 +257,13 @@ def validate_and_collect_matrix_responses(request, survey, question):
                             'group_label': group_label,
                         })
                         if not next_q:
-                            route = SbsCellRouting.objects.filter(
-                                question=question,
-                                group_slug=group_slug,
-                                row=row,
-                                col=matching_col,  # or matching_col / anchor_col in that branch
-                            ).select_related('next_question').first()
-
-                            if route and route.next_question:
-                                next_q = route.next_question
-                            elif matching_col.next_question:
-                                next_q = matching_col.next_question
+                            next_q = plan.sbs_cell_target(group_slug, row.id, matching_col.id)
 
             # --- TEXT (one field per group) ---
             elif input_type == 'text':
                 # Template names the input with row+firstCol id, e.g. "matrix_{rowId}_{cols[0].id}"
                 field_name = f"matrix_{row.id}_{cols[0].id}"
                 val = (request.POST.get(field_name, '') or '').strip()
-                group_slug = slugify(group_label)
 
                 is_required = any(col.required for col in cols) or row.required
                 if is_required and not val:
@@ -162,17 +282,7 @@ def validate_and_collect_matrix_responses(request, survey, question):
                         'group_label': group_label,
                     })
                     if not next_q:
-                        route = SbsCellRouting.objects.filter(
-                            question=question,
-                            group_slug=group_slug,
-                            row=row,
-                            col=anchor_col,  # or matching_col / anchor_col in that branch
-                        ).select_related('next_question').first()
-
-                        if route and route.next_question:
-                            next_q = route.next_question
-                        elif anchor_col.next_question:
-                            next_q = anchor_col.next_question
+                        next_q = plan.sbs_cell_target(group_slug, row.id, anchor_col.id)
 
             else:
                 # Defensive: unknown type -> ignore gracefully
@@ -180,6 +290,79 @@ def validate_and_collect_matrix_responses(request, survey, question):
     return True, collected_responses, next_q
 
 
+# A Response row counts towards progress only if it actually carries an answer
+ANSWERED_RESPONSE_Q = (
+    Q(choice__isnull=False) |
+    Q(text_answer__gt="") |
+    Q(media_upload__isnull=False) |
+    Q(value__isnull=False) |
+    (Q(latitude__isnull=False) & Q(longitude__isnull=False))
+)
+
+def _answered_counts(user, survey_ids) -> dict:
+    """{survey_id: distinct answered questions} in one grouped query."""
+    rows = (
+        Response.objects
+        .filter(user=user, survey_id__in=survey_ids)
+        .filter(ANSWERED_RESPONSE_Q)
+        .values("survey_id")
+        .annotate(n=Count("question_id", distinct=True))
+        .values_list("survey_id", "n")
+    )
+    counts = {sid: 0 for sid in survey_ids}
+    counts.update(dict(rows))
+    return counts
+
+
+def user_survey_progress(user, survey_ids) -> dict:
+    """
+    Answered-question counts per survey for a user, read from their open
+    SurveyRun rows. Surveys without one (never started, or answered before
+    SurveyRun existed) are counted from the Response rows in one query.
+    """
+    runs = dict(
+        SurveyRun.objects
+        .filter(user=user, survey_id__in=survey_ids, status=SurveyRun.STATUS_IN_PROGRESS)
+        .values_list("survey_id", "answered_count")
+    )
+    counts = _answered_counts(user, [sid for sid in survey_ids if sid not in runs])
+    counts.update(runs)
+    return counts
+
+
+def open_survey_run(request, survey) -> SurveyRun:
+    """
+    Get (or start) the user's run for a survey.
+
+    Runs started before SurveyRun existed kept their start time and Back path in
+    the session; those keys are adopted into the new row once and dropped.
+    """
+    start_iso = request.session.pop(f"survey_{survey.id}_start_time", None)
+    legacy_path = request.session.pop(f"survey_{survey.id}_path", None)
+
+    defaults = {"path": list(legacy_path or [])}
+    start_dt = parse_datetime(start_iso) if start_iso else None
+    if start_dt:
+        defaults["started_at"] = make_aware(start_dt) if is_naive(start_dt) else start_dt
+
+    run, created = SurveyRun.objects.get_or_create(user=request.user, survey=survey, defaults=defaults)
+    if not created and run.status != SurveyRun.STATUS_IN_PROGRESS:
+        # submission was removed (e.g. by staff) - the respondent starts over
+        run.status = SurveyRun.STATUS_IN_PROGRESS
+        run.started_at = now()
+        run.path = []
+        run.last_question = None
+        run.answered_count = _answered_counts(request.user, [survey.id])[survey.id]
+        run.save()
+    return run
+
+
+def refresh_run_progress(run) -> None:
+    """Recount answered questions on the run after the runner saved an answer."""
+    run.answered_count = _answered_counts(run.user_id, [run.survey_id])[run.survey_id]
+    run.save(update_fields=["answered_count", "updated_at"])
+
+
 def get_next_question_in_sequence(questions, current_question):
     try:
         idx = questions.index(current_question)
@@ -188,7 +371,7 @@ def get_next_question_in_sequence(questions, current_question):
         return None
 
 
-def finalize_submission(*, request, survey, session_key):
+def finalize_submission(*, request, survey, run):
     """
     Finalize the current user's in-progress survey run exactly once.
     """
@@ -196,10 +379,7 @@ def finalize_submission(*, request, survey, session_key):
     if existing:
         return existing
 
-    start_iso = request.session.get(session_key)
-    start_dt = parse_datetime(start_iso) if start_iso else None
-    if not start_dt:
-        start_dt = now()
+    start_dt = run.started_at
 
     submitted_dt = now()
     duration = int((submitted_dt - start_dt).total_seconds())
@@ -212,32 +392,47 @@ def finalize_submission(*, request, survey, session_key):
     if optimal_seconds is not None:
         delta = duration - optimal_seconds
 
-    submission = Submission.objects.create(
-        user=request.user,
-        survey=survey,
-        started_at=start_dt,
-        duration_seconds=duration,
-        delta_seconds=delta,
-    )
-
-    Response.objects.filter(
-        user=request.user,
-        survey=survey,
-        submission__isnull=True,
-    ).update(submission=submission)
-
-    request.user.add_points(survey.points_reward)
-
-    PointsLedger.objects.create(
-        user=request.user,
-        amount=survey.points_reward,
-        type="survey_reward",
-        survey_id=survey.id,
-        submission_id=submission.id,
-        note=f"Completed survey: {survey.title}",
-    )
-
-    # Step 5: build normalized analytics rows for this submission
-    build_submission_answer_facts(submission)
+    # Submission, answers, run state, points and ledger commit together (or not at all);
+    # everything else is queued through the outbox and runs after the response is sent.
+    try:
+        with transaction.atomic():
+            submission = Submission.objects.create(
+                user=request.user,
+                survey=survey,
+                started_at=start_dt,
+                duration_seconds=duration,
+                delta_seconds=delta,
+            )
+
+            Response.objects.filter(
+                user=request.user,
+                survey=survey,
+                submission__isnull=True,
+            ).update(submission=submission)
+
+            run.status = SurveyRun.STATUS_SUBMITTED
+            run.path = []
+            run.save(update_fields=["status", "path", "updated_at"])
+
+            credit_points(
+                request.user,
+                survey.points_reward,
+                type="survey_reward",
+                survey_id=survey.id,
+                submission_id=submission.id,
+                note=f"Completed survey: {survey.title}",
+            )
+
+            # Step 5: normalized analytics rows are built by the outbox worker
+            event = OutboxEvent.objects.create(submission=submission, kind=OutboxEvent.KIND_ANSWER_FACTS)
+            # robust: a broker outage is logged, not raised after the submission
+            # committed; sweep_outbox redelivers the event later
+            transaction.on_commit(lambda eid=event.id: process_outbox_event.delay(eid), robust=True)
+    except IntegrityError:
+        # a concurrent request finalized this run first
+        return Submission.objects.get(user=request.user, survey=survey)
+
+    # the in-progress answers map no longer describes any open run
+    AnswersMap(request.user, survey).discard()
 
     return submission
@@ -0,0 +1,36 @@
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from .flow import invalidate_flow_plan
+from .media import MEDIA_FIELDS, track_media_fields
+from .models import Survey, Question, Choice, MatrixRow, MatrixColumn, MatrixCellRouting, SbsCellRouting, Response
+
+
+@receiver([post_save, post_delete], sender=Survey)
+def survey_changed(sender, instance: Survey, **kwargs):
+    invalidate_flow_plan(instance.pk)
+
+
+@receiver([post_save, post_delete], sender=Question)
+def question_changed(sender, instance: Question, **kwargs):
+    invalidate_flow_plan(instance.survey_id)
+
+
+@receiver([post_save, post_delete], sender=Choice)
+@receiver([post_save, post_delete], sender=MatrixRow)
+@receiver([post_save, post_delete], sender=MatrixColumn)
+@receiver([post_save, post_delete], sender=MatrixCellRouting)
+@receiver([post_save, post_delete], sender=SbsCellRouting)
+def routing_changed(sender, instance, **kwargs):
+    # Cascade deletes may run after the parent question is gone
+    survey_id = (
+        Question.objects.filter(pk=instance.question_id).values_list("survey_id", flat=True).first()
+    )
+    invalidate_flow_plan(survey_id)
+
+
+# Response files are counted by AnswerWriter instead: a post_delete receiver
+# would turn every answer replace into a select followed by a delete
+for model, field in MEDIA_FIELDS:
+    if model is not Response:
+        track_media_fields(model, field)
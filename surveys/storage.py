@@ -0,0 +1,80 @@
+import hashlib
+import os
+import uuid
+
+from django.conf import settings
+from django.core.files.storage import FileSystemStorage
+
+# content-addressed files live under MEDIA_ROOT/blobs/<first two hex digits>/
+BLOB_DIR = 'blobs'
+
+# files surveys.derivatives can render thumbnails / posters for
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp', '.tif', '.tiff'}
+VIDEO_EXTENSIONS = {'.mp4', '.m4v', '.mov', '.webm', '.mkv', '.avi', '.3gp'}
+
+
+def is_blob_name(name) -> bool:
+    return bool(name) and name.startswith(f"{BLOB_DIR}/")
+
+
+def media_type(name):
+    """'image', 'video' or None, from the file extension."""
+    ext = os.path.splitext(name or '')[1].lower()
+    if ext in IMAGE_EXTENSIONS:
+        return 'image'
+    if ext in VIDEO_EXTENSIONS:
+        return 'video'
+    return None
+
+
+class HashedMediaStorage(FileSystemStorage):
+    """
+    FileSystemStorage that keeps one copy of every distinct file.
+
+    Whatever name upload_to produced, the file is stored as
+    blobs/<aa>/<sha256><ext>; saving bytes that are already stored writes
+    nothing and returns the existing name. A name therefore never changes
+    content, which is what lets blobs be cached forever. Files are shared
+    between rows, so they are only deleted through the MediaBlob refcounts
+    (surveys.media), never by the field.
+    """
+
+    def blob_name(self, digest, filename) -> str:
+        ext = os.path.splitext(filename or '')[1].lower()[:10]
+        return f"{BLOB_DIR}/{digest[:2]}/{digest}{ext}"
+
+    def get_available_name(self, name, max_length=None):
+        # _save replaces the name with the content hash; no need to probe for a free one
+        return name
+
+    def _save(self, name, content):
+        digest = hashlib.sha256()
+        for chunk in content.chunks():
+            digest.update(chunk)
+        name = self.blob_name(digest.hexdigest(), name)
+        if self.exists(name):
+            return name
+        # written under a private name and renamed: a concurrent save of the
+        # same bytes may win the rename, which leaves an identical file
+        tmp_name = super()._save(f"{name}.{uuid.uuid4().hex}.part", content)
+        os.replace(self.path(tmp_name), self.path(name))
+        return name
+
+    def adopt(self, path, filename, digest) -> str:
+        """Move a local file whose sha256 is already known into the store; returns its name."""
+        name = self.blob_name(digest, filename)
+        target = self.path(name)
+        if os.path.exists(target):
+            os.remove(path)
+        else:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.replace(path, target)
+        return name
+
+
+blob_storage = HashedMediaStorage()
+
+
+def export_storage():
+    """Storage of ExportJob files under EXPORT_ROOT (a callable, so migrations don't pin the path)."""
+    return FileSystemStorage(location=settings.EXPORT_ROOT, base_url=None)
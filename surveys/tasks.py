@@ -29,3 +29,229 @@
 #         fail_silently=False,
 #     )
 #     return f"Reminder sent to {user_email}"
+
+
+import logging
+import os
+import secrets
+import time
+from datetime import timedelta
+
+from celery import shared_task
+from django.conf import settings
+from django.db import transaction
+from django.urls import reverse
+from django.utils.timezone import now
+
+from notifications.models import Notification
+from .analytics import build_submission_answer_facts
+from .exports import export_survey_wide, write_media_zip, write_responses_csv
+from .models import ExportJob, OutboxEvent, Response, Submission, UploadSession
+from .derivatives import build_derivatives
+from .media import collect_media_blobs as collect_unreferenced_blobs
+from .uploads import discard_upload_session
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_MAX_ATTEMPTS = 10
+OUTBOX_SWEEP_GRACE = timedelta(minutes=2)  # leave time for the on_commit dispatch
+OUTBOX_SWEEP_BATCH = 500
+
+
+def _handle_outbox_event(event):
+    if event.kind == OutboxEvent.KIND_ANSWER_FACTS:
+        build_submission_answer_facts(event.submission)
+
+
+@shared_task(bind=True, max_retries=5, default_retry_delay=30, acks_late=True)
+def process_outbox_event(self, event_id):
+    """Run one pending outbox event; failures are recorded on the row and retried."""
+    error = None
+    with transaction.atomic():
+        event = (
+            OutboxEvent.objects
+            .select_for_update(skip_locked=True)
+            .select_related("submission")
+            .filter(pk=event_id, processed_at__isnull=True)
+            .first()
+        )
+        if event is None:
+            return "skipped"  # already done, or another worker holds it
+
+        event.attempts += 1
+        try:
+            with transaction.atomic():
+                _handle_outbox_event(event)
+        except Exception as exc:
+            error = exc
+            event.last_error = repr(exc)[:2000]
+            event.save(update_fields=["attempts", "last_error"])
+        else:
+            event.processed_at = now()
+            event.last_error = ""
+            event.save(update_fields=["attempts", "last_error", "processed_at"])
+
+    if error is not None:
+        raise self.retry(exc=error)
+    return "done"
+
+
+@shared_task
+def sweep_outbox():
+    """Re-dispatch outbox events whose task was lost or gave up retrying."""
+    ids = list(
+        OutboxEvent.objects
+        .filter(
+            processed_at__isnull=True,
+            attempts__lt=OUTBOX_MAX_ATTEMPTS,
+            created_at__lt=now() - OUTBOX_SWEEP_GRACE,
+        )
+        .order_by("created_at")
+        .values_list("id", flat=True)[:OUTBOX_SWEEP_BATCH]
+    )
+    for event_id in ids:
+        process_outbox_event.delay(event_id)
+    return len(ids)
+
+
+def _export_name(job, ext):
+    """
+    Name of a job's artifact in its (non-public) storage, with a random part
+    so it cannot be guessed either; creates the directory.
+    """
+    os.makedirs(job.file.storage.location, exist_ok=True)
+    return f"{job.kind}-{job.pk}-{secrets.token_urlsafe(16)}.{ext}"
+
+
+def _job_responses(job):
+    """The Responses recorded on a job when it was queued (ExportJob.select_responses)."""
+    return Response.objects.filter(
+        pk__in=job.responses.through.objects.filter(exportjob=job).values("response_id")
+    ).order_by(*job.params.get("ordering", ["pk"]))
+
+
+def _export_responses_csv(job, progress):
+    queryset = _job_responses(job)
+    progress(0, queryset.count())
+    name = _export_name(job, "csv")
+    rows = write_responses_csv(queryset, job.file.storage.path(name), progress)
+    return name, rows
+
+
+def _export_media_zip(job, progress):
+    queryset = _job_responses(job)
+    progress(0, queryset.exclude(media_upload="").exclude(media_upload__isnull=True).count())
+    name = _export_name(job, "zip")
+    with open(job.file.storage.path(name), "wb") as fh:
+        rows = write_media_zip(queryset, fh, progress)
+    return name, rows
+
+
+def _export_survey_wide(job, progress):
+    if job.survey is None:
+        raise ValueError("The survey of this export no longer exists.")
+    progress(0, Submission.objects.filter(survey=job.survey).count())
+    base = _export_name(job, "tmp")
+    path, rows = export_survey_wide(
+        job.survey,
+        job.file.storage.path(base),
+        fmt=job.params.get("format", "auto"),
+        progress=progress,
+    )
+    return os.path.basename(path), rows
+
+
+EXPORTERS = {
+    ExportJob.KIND_RESPONSES_CSV: _export_responses_csv,
+    ExportJob.KIND_MEDIA_ZIP: _export_media_zip,
+    ExportJob.KIND_SURVEY_WIDE: _export_survey_wide,
+}
+
+
+def _notify_export(job):
+    if job.requested_by_id is None:
+        return
+    if job.status == ExportJob.STATUS_DONE:
+        type_, title = "export_ready", f"Export ready: {job.get_kind_display()}"
+        message = f"{job.processed_rows} row(s), {job.size_bytes or 0} bytes in {job.elapsed:.1f}s."
+    else:
+        type_, title = "export_failed", f"Export failed: {job.get_kind_display()}"
+        message = job.error[:500]
+    Notification.objects.create(
+        user_id=job.requested_by_id,
+        type=type_,
+        title=title,
+        message=message,
+        url=reverse("admin:surveys_exportjob_change", args=[job.pk]),
+    )
+
+
+@shared_task(acks_late=True)
+def run_export_job(job_id):
+    """Generate one ExportJob artifact, recording progress, size and timing on the row."""
+    claimed = ExportJob.objects.filter(pk=job_id, status=ExportJob.STATUS_PENDING).update(
+        status=ExportJob.STATUS_RUNNING, started_at=now()
+    )
+    if not claimed:
+        return "skipped"  # already running or finished
+    job = ExportJob.objects.select_related("survey", "requested_by").get(pk=job_id)
+    started = time.monotonic()
+
+    def progress(done, total=None):
+        fields = {"processed_rows": done}
+        if total is not None:
+            fields["total_rows"] = total
+        ExportJob.objects.filter(pk=job_id).update(**fields)
+
+    try:
+        name, rows = EXPORTERS[job.kind](job, progress)
+    except Exception as exc:
+        logger.exception("Export job %s failed", job_id)
+        job.status = ExportJob.STATUS_FAILED
+        job.error = repr(exc)[:2000]
+        job.elapsed = time.monotonic() - started
+        job.finished_at = now()
+        job.save(update_fields=["status", "error", "elapsed", "finished_at"])
+        _notify_export(job)
+        return "failed"
+
+    job.refresh_from_db(fields=["total_rows"])
+    job.status = ExportJob.STATUS_DONE
+    job.file.name = name
+    job.processed_rows = rows
+    job.total_rows = max(job.total_rows, rows)
+    job.size_bytes = job.file.size
+    job.elapsed = time.monotonic() - started
+    job.finished_at = now()
+    job.save(update_fields=[
+        "status", "file", "processed_rows", "total_rows", "size_bytes", "elapsed", "finished_at",
+    ])
+    _notify_export(job)
+    return "done"
+
+
+@shared_task
+def purge_upload_sessions():
+    """
+    Drop chunked uploads idle for longer than UPLOAD_SESSION_TTL, with their
+    files: unfinished ones and completed ones no answer ever claimed
+    (attached sessions are deleted when the answer is saved).
+    """
+    cutoff = now() - timedelta(seconds=settings.UPLOAD_SESSION_TTL)
+    purged = 0
+    for session in UploadSession.objects.filter(updated_at__lt=cutoff).iterator():
+        discard_upload_session(session)
+        purged += 1
+    return purged
+
+
+@shared_task
+def collect_media_blobs():
+    """Delete content-addressed media files no row has referenced for MEDIA_BLOB_GRACE."""
+    return len(collect_unreferenced_blobs())
+
+
+@shared_task(acks_late=True)
+def generate_media_derivatives(source, force=False):
+    """Render thumbnails / web sizes (and a poster for videos) of one stored file."""
+    return len(build_derivatives(source, force=force))
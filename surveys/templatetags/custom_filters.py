@@ -1,5 +1,7 @@
 from django import template
 
+from surveys.storage import blob_storage
+
 register = template.Library()
 
 
@@ -72,3 +74,7 @@ def format_duration(seconds):
     return " ".join(parts)
 
 
+@register.filter
+def blob_url(name):
+    """URL of a stored blob name, e.g. a derivative annotated by with_derivatives()."""
+    return blob_storage.url(name) if name else ''
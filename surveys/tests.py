@@ -1,5 +1,299 @@
-from django.test import TestCase
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import RequestFactory, TestCase, override_settings
+from django.utils.timezone import now
 
+from ledger.models import PointsLedger
+from users.models import CustomUser
 
+from .aggregates import answer_summary, recompute_answer_aggregates
+from .analytics import build_answer_facts
+from .models import AnswerAggregate, AnswerFact, Choice, ExportJob, OutboxEvent, Question, Response, Submission, Survey, SurveyRun, UploadSession
+from .services import finalize_submission
+from .tasks import process_outbox_event, sweep_outbox
+from .uploads import UploadError, append_chunk, complete_upload_session, open_upload_session, part_path
+
+
+def make_survey():
+    survey = Survey.objects.create(title='Survey', description='d', points_reward=5)
+    pick = Question.objects.create(survey=survey, code='Q1', text='Pick one', question_type='SINGLE_CHOICE', sort_index=1)
+    choices = [Choice.objects.create(question=pick, text=text, value=value) for text, value in (('a', 1), ('b', 2))]
+    number = Question.objects.create(survey=survey, code='Q2', text='A number', question_type='NUMBER', sort_index=2)
+    return survey, pick, choices, number
+
+
+def answer(user, survey, pick, choice, number, value):
+    Response.objects.create(user=user, survey=survey, question=pick, choice=choice, value=choice.value)
+    Response.objects.create(user=user, survey=survey, question=number, value=value)
+
+
+class FinalizeSubmissionTests(TestCase):
+
+    def setUp(self):
+        self.user = CustomUser.objects.create_user('respondent', 'r@example.com', 'pw')
+        self.survey, pick, choices, number = make_survey()
+        answer(self.user, self.survey, pick, choices[0], number, 7)
+        self.run = SurveyRun.objects.create(user=self.user, survey=self.survey, started_at=now() - timedelta(minutes=3))
+        self.request = RequestFactory().post('/')
+        self.request.user = self.user
+
+    def finalize(self):
+        return finalize_submission(request=self.request, survey=self.survey, run=self.run)
+
+    def test_writes_submission_points_and_one_outbox_event(self):
+        with mock.patch.object(process_outbox_event, 'delay') as delay:
+            with self.captureOnCommitCallbacks(execute=True):
+                submission = self.finalize()
+
+        event = OutboxEvent.objects.get()
+        self.assertEqual(event.submission, submission)
+        self.assertEqual(event.kind, OutboxEvent.KIND_ANSWER_FACTS)
+        delay.assert_called_once_with(event.pk)
+        self.assertEqual(Response.objects.filter(submission=submission).count(), 2)
+        self.assertEqual(CustomUser.objects.get(pk=self.user.pk).points, 5)
+        self.assertEqual(PointsLedger.objects.filter(submission_id=submission.pk).count(), 1)
+        self.run.refresh_from_db()
+        self.assertEqual(self.run.status, SurveyRun.STATUS_SUBMITTED)
+
+    def test_second_submit_returns_the_first_submission(self):
+        first = self.finalize()
+        self.assertEqual(self.finalize(), first)
+        self.assertEqual(OutboxEvent.objects.count(), 1)
+        self.assertEqual(CustomUser.objects.get(pk=self.user.pk).points, 5)
+
+    def test_concurrent_submit_rolls_back_on_integrity_error(self):
+        first = self.finalize()
+        # the other request finalized between our existence check and insert
+        with mock.patch.object(Submission.objects, 'filter', return_value=mock.Mock(first=lambda: None)):
+            second = self.finalize()
+
+        self.assertEqual(second, first)
+        self.assertEqual(OutboxEvent.objects.count(), 1)
+        self.assertEqual(PointsLedger.objects.filter(user=self.user).count(), 1)
+        self.assertEqual(CustomUser.objects.get(pk=self.user.pk).points, 5)
+
+
+class OutboxTests(TestCase):
+
+    def setUp(self):
+        self.user = CustomUser.objects.create_user('respondent', 'r@example.com', 'pw')
+        survey, pick, choices, number = make_survey()
+        answer(self.user, survey, pick, choices[1], number, 3)
+        self.submission = Submission.objects.create(user=self.user, survey=survey, started_at=now())
+        Response.objects.update(submission=self.submission)
+        self.event = OutboxEvent.objects.create(submission=self.submission, kind=OutboxEvent.KIND_ANSWER_FACTS)
+
+    def test_process_outbox_event_runs_once(self):
+        self.assertEqual(process_outbox_event(self.event.pk), 'done')
+        facts = AnswerFact.objects.count()
+        self.assertGreater(facts, 0)
+
+        self.assertEqual(process_outbox_event(self.event.pk), 'skipped')
+        self.assertEqual(AnswerFact.objects.count(), facts)
+        self.event.refresh_from_db()
+        self.assertEqual(self.event.attempts, 1)
+        self.assertIsNotNone(self.event.processed_at)
+
+    def test_sweep_outbox_redelivers_only_pending_events(self):
+        with mock.patch.object(process_outbox_event, 'delay') as delay:
+            # still within the grace period of its on_commit dispatch
+            self.assertEqual(sweep_outbox(), 0)
+
+            OutboxEvent.objects.update(created_at=now() - timedelta(hours=1))
+            self.assertEqual(sweep_outbox(), 1)
+            delay.assert_called_once_with(self.event.pk)
+
+            process_outbox_event(self.event.pk)
+            self.assertEqual(sweep_outbox(), 0)
+        self.assertEqual(delay.call_count, 1)
+
+
+class AggregateTests(TestCase):
+
+    def setUp(self):
+        self.survey, pick, choices, number = make_survey()
+        self.submission_ids = []
+        for i, value in enumerate([4, 9, 9, 15, 2.5]):
+            user = CustomUser.objects.create_user(f'user{i}', f'u{i}@example.com', 'pw')
+            answer(user, self.survey, pick, choices[i % 2], number, value)
+            submission = Submission.objects.create(user=user, survey=self.survey, started_at=now())
+            Response.objects.filter(user=user).update(submission=submission)
+            self.submission_ids.append(submission.pk)
+
+    def aggregates(self):
+        return sorted(
+            AnswerAggregate.objects.filter(survey=self.survey).values_list(
+                'analytics_key', 'bucket', 'count', 'respondents', 'numeric_count',
+                'value_sum', 'value_sum_sq', 'value_min', 'value_max', 'histogram',
+            )
+        )
+
+    def test_incremental_and_recomputed_aggregates_match(self):
+        # two batches, so increments are merged into existing rows
+        build_answer_facts(self.submission_ids[:2])
+        build_answer_facts(self.submission_ids[2:])
+        incremental = self.aggregates()
+        summary = answer_summary(self.survey)
+
+        recompute_answer_aggregates(self.survey.pk)
+        self.assertEqual(self.aggregates(), incremental)
+        self.assertEqual(answer_summary(self.survey), summary)
+        self.assertEqual(summary['Q2']['count'], 5)
+        self.assertEqual(summary['Q2']['min'], 2.5)
+        self.assertEqual(summary['Q2']['max'], 15)
+
+    def test_replaced_facts_are_recomputed(self):
+        build_answer_facts(self.submission_ids)
+        Response.objects.filter(submission_id=self.submission_ids[0], question__code='Q2').update(value=100)
+        build_answer_facts(self.submission_ids[:1])
+        rebuilt = self.aggregates()
+
+        recompute_answer_aggregates(self.survey.pk)
+        self.assertEqual(self.aggregates(), rebuilt)
+        self.assertEqual(answer_summary(self.survey, 'Q2')['Q2']['max'], 100)
+
+
+class RebuildCheckpointTests(TestCase):
+
+    def setUp(self):
+        survey, pick, choices, number = make_survey()
+        for i in range(3):
+            user = CustomUser.objects.create_user(f'user{i}', f'u{i}@example.com', 'pw')
+            answer(user, survey, pick, choices[0], number, i)
+            submission = Submission.objects.create(user=user, survey=survey, started_at=now())
+            Response.objects.filter(user=user).update(submission=submission)
+        self.survey = survey
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        self.checkpoint = os.path.join(directory, 'facts.json')
+
+    def rebuild(self, **options):
+        call_command('rebuild_answer_facts', checkpoint=self.checkpoint, stdout=io.StringIO(), **options)
+
+    def test_resume_with_the_same_options(self):
+        self.rebuild(chunk_size=2)
+        facts = AnswerFact.objects.count()
+        self.rebuild(chunk_size=2)
+        self.assertEqual(AnswerFact.objects.count(), facts)
+
+    def test_resume_with_other_options_is_refused(self):
+        self.rebuild(chunk_size=2)
+        for options in ({'chunk_size': 3}, {'chunk_size': 2, 'survey_id': self.survey.pk}, {'chunk_size': 2, 'since': '2020-01-01'}):
+            with self.subTest(**options), self.assertRaises(CommandError):
+                self.rebuild(**options)
+
+
+class ExportSelectionTests(TestCase):
+
+    def setUp(self):
+        self.admin = CustomUser.objects.create_superuser('admin', 'admin@example.com', 'pw')
+        survey, pick, choices, number = make_survey()
+        for i in range(3):
+            user = CustomUser.objects.create_user(f'user{i}', f'u{i}@example.com', 'pw')
+            answer(user, survey, pick, choices[i % 2], number, i)
+        self.pick = pick
+        self.client.force_login(self.admin)
+
+    def test_filtered_export_records_the_changelist_selection(self):
+        changelist = f'/admin/surveys/response/?question__id__exact={self.pick.pk}'
+        self.assertContains(self.client.get(changelist), f'export-csv-job/?question__id__exact={self.pick.pk}')
+
+        with mock.patch('surveys.admin.run_export_job'):
+            self.client.get(f'/admin/surveys/response/export-csv-job/?question__id__exact={self.pick.pk}&o=-1')
+        job = ExportJob.objects.get()
+        self.assertEqual(
+            sorted(job.responses.values_list('pk', flat=True)),
+            sorted(Response.objects.filter(question=self.pick).values_list('pk', flat=True)),
+        )
+        self.assertTrue(job.params['ordering'])
+
+    def test_action_records_the_selected_responses(self):
+        selected = list(Response.objects.values_list('pk', flat=True)[:2])
+        with mock.patch('surveys.admin.run_export_job'):
+            self.client.post('/admin/surveys/response/', {'action': 'export_csv_in_background', '_selected_action': selected})
+        self.assertEqual(sorted(ExportJob.objects.get().responses.values_list('pk', flat=True)), sorted(selected))
+
+
+class ChunkedUploadTests(TestCase):
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.user = CustomUser.objects.create_user('uploader', 'up@example.com', 'pw')
+        survey = Survey.objects.create(title='Photos', description='d')
+        self.question = Question.objects.create(survey=survey, code='P1', text='Photo', question_type='PHOTO_UPLOAD')
+        self.data = os.urandom(20)
+
+    def open(self, sha256=''):
+        return open_upload_session(self.user, self.question, 'photo.png', 'image/png', len(self.data), sha256)
+
+    def put(self, session, start, end, checksum=''):
+        body = io.BytesIO(self.data[start:end + 1])
+        return append_chunk(session.pk, self.user, f'bytes {start}-{end}/{len(self.data)}', body, checksum)
+
+    def test_chunks_must_arrive_at_the_received_offset(self):
+        session = self.open()
+        self.assertEqual(self.put(session, 0, 9).received, 10)
+
+        with self.assertRaises(UploadError) as raised:
+            self.put(session, 15, 19)
+        self.assertEqual((raised.exception.status, raised.exception.offset), (409, 10))
+
+        # a repeated chunk is a conflict too, and leaves the offset alone
+        with self.assertRaises(UploadError) as raised:
+            self.put(session, 0, 9)
+        self.assertEqual((raised.exception.status, raised.exception.offset), (409, 10))
+
+        self.assertEqual(self.put(session, 10, 19).received, 20)
+        with open(part_path(session), 'rb') as fh:
+            self.assertEqual(fh.read(), self.data)
+
+    def test_chunk_checksum_mismatch_is_rejected(self):
+        session = self.open()
+        with self.assertRaises(UploadError) as raised:
+            self.put(session, 0, 9, checksum='0' * 64)
+        self.assertEqual((raised.exception.status, raised.exception.offset), (400, 0))
+        session.refresh_from_db()
+        self.assertEqual(session.received, 0)
+        self.assertEqual(os.listdir(os.path.dirname(part_path(session))), [])
+
+        self.put(session, 0, 9, checksum=hashlib.sha256(self.data[:10]).hexdigest())
+        session.refresh_from_db()
+        self.assertEqual(session.received, 10)
+
+    def test_complete_with_file_checksum_mismatch_resets_the_session(self):
+        session = self.open(sha256=hashlib.sha256(b'other bytes').hexdigest())
+        self.put(session, 0, 19)
+
+        with self.assertRaises(UploadError) as raised:
+            complete_upload_session(session.pk, self.user)
+        self.assertEqual((raised.exception.status, raised.exception.offset), (422, 0))
+        session.refresh_from_db()
+        self.assertEqual((session.status, session.received), (UploadSession.STATUS_OPEN, 0))
+        self.assertFalse(os.path.exists(part_path(session)))
+
+    def test_complete_stores_the_verified_file(self):
+        digest = hashlib.sha256(self.data).hexdigest()
+        session = self.open(sha256=digest)
+        self.put(session, 0, 19)
+
+        session = complete_upload_session(session.pk, self.user)
+        self.assertEqual(session.status, UploadSession.STATUS_COMPLETE)
+        self.assertIn(digest, session.stored_name)
+        storage = Response._meta.get_field('media_upload').storage
+        with storage.open(session.stored_name) as fh:
+            self.assertEqual(fh.read(), self.data)
+        # completing again is a no-op
+        self.assertEqual(complete_upload_session(session.pk, self.user).stored_name, session.stored_name)
@@ -0,0 +1,290 @@
+import glob
+import hashlib
+import os
+import re
+import shutil
+import uuid
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+from django.db import transaction
+from django.urls import reverse
+
+from .media import forget_media
+from .models import Response, UploadSession
+from .storage import HashedMediaStorage, is_blob_name
+
+# accepted content types per upload question type (runner and chunked uploads)
+UPLOAD_CONTENT_TYPES = {
+    'PHOTO_UPLOAD': ['image/jpeg', 'image/png'],
+    'PHOTO_MULTI_UPLOAD': ['image/jpeg', 'image/png'],
+    'VIDEO_UPLOAD': ['video/mp4', 'video/quicktime'],
+    'AUDIO_UPLOAD': ['audio/mpeg', 'audio/wav', 'audio/ogg'],
+}
+
+PARTIAL_UPLOAD_DIR = 'uploads/partial'
+# a PUT may carry a little more than the advertised chunk size, never much more
+MAX_CHUNK_BYTES = 2 * settings.UPLOAD_CHUNK_SIZE
+READ_BLOCK = 64 * 1024
+
+CONTENT_RANGE_RE = re.compile(r'^bytes (\d+)-(\d+)/(\d+)$')
+
+
+class UploadError(Exception):
+    """Rejected upload request; status is the HTTP status to answer with."""
+
+    def __init__(self, message, status=400, offset=None):
+        super().__init__(message)
+        self.status = status
+        self.offset = offset
+
+
+def part_path(session):
+    return os.path.join(settings.MEDIA_ROOT, PARTIAL_UPLOAD_DIR, f"{session.pk}.part")
+
+
+def session_state(session):
+    return {
+        'id': str(session.pk),
+        'url': reverse('surveys:upload_session_detail', args=[session.pk]),
+        'status': session.status,
+        'offset': session.received,
+        'size': session.total_size,
+        'chunk_size': settings.UPLOAD_CHUNK_SIZE,
+    }
+
+
+def open_upload_session(user, question, filename, content_type, size, sha256=''):
+    """
+    Start a chunked upload, or resume the open one for the same file.
+
+    A reconnecting client re-sends the same metadata and gets the existing
+    session back with the offset to continue from.
+    """
+    allowed = UPLOAD_CONTENT_TYPES.get(question.question_type)
+    if allowed is None:
+        raise UploadError("This question does not accept uploads.")
+    if content_type not in allowed:
+        raise UploadError("Invalid file type.")
+    if size <= 0 or size > settings.MAX_CHUNKED_UPLOAD_SIZE:
+        raise UploadError("Invalid file size.", status=413 if size > 0 else 400)
+    sha256 = (sha256 or '').lower()
+    if sha256 and not re.fullmatch(r'[0-9a-f]{64}', sha256):
+        raise UploadError("Invalid sha256.")
+
+    filename = os.path.basename(filename or '')[:255] or 'upload'
+    open_sessions = UploadSession.objects.filter(user=user, status=UploadSession.STATUS_OPEN)
+    session = (
+        open_sessions
+        .filter(
+            question=question,
+            filename=filename,
+            total_size=size,
+            sha256=sha256,
+        )
+        .order_by('-updated_at')
+        .first()
+    )
+    if session is None:
+        if open_sessions.count() >= settings.MAX_OPEN_UPLOAD_SESSIONS:
+            raise UploadError("Too many unfinished uploads; finish or wait for them to expire.", status=429)
+        session = UploadSession.objects.create(
+            user=user,
+            survey_id=question.survey_id,
+            question=question,
+            filename=filename,
+            content_type=content_type,
+            total_size=size,
+            sha256=sha256,
+        )
+    return session
+
+
+def parse_content_range(header):
+    """(start, end, total) from 'bytes start-end/total'; end is inclusive."""
+    match = CONTENT_RANGE_RE.match(header or '')
+    if not match:
+        raise UploadError("Missing or invalid Content-Range.")
+    start, end, total = (int(g) for g in match.groups())
+    if end < start:
+        raise UploadError("Invalid Content-Range.")
+    return start, end, total
+
+
+def _session_expecting(session_id, user, start, end, total):
+    """The session row, locked, if it is open and its next byte is start."""
+    session = (
+        UploadSession.objects
+        .select_for_update()
+        .filter(pk=session_id, user=user)
+        .first()
+    )
+    if session is None:
+        raise UploadError("Upload not found.", status=404)
+    if session.status != UploadSession.STATUS_OPEN:
+        raise UploadError("Upload already completed.", status=409, offset=session.received)
+    if total != session.total_size or end >= session.total_size:
+        raise UploadError("Range does not match the upload size.")
+    if start != session.received:
+        raise UploadError("Unexpected offset.", status=409, offset=session.received)
+    return session
+
+
+def append_chunk(session_id, user, content_range, stream, checksum=''):
+    """
+    Append one byte range to a session's part file.
+
+    The range must start exactly at the received offset (409 with the
+    current offset otherwise, so the client can resync). The chunk is read
+    from the client into a file of its own without holding the session lock
+    or a transaction; the offset is then checked again under the lock and
+    the chunk appended, the part file first being cut back to the offset
+    (bytes of an earlier interrupted append). With a checksum (hex sha256
+    of the chunk) a corrupted chunk is rejected.
+    """
+    start, end, total = parse_content_range(content_range)
+    length = end - start + 1
+    if length > MAX_CHUNK_BYTES:
+        raise UploadError("Chunk too large.", status=413)
+
+    with transaction.atomic():
+        session = _session_expecting(session_id, user, start, end, total)
+
+    path = part_path(session)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    chunk_path = f"{path}.{uuid.uuid4().hex}.chunk"
+    try:
+        digest = hashlib.sha256()
+        remaining = length
+        with open(chunk_path, 'wb') as fh:
+            while remaining:
+                block = stream.read(min(READ_BLOCK, remaining))
+                if not block:
+                    break
+                digest.update(block)
+                fh.write(block)
+                remaining -= len(block)
+        if remaining or (checksum and checksum.lower() != digest.hexdigest()):
+            raise UploadError(
+                "Incomplete chunk." if remaining else "Chunk checksum mismatch.",
+                status=400,
+                offset=session.received,
+            )
+
+        with transaction.atomic():
+            # a concurrent PUT of the same range may have landed meanwhile
+            session = _session_expecting(session_id, user, start, end, total)
+            with open(path, 'ab') as fh, open(chunk_path, 'rb') as chunk:
+                fh.truncate(session.received)
+                shutil.copyfileobj(chunk, fh, 1024 * 1024)
+            session.received = end + 1
+            session.save(update_fields=['received', 'updated_at'])
+    finally:
+        if os.path.exists(chunk_path):
+            os.remove(chunk_path)
+    return session
+
+
+def _file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fh:
+        for block in iter(lambda: fh.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def complete_upload_session(session_id, user):
+    """
+    Verify the assembled file and move it to Response.media_upload's storage.
+
+    Idempotent: completing a completed session returns it unchanged. On a
+    whole-file checksum mismatch the part file is dropped and the client has
+    to upload again.
+    """
+    with transaction.atomic():
+        session = (
+            UploadSession.objects
+            .select_for_update()
+            .filter(pk=session_id, user=user)
+            .first()
+        )
+        if session is None:
+            raise UploadError("Upload not found.", status=404)
+        if session.status == UploadSession.STATUS_COMPLETE:
+            return session
+        if session.received != session.total_size:
+            raise UploadError("Upload is not finished.", status=409, offset=session.received)
+
+        path = part_path(session)
+        digest = _file_sha256(path)
+        mismatch = bool(session.sha256) and session.sha256 != digest
+        if mismatch:
+            os.remove(path)
+            session.received = 0
+            session.save(update_fields=['received', 'updated_at'])
+        else:
+            _store_upload(session, path, digest)
+
+    # raised outside the atomic block so the reset above is kept
+    if mismatch:
+        raise UploadError("File checksum mismatch; upload it again.", status=422, offset=0)
+    return session
+
+
+def _store_upload(session, path, digest):
+    field = Response._meta.get_field('media_upload')
+    storage = field.storage
+    if isinstance(storage, HashedMediaStorage):
+        # already hashed: rename into the blob store (or drop the duplicate)
+        name = storage.adopt(path, session.filename, digest)
+    elif isinstance(storage, FileSystemStorage):
+        # the part file already lives on the same volume: rename, don't copy
+        name = storage.get_available_name(field.generate_filename(None, session.filename))
+        target = storage.path(name)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(path, target)
+    else:
+        with open(path, 'rb') as fh:
+            name = storage.save(field.generate_filename(None, session.filename), File(fh))
+        os.remove(path)
+
+    session.sha256 = digest
+    session.stored_name = name
+    session.status = UploadSession.STATUS_COMPLETE
+    session.save(update_fields=['sha256', 'stored_name', 'status', 'updated_at'])
+
+
+def completed_uploads(user, question, session_ids):
+    """Completed sessions of this user and question among the ids the runner form posted."""
+    ids = []
+    for raw in session_ids:
+        try:
+            ids.append(str(UploadSession._meta.pk.to_python(raw)))
+        except ValidationError:
+            continue
+    if not ids:
+        return []
+    return list(
+        UploadSession.objects
+        .filter(pk__in=ids, user=user, question=question, status=UploadSession.STATUS_COMPLETE)
+        .order_by('created_at')
+    )
+
+
+def discard_upload_session(session, keep_file=False):
+    """
+    Delete a session and its part file. A completed file nobody attached is
+    handed to the blob collector: the same bytes may belong to other answers.
+    """
+    # the part file and any chunk file a killed request left behind
+    for path in [part_path(session), *glob.glob(f"{glob.escape(part_path(session))}.*.chunk")]:
+        if os.path.exists(path):
+            os.remove(path)
+    if session.stored_name and not keep_file:
+        if is_blob_name(session.stored_name):
+            forget_media(session.stored_name)
+        else:
+            Response._meta.get_field('media_upload').storage.delete(session.stored_name)
+    session.delete()
@@ -14,6 +14,10 @@ urlpatterns = [
     path('<int:survey_id>/question/<int:question_id>/', views.survey_question, name='survey_question'),
     path('<int:survey_id>/submit/', views.survey_submit, name='survey_submit'),
     path('<int:survey_id>/already-submitted/', views.already_submitted, name='already_submitted'),
+    # chunked / resumable uploads for upload questions
+    path('<int:survey_id>/question/<int:question_id>/uploads/', views.upload_session_create, name='upload_session_create'),
+    path('uploads/<uuid:session_id>/', views.upload_session_detail, name='upload_session_detail'),
+    path('uploads/<uuid:session_id>/complete/', views.upload_session_complete, name='upload_session_complete'),
     path('api/question-data/<int:question_id>/', views.get_question_data, name="question_data_api",),
     path("admin/surveys/question-lookup/", admin.site.admin_view(views.question_lookup), name="admin_question_lookup"),
     path('api/question-preview/<int:question_id>/', views.get_question_preview_html, name='question_preview_html'),
@@ -6,20 +6,35 @@ from django.conf import settings
 from datetime import timedelta
 import json
 from django.views.decorators.csrf import csrf_exempt, csrf_protect
-from django.views.decorators.http import require_POST
+from django.views.decorators.http import require_POST, require_http_methods
 from django.utils.dateparse import parse_datetime
-from .services import validate_and_collect_matrix_responses, get_next_question_in_sequence, finalize_submission
+from .services import (
+    validate_and_collect_matrix_responses, get_next_question_in_sequence, finalize_submission,
+    user_survey_progress, open_survey_run, refresh_run_progress, AnswerWriter, group_matrix_columns,
+)
 from django.contrib import messages
 from django.shortcuts import render, redirect, get_object_or_404
 from django.http import HttpResponseForbidden, HttpResponseBadRequest, JsonResponse, Http404
-from .models import Survey, Response, Choice, Question, Submission, MatrixRow, MatrixColumn, MatrixCellRouting, SbsCellRouting
+from .models import Survey, Response, Choice, Question, Submission, MatrixRow, MatrixColumn, MatrixCellRouting, SbsCellRouting, UploadSession
+from .uploads import (
+    UPLOAD_CONTENT_TYPES,
+    UploadError,
+    append_chunk,
+    complete_upload_session,
+    completed_uploads,
+    discard_upload_session,
+    open_upload_session,
+    session_state,
+)
 from .forms import SurveyResponseForm, WizardQuestionForm
-from .logic import next_displayable, is_visible, safe_next_question, find_next_visible_after, eval_rules
+from .logic import next_displayable, is_visible, safe_next_question, find_next_visible_after, eval_rules, AnswersMap
+from .flow import get_flow_plan, invalidate_flow_plan
 from django.db import models
 from django.utils.html import escape
 from django.forms import inlineformset_factory
 from django.core.paginator import Paginator
 from django.db.models import Q
+from django.db.models.functions import Coalesce
 from django.contrib.postgres.search import SearchVector, SearchQuery, SearchRank
 from django.db import connection
 import re
@@ -50,8 +65,18 @@ def survey_list(request):
     )
     completed_ids = completed_submissions.values_list("survey_id", flat=True)
 
+    # Question totals per survey, computed in the same query
+    question_totals = (
+        Question.objects
+        .filter(survey=models.OuterRef("pk"))
+        .order_by()
+        .values("survey")
+        .annotate(n=models.Count("id"))
+        .values("n")
+    )
+
     # Available surveys user can access and has not completed
-    available_surveys = (
+    available_surveys = list(
         Survey.objects
         .filter(is_active=True)
         .filter(
@@ -60,28 +85,18 @@ def survey_list(request):
         )
         .exclude(id__in=completed_ids)
         .distinct()
+        .annotate(total_questions=Coalesce(models.Subquery(question_totals), 0))
         .order_by("-created_at")
     )
 
+    # Answered counts for every card, straight from the user's SurveyRun rows
+    answered_counts = user_survey_progress(user, [s.id for s in available_surveys])
+
     # Build cards for available/in-progress surveys
     survey_cards = []
     for survey in available_surveys:
-        total_questions = Question.objects.filter(survey=survey).count()
-
-        answered_count = (
-            Response.objects
-            .filter(user=user, survey=survey)
-            .filter(
-                models.Q(choice__isnull=False) |
-                models.Q(text_answer__gt="") |
-                models.Q(media_upload__isnull=False) |
-                models.Q(value__isnull=False) |
-                (models.Q(latitude__isnull=False) & models.Q(longitude__isnull=False))
-            )
-            .values("question_id")
-            .distinct()
-            .count()
-        )
+        total_questions = survey.total_questions
+        answered_count = answered_counts[survey.id]
 
         progress_percent = int((answered_count / total_questions) * 100) if total_questions else 0
         if progress_percent > 100:
@@ -105,7 +120,7 @@ def survey_list(request):
 def survey_question(request, survey_id, question_id=None):
     """
     Survey runner with:
-      - Back button support via a session-stored navigation path
+      - Back button support via the navigation path stored on the SurveyRun
       - Editable answers (replace instead of duplicate)
       - Visibility-aware forward navigation (safe_next_question)
     """
@@ -119,126 +134,99 @@ def survey_question(request, survey_id, question_id=None):
     if survey.groups.exists() and not survey.groups.filter(id__in=request.user.groups.all()).exists():
         return HttpResponseForbidden("Access denied.")
 
-    # 🧭 navigation path kept in session for "Back" support
-    path_key = f"survey_{survey.id}_path"
+    # ⏱ In-progress run: start time, resume position and the "Back" navigation path
+    run = open_survey_run(request, survey)
 
-    def get_path():
-        return list(request.session.get(path_key, []))
-
-    def set_path(p):
-        request.session[path_key] = p
-        request.session.modified = True
-
-    def push_to_path(qid: int):
+    def push_to_path(qid: int) -> bool:
         """Append current question id if it's not already the tail."""
-        p = get_path()
-        if not p or p[-1] != qid:
-            p.append(qid)
-            set_path(p)
+        if not run.path or run.path[-1] != qid:
+            run.path.append(qid)
+            return True
+        return False
 
     def pop_current_and_prev() -> int | None:
         """
         Pops current id (tail) and returns previous id if present.
         If already at the first item, returns None.
         """
-        p = get_path()
-        if not p:
+        if not run.path:
             return None
-        _curr = p.pop()  # remove current
-        prev = p[-1] if p else None
-        set_path(p)
+        _curr = run.path.pop()  # remove current
+        prev = run.path[-1] if run.path else None
+        run.save(update_fields=["path", "updated_at"])
         return prev
 
-    # ⏱ Start-time tracking (existing)
-    session_key = f"survey_{survey.id}_start_time"
-    if session_key not in request.session:
-        request.session[session_key] = now().isoformat()
-    start_iso = request.session.get(session_key)
-    start_time = parse_datetime(start_iso) if start_iso else None
-    if not start_time:
-        start_time = now()
-        request.session[session_key] = start_time.isoformat()
-    elif is_naive(start_time):
-        start_time = make_aware(start_time)
-
-    # All questions in fixed order
-    all_questions = list(survey.questions.order_by("sort_index", 'id'))
+    # Compiled routing graph (cached per survey); all questions in fixed order
+    plan = get_flow_plan(survey)
+    all_questions = plan.questions
+
+    # In-progress answers, loaded at most once per request and kept in sync on save
+    answers = AnswersMap(request.user, survey, plan)
 
     # 🔍 Resolve which question to show
     if question_id:
         # 🔙 Explicit question id (Back button or routed Next)
         # Show it as-is (we allow editing even if it already has a response).
-        question = get_object_or_404(Question, id=question_id, survey=survey)
+        question = plan.get(question_id)
+        if question is None:
+            raise Http404("Question not found")
 
     else:
         # ➡️ AUTO MODE:
         # Find the first question that is BOTH:
         #   - visible (according to visibility_rules + routing via next_displayable)
         #   - unanswered (no in-progress Response for this user/survey)
-        answered_ids = set(
-            Response.objects.filter(
-                user=request.user,
-                survey=survey,
-                submission__isnull=True,
-            ).values_list("question_id", flat=True)
-        )
+        answered_ids = answers.answered_question_ids
 
         visible_unanswered = None
 
-        for base_q in all_questions:
-            # From each base question, follow its next_question chain
-            # and visibility rules to find the first displayable candidate
-            cand = next_displayable(base_q, request.user, survey)
-            if not cand:
-                continue
-
-            # Skip if that candidate already has an in-progress answer
-            has_answer = Response.objects.filter(
-                user=request.user,
-                survey=survey,
-                question=cand,
-                submission__isnull=True,
-            ).exists()
-            if has_answer:
-                continue
-
-            # ✅ Found a visible & unanswered question
-            visible_unanswered = cand
-            break
+        # Resume where the respondent left off when that question is still open
+        last_q = plan.get(run.last_question_id)
+        if last_q and last_q.id not in answered_ids and is_visible(last_q, request.user, survey, answers, plan):
+            visible_unanswered = last_q
+        else:
+            for base_q in all_questions:
+                # From each base question, follow its next_question chain
+                # and visibility rules to find the first displayable candidate
+                cand = next_displayable(base_q, request.user, survey, answers, plan)
+                if not cand:
+                    continue
+
+                # Skip if that candidate already has an in-progress answer
+                if cand.id in answered_ids:
+                    continue
+
+                # ✅ Found a visible & unanswered question
+                visible_unanswered = cand
+                break
 
         if not visible_unanswered:
-            finalize_submission(request=request, survey=survey, session_key=session_key)
-            request.session.pop(session_key, None)
-            request.session.pop(path_key, None)
+            finalize_submission(request=request, survey=survey, run=run)
             return redirect('surveys:survey_submit', survey_id=survey.id)
 
         question = visible_unanswered
 
-    # 🧭 track this question in the path for Back support
-    push_to_path(question.id)
+    # 🧭 track this question on the run (Back path + resume position)
+    if push_to_path(question.id) or run.last_question_id != question.id:
+        run.last_question = question
+        run.save(update_fields=["path", "last_question", "updated_at"])
 
     # expose "first step" flag for template (length <= 1 means we're at the first visible question)
-    is_first_step = len(get_path()) <= 1
+    is_first_step = len(run.path) <= 1
 
     # Progress
     current_index = all_questions.index(question) + 1
     total_questions = len(all_questions)
     progress_percent = int((current_index / total_questions) * 100)
 
+    # 🆕 answer persistence: one prefetched option set, one delete + bulk insert per save
+    writer = AnswerWriter(request.user, survey, question, plan)
+    writer.prefetch()
+
     # Side-by-side matrix grouping (existing)
-    grouped_matrix_columns = defaultdict(list)
+    grouped_matrix_columns = {}
     if question.question_type == 'MATRIX' and question.matrix_mode == 'side_by_side':
-        columns = question.matrix_columns.all().order_by('group', 'value')
-        for col in columns:
-            key = col.group or "Ungrouped"
-            grouped_matrix_columns[key].append(col)
-    grouped_matrix_columns = dict(grouped_matrix_columns)
-
-    # 🆕 helper: replace a single-answer response atomically (delete then insert)
-    def replace_single_answer(*, user, survey, question):
-        Response.objects.filter(
-            user=user, survey=survey, question=question, submission__isnull=True
-        ).delete()
+        grouped_matrix_columns = writer.column_groups
 
     if request.method == 'POST':
         # 🧭 NEW: detect which nav button was clicked
@@ -272,11 +260,10 @@ def survey_question(request, survey_id, question_id=None):
                     })
                 else:
                     # 🆕 user cleared selection on a non-required question: wipe existing response
-                    replace_single_answer(user=request.user, survey=survey, question=question)
+                    writer.replace()
             else:
-                try:
-                    choice = Choice.objects.get(id=answer, question=question)
-                except Choice.DoesNotExist:
+                choice = writer.choice(answer)
+                if choice is None:
                     messages.error(request, "Invalid option selected. Please try again.")
                     return render(request, 'surveys/survey_question.html', {
                         'survey': survey,
@@ -289,16 +276,12 @@ def survey_question(request, survey_id, question_id=None):
                     })
 
                 custom_other = request.POST.get('other_text', '').strip()
-                replace_single_answer(user=request.user, survey=survey, question=question)
-                Response.objects.create(
-                    user=request.user,
-                    survey=survey,
-                    question=question,
+                writer.replace([writer.build(
                     choice=choice,
                     text_answer=custom_other if choice.text.lower() == 'other' else '',
                     value=choice.value if choice.value is not None else None,
-                )
-                next_q = choice.next_question
+                )])
+                next_q = plan.choice_target(choice.id)
 
         elif question.question_type == 'YESNO':
             if question.required and not answer:
@@ -314,18 +297,11 @@ def survey_question(request, survey_id, question_id=None):
                 })
             if answer and answer.lower() in ['yes', 'no']:
                 value = 1 if answer.lower() == "yes" else 0
-                replace_single_answer(user=request.user, survey=survey, question=question)
-                Response.objects.create(
-                    user=request.user,
-                    survey=survey,
-                    question=question,
-                    text_answer=answer.lower(),
-                    value=value
-                )
+                writer.replace([writer.build(text_answer=answer.lower(), value=value)])
             else:
                 # 🆕 cleared on non-required → wipe previous
-                replace_single_answer(user=request.user, survey=survey, question=question)
-            next_q = question.next_question or get_next_question_in_sequence(all_questions, question)
+                writer.replace()
+            next_q = plan.chain_next(question) or get_next_question_in_sequence(all_questions, question)
 
         elif question.question_type == 'NUMBER':
             raw = (answer or '').strip()
@@ -354,18 +330,11 @@ def survey_question(request, survey_id, question_id=None):
                         'previous_response': None,
                         'grouped_matrix_columns': grouped_matrix_columns,
                     })
-                replace_single_answer(user=request.user, survey=survey, question=question)
-                Response.objects.create(
-                    user=request.user,
-                    survey=survey,
-                    question=question,
-                    text_answer=str(number_value),
-                    value=number_value
-                )
+                writer.replace([writer.build(text_answer=str(number_value), value=number_value)])
             else:
                 # cleared on non-required
-                replace_single_answer(user=request.user, survey=survey, question=question)
-            next_q = question.next_question or get_next_question_in_sequence(all_questions, question)
+                writer.replace()
+            next_q = plan.chain_next(question) or get_next_question_in_sequence(all_questions, question)
 
         elif question.question_type == 'SLIDER':
             slider_moved = request.POST.get('slider_moved') == "true"
@@ -401,18 +370,11 @@ def survey_question(request, survey_id, question_id=None):
                 if question.max_value is not None and slider_value > question.max_value:
                     messages.error(request, f"Value must be at most {question.max_value}.")
                     return render(request, 'surveys/survey_question.html', {...})
-                replace_single_answer(user=request.user, survey=survey, question=question)
-                Response.objects.create(
-                    user=request.user,
-                    survey=survey,
-                    question=question,
-                    text_answer=str(slider_value),
-                    value=slider_value
-                )
+                writer.replace([writer.build(text_answer=str(slider_value), value=slider_value)])
             else:
                 # cleared on non-required
-                replace_single_answer(user=request.user, survey=survey, question=question)
-            next_q = question.next_question or get_next_question_in_sequence(all_questions, question)
+                writer.replace()
+            next_q = plan.chain_next(question) or get_next_question_in_sequence(all_questions, question)
 
         elif question.question_type == 'DATE':
             if not answer and question.required:
@@ -431,15 +393,9 @@ def survey_question(request, survey_id, question_id=None):
                     parsed_date = datetime.datetime.strptime(answer, '%Y-%m-%d').date()
                 except ValueError:
                     return HttpResponseBadRequest("Invalid date format. Please use YYYY-MM-DD.")
-                replace_single_answer(user=request.user, survey=survey, question=question)
-                Response.objects.create(
-                    user=request.user,
-                    survey=survey,
-                    question=question,
-                    text_answer=parsed_date.isoformat(),
-                )
+                writer.replace([writer.build(text_answer=parsed_date.isoformat())])
             else:
-                replace_single_answer(user=request.user, survey=survey, question=question)
+                writer.replace()
 
         elif question.question_type == 'GEOLOCATION':
             # Read coords coming from the hidden inputs
@@ -460,21 +416,12 @@ def survey_question(request, survey_id, question_id=None):
                     'is_first_step': is_first_step,
                 })
 
-            # 🆕 Always replace previous in-progress geo answer (edit support)
-            replace_single_answer(user=request.user, survey=survey, question=question)
-
-            # If user actually picked a point (or it’s optional), save it
-            if lat and lng:
-                Response.objects.create(
-                    user=request.user,
-                    survey=survey,
-                    question=question,
-                    latitude=lat,
-                    longitude=lng,
-                )
+            # 🆕 Always replace previous in-progress geo answer (edit support);
+            # a point is only stored if the user actually picked one
+            writer.replace([writer.build(latitude=lat, longitude=lng)] if lat and lng else [])
 
             # Normal forward routing
-            next_q = question.next_question or get_next_question_in_sequence(all_questions, question)
+            next_q = plan.chain_next(question) or get_next_question_in_sequence(all_questions, question)
 
         elif question.question_type == 'TEXT':
             txt = (answer or '').strip()
@@ -490,40 +437,31 @@ def survey_question(request, survey_id, question_id=None):
                     'grouped_matrix_columns': grouped_matrix_columns,
                 })
             # Replace whether empty or not (empty = clearing on non-required)
-            replace_single_answer(user=request.user, survey=survey, question=question)
-            if txt:
-                Response.objects.create(
-                    user=request.user,
-                    survey=survey,
-                    question=question,
-                    text_answer=txt,
-                )
-            next_q = question.next_question or get_next_question_in_sequence(all_questions, question)
+            writer.replace([writer.build(text_answer=txt)] if txt else [])
+            next_q = plan.chain_next(question) or get_next_question_in_sequence(all_questions, question)
 
         elif question.question_type in ['PHOTO_UPLOAD', 'PHOTO_MULTI_UPLOAD', 'VIDEO_UPLOAD', 'AUDIO_UPLOAD']:
             files = request.FILES.getlist('answer_file') if question.allow_multiple_files else [
                 request.FILES.get('answer_file')
             ]
-            allowed_types = {
-                'PHOTO_UPLOAD': ['image/jpeg', 'image/png'],
-                'PHOTO_MULTI_UPLOAD': ['image/jpeg', 'image/png'],
-                'VIDEO_UPLOAD': ['video/mp4', 'video/quicktime'],
-                'AUDIO_UPLOAD': ['audio/mpeg', 'audio/wav', 'audio/ogg'],
-            }
+            files = [f for f in files if f]
+            # validate every file before touching the stored answer
+            if any(f.content_type not in UPLOAD_CONTENT_TYPES[question.question_type] for f in files):
+                return HttpResponseBadRequest("Invalid file type.")
+            # files that arrived through the chunked upload endpoints
+            sessions = completed_uploads(request.user, question, request.POST.getlist('upload_session'))
+            uploads = [writer.build(media_upload=file, media_filename=file.name[:255]) for file in files]
+            uploads += [writer.build(media_upload=s.stored_name, media_filename=s.filename) for s in sessions]
             # 🆕 if not multiple, replace previous
             if not question.allow_multiple_files:
-                replace_single_answer(user=request.user, survey=survey, question=question)
-            for file in files:
-                if not file:
-                    continue
-                if file.content_type not in allowed_types[question.question_type]:
-                    return HttpResponseBadRequest("Invalid file type.")
-                Response.objects.create(
-                    user=request.user,
-                    survey=survey,
-                    question=question,
-                    media_upload=file,
-                )
+                writer.replace(uploads[-1:])
+                attached = sessions[-1:]
+            else:
+                writer.append(uploads)
+                attached = sessions
+            # attached files now belong to the responses; the others go to the blob collector
+            for s in sessions:
+                discard_upload_session(s, keep_file=s in attached)
 
         # --- MULTI-ANSWER TYPES ---
         elif question.question_type == 'MULTI_CHOICE':
@@ -541,34 +479,20 @@ def survey_question(request, survey_id, question_id=None):
                         'grouped_matrix_columns': grouped_matrix_columns,
                     })
                 # 🆕 cleared on non-required → wipe previous
-                Response.objects.filter(
-                    user=request.user, survey=survey, question=question, submission__isnull=True
-                ).delete()
+                writer.replace()
             else:
                 # 🆕 replace entire set
-                Response.objects.filter(
-                    user=request.user, survey=survey, question=question, submission__isnull=True
-                ).delete()
-                seen = set()
-                for ans_id in selected:
-                    if ans_id in seen:
-                        continue
-                    seen.add(ans_id)
-                    try:
-                        choice = Choice.objects.get(id=ans_id, question=question)
-                    except Choice.DoesNotExist:
-                        continue
-                    custom_other = request.POST.get('other_text', '').strip()
-                    Response.objects.create(
-                        user=request.user,
-                        survey=survey,
-                        question=question,
+                chosen = writer.selected_choices(selected)
+                custom_other = request.POST.get('other_text', '').strip()
+                writer.replace([
+                    writer.build(
                         choice=choice,
                         text_answer=custom_other if choice.text.lower() == 'other' else '',
                         value=choice.value if choice.value is not None else None,
                     )
-                    if not next_q and choice.next_question:
-                        next_q = choice.next_question
+                    for choice in chosen
+                ])
+                next_q = writer.choice_route(chosen)
 
         elif question.question_type == 'IMAGE_CHOICE':
             selected_ids = request.POST.getlist('answer')
@@ -584,23 +508,9 @@ def survey_question(request, survey_id, question_id=None):
                     'grouped_matrix_columns': grouped_matrix_columns,
                 })
             # 🆕 replace entire set (even if empty to clear)
-            Response.objects.filter(
-                user=request.user, survey=survey, question=question, submission__isnull=True
-            ).delete()
-            for choice_id in selected_ids:
-                try:
-                    choice = Choice.objects.get(id=choice_id, question=question)
-                except Choice.DoesNotExist:
-                    continue
-                Response.objects.create(
-                    user=request.user,
-                    survey=survey,
-                    question=question,
-                    choice=choice,
-                    value=choice.value,
-                )
-                if not next_q and choice.next_question:
-                    next_q = choice.next_question
+            chosen = writer.selected_choices(selected_ids)
+            writer.replace([writer.build(choice=choice, value=choice.value) for choice in chosen])
+            next_q = writer.choice_route(chosen)
 
         # 🆕 IMAGE_RATING (per-image rating with flexible scale)
         elif question.question_type == 'IMAGE_RATING':
@@ -613,7 +523,7 @@ def survey_question(request, survey_id, question_id=None):
             # Check if user rated at least one image
             has_any_rating = any(
                 request.POST.get(f'rating_{c.id}')
-                for c in question.choices.all()
+                for c in writer.choices.values()
             )
 
             if question.required and not has_any_rating:
@@ -628,15 +538,8 @@ def survey_question(request, survey_id, question_id=None):
                     'grouped_matrix_columns': grouped_matrix_columns,
                 })
 
-            # Replace previous ratings (for this in-progress submission)
-            Response.objects.filter(
-                user=request.user,
-                survey=survey,
-                question=question,
-                submission__isnull=True,
-            ).delete()
-
-            for choice in question.choices.all():
+            ratings = []
+            for choice in writer.choices.values():
                 rating_str = request.POST.get(f'rating_{choice.id}')
                 if not rating_str:
                     continue
@@ -659,24 +562,23 @@ def survey_question(request, survey_id, question_id=None):
                         'grouped_matrix_columns': grouped_matrix_columns,
                     })
 
-                # ✅ Store the rating itself as `value`, and also in `text_answer`
-                Response.objects.create(
-                    user=request.user,
-                    survey=survey,
-                    question=question,
-                    choice=choice,
-                    text_answer=str(rating_val),
-                    value=rating_val,
-                )
+                ratings.append((choice, rating_val))
+
+            # Replace previous ratings (for this in-progress submission);
+            # ✅ the rating itself is stored as `value`, and also in `text_answer`
+            writer.replace([
+                writer.build(choice=choice, text_answer=str(rating_val), value=rating_val)
+                for choice, rating_val in ratings
+            ])
 
             # Normal forward routing
-            next_q = question.next_question or get_next_question_in_sequence(all_questions, question)
+            next_q = plan.chain_next(question) or get_next_question_in_sequence(all_questions, question)
 
         # --- MATRIX TYPES ---
         elif question.question_type == 'MATRIX':
             if question.matrix_mode == 'side_by_side':
                 # Validate + collect from POST
-                is_valid, result, next_q = validate_and_collect_matrix_responses(request, survey, question)
+                is_valid, result, next_q = validate_and_collect_matrix_responses(request, survey, question, writer)
                 if not is_valid:
                     messages.error(request, result)
                     return render(request, 'surveys/survey_question.html', {
@@ -697,54 +599,30 @@ def survey_question(request, survey_id, question_id=None):
                     pass
 
                 # ✅ FULL REPLACE for this question (in-progress only)
-                from django.db import transaction
-                with transaction.atomic():
-                    deleted_ct, _ = Response.objects.filter(
-                        user=request.user,
-                        survey=survey,
-                        question=question,
-                        submission__isnull=True,  # only the current in-progress run
-                    ).delete()
-
-                    try:
-                        messages.debug(request, f"SBS: deleted {deleted_ct} old cells for q#{question.id}")
-                    except Exception:
-                        pass
-
+                writer.replace([
+                    writer.build(
+                        matrix_row=r['row'],
+                        matrix_column=r['col'],
+                        text_answer=r['answer'],
+                        value=r['value'],
+                        group_label=r.get('group_label'),
+                    )
+                    for r in result
+                ])
+                try:
                     if result:
-                        Response.objects.bulk_create([
-                            Response(
-                                user=request.user,
-                                survey=survey,
-                                question=question,
-                                matrix_row=r['row'],
-                                matrix_column=r['col'],
-                                text_answer=r['answer'],
-                                value=r['value'],
-                                group_label=r.get('group_label'),
-                            )
-                            for r in result
-                        ])
-                        try:
-                            messages.debug(request, f"SBS: inserted {len(result)} new cells for q#{question.id}")
-                        except Exception:
-                            pass
+                        messages.debug(request, f"SBS: inserted {len(result)} new cells for q#{question.id}")
                     else:
-                        try:
-                            messages.info(request, f"SBS: no values posted for q#{question.id} (cleared).")
-                        except Exception:
-                            pass
+                        messages.info(request, f"SBS: no values posted for q#{question.id} (cleared).")
+                except Exception:
+                    pass
 
             elif question.matrix_mode == 'multi':
-                # 🆕 replace entire set before re-adding
-                Response.objects.filter(
-                    user=request.user, survey=survey, question=question, submission__isnull=True
-                ).delete()
                 collected_responses = []
                 next_q = None
-                for row in question.matrix_rows.all():
+                for row in writer.rows:
                     row_has_any = False
-                    for col in question.matrix_columns.all():
+                    for col in writer.columns:
                         field_name = f"matrix_{row.id}_{col.id}"
                         submitted_values = request.POST.getlist(field_name)
                         if submitted_values:
@@ -756,14 +634,6 @@ def survey_question(request, survey_id, question_id=None):
                                     'answer': col.label,
                                     'value': val,
                                 })
-                                if not next_q:
-                                    route = MatrixCellRouting.objects.filter(
-                                        question=question, row=row, col=col
-                                    ).select_related('next_question').first()
-                                    if route and route.next_question:
-                                        next_q = route.next_question
-                                    elif col.next_question:
-                                        next_q = col.next_question
                         elif col.required:
                             messages.error(
                                 request,
@@ -789,25 +659,23 @@ def survey_question(request, survey_id, question_id=None):
                             'previous_response': None,
                             'submitted_data': request.POST,
                         })
-                for r in collected_responses:
-                    Response.objects.create(
-                        user=request.user,
-                        survey=survey,
-                        question=question,
+                # 🆕 replace entire set once every row validated
+                writer.replace([
+                    writer.build(
                         matrix_row=r['row'],
                         matrix_column=r['col'],
                         text_answer=r['answer'],
                         value=r['value'],
                     )
+                    for r in collected_responses
+                ])
+                # cell routing override, then column routing
+                next_q = writer.cell_route((r['row'], r['col']) for r in collected_responses)
 
             else:  # matrix single-select per row
-                # 🆕 replace entire set before re-adding
-                Response.objects.filter(
-                    user=request.user, survey=survey, question=question, submission__isnull=True
-                ).delete()
                 collected_responses = []
                 next_q = None
-                for row in question.matrix_rows.all():
+                for row in writer.rows:
                     field_name = f"matrix_{row.id}"
                     selected_val = request.POST.get(field_name)
                     if not selected_val:
@@ -823,7 +691,7 @@ def survey_question(request, survey_id, question_id=None):
                                 'submitted_data': request.POST,
                             })
                         continue
-                    matching_col = next((col for col in question.matrix_columns.all()
+                    matching_col = next((col for col in writer.columns
                                          if str(col.value) == selected_val), None)
                     if not matching_col:
                         messages.error(request, f"Invalid selection in row '{row.text}'.")
@@ -842,49 +710,40 @@ def survey_question(request, survey_id, question_id=None):
                         'answer': matching_col.label,
                         'value': matching_col.value,
                     })
-                    if not next_q:
-                        # 1) cell routing override
-                        route = MatrixCellRouting.objects.filter(
-                            question=question, row=row, col=matching_col
-                        ).select_related('next_question').first()
-                        if route and route.next_question:
-                            next_q = route.next_question
-                        # 2) fallback to column routing (existing)
-                        elif matching_col.next_question:
-                            next_q = matching_col.next_question
-                for r in collected_responses:
-                    Response.objects.create(
-                        user=request.user,
-                        survey=survey,
-                        question=question,
+                # 🆕 replace entire set once every row validated
+                writer.replace([
+                    writer.build(
                         matrix_row=r['row'],
                         matrix_column=r['col'],
                         text_answer=r['answer'],
                         value=r['value'],
                     )
+                    for r in collected_responses
+                ])
+                # cell routing override, then column routing
+                next_q = writer.cell_route((r['row'], r['col']) for r in collected_responses)
+
+        # Keep the answers map and the run's progress in step with what was just saved
+        if writer.saved is not None:
+            answers.set_question(question, writer.saved)
+        else:
+            answers.refresh_question(question)
+        refresh_run_progress(run)
 
         # If no explicit next_q was determined by branching, fall back to question.next or linear
         if not next_q:
             if 'choice' in locals() and choice and question.question_type in ['SINGLE_CHOICE', 'RATING', 'DROPDOWN', 'IMAGE_CHOICE'] \
-               and not getattr(question, 'allows_multiple', False) and choice.next_question:
-                next_q = choice.next_question
-            elif question.next_question:
-                next_q = question.next_question
+               and not getattr(question, 'allows_multiple', False) and plan.choice_target(choice.id):
+                next_q = plan.choice_target(choice.id)
             else:
-                try:
-                    idx = all_questions.index(question)
-                    next_q = all_questions[idx + 1]
-                except IndexError:
-                    next_q = None
+                next_q = plan.chain_next(question) or plan.next_in_order(question)
 
         # ✅ Visibility-safe forward navigation with fallback
-        next_candidate = safe_next_question(next_q, question, all_questions, request.user, survey)
+        next_candidate = safe_next_question(next_q, question, all_questions, request.user, survey, answers, plan)
         if next_candidate:
             return redirect('surveys:survey_question', survey_id=survey.id, question_id=next_candidate.id)
         else:
-            finalize_submission(request=request, survey=survey, session_key=session_key)
-            request.session.pop(session_key, None)
-            request.session.pop(path_key, None)
+            finalize_submission(request=request, survey=survey, run=run)
             return redirect('surveys:survey_submit', survey_id=survey.id)
 
     # --- AFTER POST block: GET / final render path ---
@@ -936,7 +795,7 @@ def survey_question(request, survey_id, question_id=None):
 
         # --- side_by_side mode (existing logic, now inside the MATRIX block) ---
         if question.matrix_mode == "side_by_side":
-            for row in question.matrix_rows.all():
+            for row in writer.rows:
                 row_resps = by_row.get(row.id, [])
 
                 # index row's responses by column id for quick lookup
@@ -1000,12 +859,12 @@ def survey_question(request, survey_id, question_id=None):
             #       value="{{ col.value }}"
             #
             # concat_ids is assumed to produce "matrix_{row.id}_{col.id}"
-            for row in question.matrix_rows.all():
+            for row in writer.rows:
                 row_resps = by_row.get(row.id, [])
                 # index row responses by column id
                 row_by_col_id = {r.matrix_column_id: r for r in row_resps}
 
-                for col in question.matrix_columns.all():
+                for col in writer.columns:
                     resp = row_by_col_id.get(col.id)
                     if not resp:
                         continue
@@ -1021,7 +880,7 @@ def survey_question(request, survey_id, question_id=None):
             #   row_name = "matrix_" + str(row.id)
             #   name="{{ row_name }}"
             #   value="{{ col.value }}"
-            for row in question.matrix_rows.all():
+            for row in writer.rows:
                 row_resps = by_row.get(row.id, [])
                 if not row_resps:
                     continue
@@ -1108,6 +967,74 @@ def already_submitted(request, survey_id):
     return render(request, 'surveys/already_submitted.html', {'survey': survey})
 
 
+def _upload_error(exc):
+    return JsonResponse({'error': str(exc), 'offset': exc.offset}, status=exc.status)
+
+
+# Chunked / resumable uploads for the upload question types (see surveys.uploads)
+@login_required
+@require_POST
+def upload_session_create(request, survey_id, question_id):
+    question = get_object_or_404(
+        Question.objects.select_related('survey'), pk=question_id, survey_id=survey_id, survey__is_active=True
+    )
+    survey = question.survey
+    # same group access rule as the runner (survey_question)
+    if survey.groups.exists() and not survey.groups.filter(id__in=request.user.groups.all()).exists():
+        return JsonResponse({'error': 'Access denied.'}, status=403)
+    if Submission.objects.filter(user=request.user, survey_id=survey_id).exists():
+        return JsonResponse({'error': 'Survey already submitted.'}, status=409)
+    try:
+        data = json.loads(request.body.decode('utf-8'))
+        size = int(data.get('size'))
+    except (ValueError, TypeError, AttributeError):
+        return HttpResponseBadRequest('Invalid JSON')
+
+    try:
+        session = open_upload_session(
+            request.user,
+            question,
+            filename=data.get('filename'),
+            content_type=data.get('content_type'),
+            size=size,
+            sha256=data.get('sha256', ''),
+        )
+    except UploadError as exc:
+        return _upload_error(exc)
+    return JsonResponse(session_state(session), status=201 if session.received == 0 else 200)
+
+
+@login_required
+@require_http_methods(['GET', 'PUT'])
+def upload_session_detail(request, session_id):
+    """GET: where to resume. PUT: append one Content-Range chunk (raw body)."""
+    if request.method == 'GET':
+        session = get_object_or_404(UploadSession, pk=session_id, user=request.user)
+        return JsonResponse(session_state(session))
+
+    try:
+        session = append_chunk(
+            session_id,
+            request.user,
+            request.headers.get('Content-Range'),
+            request,  # read straight from the request stream, never request.body
+            checksum=request.headers.get('X-Chunk-SHA256', ''),
+        )
+    except UploadError as exc:
+        return _upload_error(exc)
+    return JsonResponse(session_state(session))
+
+
+@login_required
+@require_POST
+def upload_session_complete(request, session_id):
+    try:
+        session = complete_upload_session(session_id, request.user)
+    except UploadError as exc:
+        return _upload_error(exc)
+    return JsonResponse({**session_state(session), 'sha256': session.sha256})
+
+
 def get_question_data(request, question_id):
     print("🔍 API HIT:", question_id)
     try:
@@ -1239,13 +1166,8 @@ def _group_matrix_columns(question):
     if question.question_type != "MATRIX" or getattr(question, "matrix_mode", None) != "side_by_side":
         return {}
 
-    grouped = defaultdict(list)
-    for col in question.matrix_columns.all().order_by("group", "value"):
-        key = col.group or "Ungrouped"
-        grouped[key].append(col)
-
-    # Convert to normal dict for template `.items`
-    return dict(grouped)
+    # Normal dict for template `.items`; reuses prefetched columns when present
+    return group_matrix_columns(question.matrix_columns.all())
 
 
 @staff_member_required
@@ -1327,6 +1249,8 @@ def reorder_questions(request, survey_id):
     with transaction.atomic():
         for idx, qid in enumerate(new_order):
             Question.objects.filter(pk=qid).update(sort_index=idx)
+    # queryset.update() bypasses signals, so drop the cached routing graph here
+    invalidate_flow_plan(survey.id)
     return JsonResponse({"ok": True})
 
 
@@ -2,6 +2,8 @@
 from django.contrib.auth.models import AbstractUser
 from django.db import models
 
+from surveys.storage import blob_storage
+
 
 # Custom user model extending Django's AbstractUser for additional fields and custom permissions
 class CustomUser(AbstractUser):
@@ -34,15 +36,17 @@ class CustomUser(AbstractUser):
 
     # NEW: user avatar/photo
     avatar = models.ImageField(
-        upload_to='avatars/',  # stored under MEDIA_ROOT/avatars/
+        upload_to='avatars/',
+        storage=blob_storage,  # stored once per content under MEDIA_ROOT/blobs/
         null=True,
         blank=True,
         help_text="Optional profile photo.")
 
-    # Method to add points to a user's balance and save changes
+    # Method to add points to a user's balance (single UPDATE, safe under concurrency).
+    # Prefer ledger.services.credit_points, which also records the ledger entry.
     def add_points(self, amount):
-        self.points += amount
-        self.save()
+        type(self).objects.filter(pk=self.pk).update(points=models.F("points") + amount)
+        self.refresh_from_db(fields=["points"])
 
 
 class UserNotificationSettings(models.Model):